@@ -0,0 +1,103 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+
+import jinja2
+from ansible.errors import AnsibleError
+from ansible.module_utils._text import to_text
+from ansible.plugins.action import ActionBase
+
+# render_cache.py sits next to the playbooks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from render_cache import (  # noqa: E402
+    UNCACHEABLE, UNDEFINED, RenderCache, record_rendered, referenced_vars, render_key,
+    write_if_changed
+)
+
+
+class ActionModule(ActionBase):
+    """template, with the rendered parts kept in a content-addressed cache
+
+    The key is the template source plus the values of the variables it
+    references. On a hit the cached part is copied to dest, without
+    rendering. The cache lives in render_cache_dir. Only src and dest are
+    supported: with any other option, no render_cache_dir, or a dest that
+    is not on the controller, this is the plain template action.
+
+    Every dest on the controller is added to the manifest of its directory
+    (render_cache.MANIFEST), cache or not, so the playbooks can remove the
+    parts this run did not render.
+    """
+
+    TRANSFERS_FILES = True
+
+    def run(self, tmp=None, task_vars=None):
+        task_vars = task_vars or {}
+        result = self._run(task_vars)
+        if (not result.get("failed") and not self._play_context.check_mode
+                and getattr(self._connection, "_remote_is_local", False)):
+            record_rendered(os.path.expanduser(self._task.args["dest"]))
+        return result
+
+    def _run(self, task_vars):
+        cache_dir = task_vars.get("render_cache_dir")
+        key = None
+        if (cache_dir and set(self._task.args) == {"src", "dest"}
+                and getattr(self._connection, "_remote_is_local", False)):
+            key = self._key(task_vars)
+        if key is None:
+            result = self._template(task_vars)
+            result["render_cache"] = "off"
+            return result
+
+        cache = RenderCache(self._templar.template(cache_dir))
+        dest = os.path.expanduser(self._task.args["dest"])
+        content = cache.get(key)
+        if content is not None:
+            changed = write_if_changed(dest, content, self._play_context.check_mode)
+            return {"changed": changed, "dest": dest, "render_cache": "hit"}
+
+        result = self._template(task_vars)
+        if not result.get("failed") and not self._play_context.check_mode:
+            with open(dest, "rb") as rendered:
+                cache.put(key, rendered.read())
+        result["render_cache"] = "miss"
+        return result
+
+    def _key(self, task_vars):
+        # None when the template cannot be keyed, it is then always rendered
+        try:
+            path = self._find_needle("templates", self._task.args["src"])
+            with open(self._loader.get_real_file(path), "rb") as template:
+                source = to_text(template.read())
+            environment = getattr(self._templar, "environment", None) or jinja2.Environment()
+            names = referenced_vars(environment, source)
+            if names & UNCACHEABLE:
+                return None
+            values = {}
+            for name in sorted(names):
+                if name in task_vars:
+                    values[name] = self._templar.template(task_vars[name])
+                else:
+                    values[name] = UNDEFINED
+        except AnsibleError:
+            return None
+        role = self._task._role.get_name() if self._task._role else ""
+        return render_key("{}/{}".format(role, self._task.args["src"]), source, values)
+
+    def _template(self, task_vars):
+        for name in ("ansible.legacy.template", "template"):
+            action = self._shared_loader_obj.action_loader.get(
+                name,
+                task=self._task.copy(),
+                connection=self._connection,
+                play_context=self._play_context,
+                loader=self._loader,
+                templar=self._templar,
+                shared_loader_obj=self._shared_loader_obj,
+            )
+            if action is not None:
+                return action.run(task_vars=task_vars)
+        raise AnsibleError("cached_template: the template action is missing")
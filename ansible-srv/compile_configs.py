@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+import argparse
+import ast
+import glob
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import time
+
+import jinja2
+import yaml
+
+from render_cache import (
+    UNCACHEABLE, UNDEFINED, RenderCache, encode_value, referenced_vars, render_key,
+    write_if_changed,
+)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, "netbox-provisioning"))
+from peer_enrichment import add_peer_ip  # noqa: E402
+
+INVENTORY = os.path.join(BASE_DIR, "netbox-provisioning", "netbox_inventory.py")
+# Roles of the Config play, in order
+ROLES = ["base", "igp", "ibgp", "transit"]
+# First line of a template overriding the environment, as in Ansible
+JINJA2_OVERRIDE = "#jinja2:"
+# Nested "{{ }}" references resolved in the variables, at most
+RESOLVE_DEPTH = 10
+
+
+def parse_cli_args(script_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--inventory', default=INVENTORY, action='store',
+        help="Inventory script, its JSON output or an INI file"
+    )
+    parser.add_argument(
+        '-e', '--extra-vars', action='append', default=[], metavar='FILE',
+        help="YAML file of variables overriding the others, e.g. the vaulted ones"
+    )
+    parser.add_argument(
+        '-l', '--limit', nargs='+', action='store',
+        help="Only compile these hosts"
+    )
+    parser.add_argument(
+        '--roles', nargs='+', choices=ROLES, default=ROLES, action='store',
+        help="Roles to include, like the playbook tags"
+    )
+    parser.add_argument(
+        '-p', '--processes', type=int, default=multiprocessing.cpu_count(), action='store',
+    )
+    parser.add_argument(
+        '--config-dir', action='store',
+        help="Where to write <ansible_host>.conf, config_dir by default"
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="Render every part, ignoring render_cache_dir"
+    )
+
+    return parser.parse_args(script_args)
+
+
+class HostUndefined(jinja2.ChainableUndefined, jinja2.StrictUndefined):
+    """Undefined as in Ansible: "is defined" on any path, an error when rendered"""
+
+
+def parse_ini(path):
+    # Ansible INI inventory: [group], [group:vars], [group:children]
+    inventory = {"_meta": {"hostvars": {}}, "all": {"hosts": [], "vars": {}, "children": []}}
+    section = None
+    with open(path) as ini_file:
+        for line in ini_file:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith("["):
+                name, _, kind = line.strip("[]").partition(":")
+                group = inventory.setdefault(name, {"hosts": [], "vars": {}, "children": []})
+                section = (group, kind)
+                continue
+            group, kind = section
+            if kind == "vars":
+                key, _, value = line.partition("=")
+                group["vars"][key.strip()] = value.strip().strip('"')
+            elif kind == "children":
+                group["children"].append(line)
+            else:
+                host, *values = line.split()
+                group["hosts"].append(host)
+                hostvars = inventory["_meta"]["hostvars"].setdefault(host, {})
+                for value in values:
+                    key, _, value = value.partition("=")
+                    hostvars[key] = value.strip('"')
+    return inventory
+
+
+def load_inventory(path):
+    """Inventory in the JSON shape of a dynamic inventory, peer IPs added"""
+    with open(path) as inventory_file:
+        head = inventory_file.read(1)
+    if head == "{":
+        with open(path) as inventory_file:
+            inventory = json.load(inventory_file)
+    elif os.access(path, os.X_OK):
+        inventory = json.loads(subprocess.check_output([path, "--list"]))
+    else:
+        inventory = parse_ini(path)
+    # Already done by netbox_inventory.py, a no-op then
+    return add_peer_ip(inventory)
+
+
+def load_vars_file(path):
+    with open(path) as vars_file:
+        content = vars_file.read()
+    if content.startswith("$ANSIBLE_VAULT"):
+        print("{}: vaulted, skipped (pass its variables with -e)".format(path), file=sys.stderr)
+        return {}
+    return yaml.safe_load(content) or {}
+
+
+def load_group_vars(group):
+    variables = {}
+    paths = sorted(
+        glob.glob(os.path.join(BASE_DIR, "group_vars", group + ".y*ml"))
+        + glob.glob(os.path.join(BASE_DIR, "group_vars", group, "*"))
+    )
+    for path in paths:
+        variables.update(load_vars_file(path))
+    return variables
+
+
+def host_groups(inventory):
+    # host -> groups, the parents of the groups included
+    parents = {}
+    for group, definition in inventory.items():
+        if group == "_meta":
+            continue
+        for child in definition.get("children", []):
+            parents.setdefault(child, set()).add(group)
+    groups = {}
+    for group, definition in inventory.items():
+        if group == "_meta":
+            continue
+        ancestors = set()
+        pending = [group]
+        while pending:
+            current = pending.pop()
+            if current not in ancestors:
+                ancestors.add(current)
+                pending.extend(parents.get(current, []))
+        for host in definition.get("hosts", []):
+            groups.setdefault(host, set()).update(ancestors)
+    return groups
+
+
+def build_hosts(inventory, limit=None):
+    """Variables of the groups, and (host, groups, inventory vars) per host
+
+    A group has its group_vars and its inventory vars. Hosts only carry
+    their own variables: the ones of the groups are shared by every host
+    and sent once to each worker.
+    """
+    groups = host_groups(inventory)
+    hosts = set(inventory["_meta"]["hostvars"]) | set(groups)
+    if limit:
+        hosts &= set(limit)
+    layers = {}
+    items = []
+    for host in sorted(hosts):
+        names = sorted(groups.get(host, set()) - {"all"})
+        for group in ["all"] + names:
+            if group not in layers:
+                layers[group] = load_group_vars(group)
+                layers[group].update(inventory.get(group, {}).get("vars", {}))
+        items.append((host, names, inventory["_meta"]["hostvars"].get(host, {})))
+    return layers, items
+
+
+def host_variables(layers, extra_vars, host, names, own):
+    """Variables of a host and the layer of each one, None for the host
+
+    Groups are merged "all" first, then by name, as Ansible does for groups
+    of the same depth, then the inventory vars and the extra vars.
+    """
+    variables = {}
+    origin = {}
+    for group in ["all"] + names:
+        variables.update(layers[group])
+        origin.update(dict.fromkeys(layers[group], group))
+    variables.update(own)
+    origin.update(dict.fromkeys(own))
+    variables.update(extra_vars)
+    origin.update(dict.fromkeys(extra_vars, "extra vars"))
+    variables["inventory_hostname"] = host
+    variables["group_names"] = names
+    variables.setdefault("ansible_host", host)
+    origin["inventory_hostname"] = origin["group_names"] = None
+    origin.setdefault("ansible_host", None)
+    return variables, origin
+
+
+def parts_plan():
+    """Parts of each platform: (part prefix, role, template), from the role tasks
+
+    The task loops give the templates, the "in group_names" conditions the
+    platform and the dest the prefix of the part files, so the compiler
+    follows the roles as they change.
+    """
+    plan = {}
+    for role in ROLES:
+        with open(os.path.join(BASE_DIR, "roles", role, "tasks", "main.yaml")) as tasks_file:
+            tasks = yaml.safe_load(tasks_file)
+        for task in tasks:
+            args = task.get("cached_template") or task.get("template")
+            if not args:
+                continue
+            dest = args.split("dest=", 1)[1]
+            prefix = re.search(r"/(\d+)_\{\{ ansible_loop.index \}\}_", dest).group(1)
+            conditions = task.get("when", [])
+            for platform in re.findall(r"'(\w+)' in group_names", " ".join(conditions)):
+                for index, item in enumerate(task.get("loop") or task.get("with_items"), 1):
+                    plan.setdefault(platform, []).append(
+                        ("{}_{}_{}.part".format(prefix, index, item), role, item + ".j2")
+                    )
+    return plan
+
+
+def load_template(role, name):
+    # Source and environment options, the override line removed as Ansible does
+    with open(os.path.join(BASE_DIR, "roles", role, "templates", name)) as template_file:
+        source = template_file.read()
+    options = {}
+    data = source
+    if data.startswith(JINJA2_OVERRIDE):
+        eol = data.find("\n")
+        for pair in data[len(JINJA2_OVERRIDE):eol].split(","):
+            key, value = pair.split(":")
+            options[key.strip()] = ast.literal_eval(value.strip())
+        data = data[eol + 1:]
+    return source, data, options
+
+
+def assemble(parts):
+    # As the assemble module: a newline between parts not ending with one
+    content = []
+    add_newline = False
+    for part in parts:
+        if add_newline:
+            content.append("\n")
+        content.append(part)
+        add_newline = not part.endswith("\n")
+    return "".join(content)
+
+
+# Per worker process: templates compiled once, see init_worker
+WORKER = {}
+
+
+def init_worker(plan, layers, extra_vars, cache_dir, config_dir):
+    templates = {}
+    for parts in plan.values():
+        for _, role, name in parts:
+            if (role, name) in templates:
+                continue
+            source, data, options = load_template(role, name)
+            # The defaults of the template module
+            environment = jinja2.Environment(
+                trim_blocks=True, keep_trailing_newline=True, undefined=HostUndefined
+            )
+            for key, value in options.items():
+                setattr(environment, key, value)
+            templates[(role, name)] = {
+                "source": source,
+                "template": environment.from_string(data),
+                "names": referenced_vars(environment, data),
+            }
+    WORKER.update(
+        plan=plan,
+        templates=templates,
+        layers=layers,
+        extra_vars=extra_vars,
+        cache=RenderCache(cache_dir) if cache_dir else None,
+        config_dir=config_dir,
+        resolver=jinja2.Environment(undefined=HostUndefined),
+        # Strings of the variables as compiled templates
+        expressions={},
+        # (layer, variable) -> encode_value(), None when it has to be resolved
+        shared={},
+    )
+
+
+def templated(value):
+    if isinstance(value, str):
+        return "{{" in value
+    if isinstance(value, dict):
+        return any(templated(item) for item in value.values())
+    if isinstance(value, list):
+        return any(templated(item) for item in value)
+    return False
+
+
+def resolve(value, variables, depth=0):
+    # Render the "{{ }}" references left in the variables
+    if isinstance(value, str) and "{{" in value and depth < RESOLVE_DEPTH:
+        if value not in WORKER["expressions"]:
+            WORKER["expressions"][value] = WORKER["resolver"].from_string(value)
+        rendered = WORKER["expressions"][value].render(variables)
+        return resolve(rendered, variables, depth + 1)
+    if isinstance(value, dict):
+        return {key: resolve(item, variables, depth) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve(item, variables, depth) for item in value]
+    return value
+
+
+def resolve_host(variables, origin, names):
+    """Resolve the variables among names, and the encoded shared ones
+
+    Group and extra vars without references are the same for every host:
+    they are neither walked nor encoded again.
+    """
+    shared = WORKER["shared"]
+    resolved = dict(variables)
+    encoded = {}
+    for name in names:
+        if name not in variables:
+            continue
+        layer = origin[name]
+        if layer is not None:
+            if (layer, name) not in shared:
+                value = variables[name]
+                shared[(layer, name)] = None if templated(value) else encode_value(value)
+            if shared[(layer, name)] is not None:
+                encoded[name] = shared[(layer, name)]
+                continue
+        resolved[name] = resolve(variables[name], resolved)
+    return resolved, encoded
+
+
+def render_part(role, name, variables, encoded):
+    # Rendered part and whether the cache had it
+    compiled = WORKER["templates"][(role, name)]
+    cache = WORKER["cache"]
+    key = None
+    if cache is not None and not compiled["names"] & UNCACHEABLE:
+        values = {
+            var: variables[var] if var in variables else UNDEFINED
+            for var in compiled["names"]
+        }
+        key = render_key("{}/{}".format(role, name), compiled["source"], values, encoded)
+        content = cache.get(key)
+        if content is not None:
+            return content.decode(), True
+    content = compiled["template"].render(variables)
+    if key is not None:
+        cache.put(key, content.encode())
+    return content, False
+
+
+def compile_host(item):
+    """Render and assemble the config of one host: (host, changed, hits, error)"""
+    host, groups, own = item
+    try:
+        variables, origin = host_variables(
+            WORKER["layers"], WORKER["extra_vars"], host, groups, own
+        )
+        parts = []
+        for platform in groups:
+            parts.extend(WORKER["plan"].get(platform, []))
+        names = {"config_dir", "ansible_host"}
+        for _, role, name in parts:
+            names |= WORKER["templates"][(role, name)]["names"]
+        variables, encoded = resolve_host(variables, origin, names)
+        hits = 0
+        rendered = []
+        # Sorted by file name, the order of assemble
+        for part, role, name in sorted(parts):
+            content, hit = render_part(role, name, variables, encoded)
+            hits += hit
+            rendered.append(content)
+        config_dir = os.path.expanduser(
+            WORKER["config_dir"] or resolve(variables["config_dir"], variables)
+        )
+        os.makedirs(config_dir, exist_ok=True)
+        host_file = "{}.conf".format(resolve(variables["ansible_host"], variables))
+        changed = write_if_changed(os.path.join(config_dir, host_file), assemble(rendered).encode())
+        return host, changed, hits, None
+    except Exception as exc:
+        # One broken host must not stop the others
+        return host, False, 0, "{}: {}".format(type(exc).__name__, exc)
+
+
+def compile_hosts(items, plan, layers, extra_vars, processes=1, cache_dir=None,
+                  config_dir=None, chunksize=64):
+    """Stream compile_host results, across a process pool with processes > 1"""
+    initargs = (plan, layers, extra_vars, cache_dir, config_dir)
+    if processes <= 1:
+        init_worker(*initargs)
+        for item in items:
+            yield compile_host(item)
+        return
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=initargs) as pool:
+        for result in pool.imap_unordered(compile_host, items, chunksize):
+            yield result
+
+
+def main():
+    args = vars(parse_cli_args(sys.argv[1:]))
+    started = time.monotonic()
+
+    extra_vars = {}
+    for path in args['extra_vars']:
+        extra_vars.update(load_vars_file(path))
+    layers, items = build_hosts(load_inventory(args['inventory']), args['limit'])
+
+    plan = {
+        platform: [part for part in parts if part[1] in args['roles']]
+        for platform, parts in parts_plan().items()
+    }
+    cache_dir = None
+    if not args['no_cache'] and items:
+        # Shared with the cached_template action of the playbooks
+        variables, _ = host_variables(layers, extra_vars, *items[0])
+        init_worker({}, layers, extra_vars, None, None)
+        cache_dir = resolve(variables.get("render_cache_dir"), variables)
+        cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+
+    counts = {"hosts": 0, "changed": 0, "hits": 0}
+    errors = {}
+    for host, changed, hits, error in compile_hosts(
+        items, plan, layers, extra_vars, args['processes'], cache_dir, args['config_dir']
+    ):
+        if error:
+            errors[host] = error
+            print("{}: {}".format(host, error), file=sys.stderr)
+            continue
+        counts["hosts"] += 1
+        counts["changed"] += changed
+        counts["hits"] += hits
+
+    print("{hosts} configs, {changed} changed, {hits} cached parts".format(**counts)
+          + " ({:.1f}s)".format(time.monotonic() - started))
+    if errors:
+        sys.exit("{} host(s) failed".format(len(errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import re
+import sys
+
+# EOS lines opening a submode within a block, the other indented lines
+# are commands of the block whatever their indentation
+EOS_SUBMODES = ("address-family ", "vrf ")
+# EOS comments, and whole lines closing a mode
+EOS_COMMENT = "!"
+EOS_SKIP = ("exit", "end")
+JUNOS_TAGS = ("replace:", "delete:")
+# Junos trailing comment, "## SECRET-DATA", the quoted strings before it skipped
+JUNOS_COMMENT = re.compile(r'^((?:[^"\\]|\\.|"(?:[^"\\]|\\.)*")*?)\s+##.*$')
+# Indentation of the rendered configs, per level
+INDENT = {"junos": "  ", "eos": "   "}
+
+
+def parse_cli_args(script_args):
+    parser = argparse.ArgumentParser(
+        description="Print the delta config turning the deployed config into the new one"
+    )
+    parser.add_argument('deployed', help="Config running on the device")
+    parser.add_argument('new', help="Config assembled for the device")
+    parser.add_argument(
+        '--syntax', choices=sorted(INDENT), action='store',
+        help="Config syntax, guessed from the new config by default"
+    )
+
+    return parser.parse_args(script_args)
+
+
+class Stanza(collections.OrderedDict):
+    """Statements of a hierarchy level: text -> Stanza, or None for a leaf"""
+
+
+def guess_syntax(text):
+    return "junos" if re.search(r"\{\s*$", text, re.MULTILINE) else "eos"
+
+
+def parse_junos(text):
+    """Tree of a Junos curly-brace config, blocks of the same path merged"""
+    root = Stanza()
+    stack = [root]
+    for line in text.splitlines():
+        # Comments: "#" lines, "/* */" lines, trailing "## SECRET-DATA"
+        line = JUNOS_COMMENT.sub(r"\1", line).strip()
+        if not line or line.startswith("#") or (line.startswith("/*") and line.endswith("*/")):
+            continue
+        # The delta is computed statement by statement, the tags are dropped
+        for prefix in JUNOS_TAGS:
+            if line.startswith(prefix):
+                line = line[len(prefix):].strip()
+        if not line:
+            # Tag alone on its line, it applies to the next statement
+            continue
+        if line == "}":
+            stack.pop()
+        elif line.endswith("{"):
+            key = line[:-1].strip()
+            stanza = stack[-1].get(key)
+            if stanza is None:
+                stanza = stack[-1][key] = Stanza()
+            stack.append(stanza)
+        else:
+            stack[-1][line.rstrip(";").strip()] = None
+    return root
+
+
+def parse_eos(text):
+    """Tree of an EOS indented config, blocks of the same path merged"""
+    root = Stanza()
+    # (indentation, stanza) of the open modes
+    stack = [(-1, root)]
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith(EOS_COMMENT) or stripped in EOS_SKIP:
+            continue
+        indent = len(line) - len(line.lstrip())
+        while len(stack) > 1 and indent <= stack[-1][0]:
+            stack.pop()
+        parent = stack[-1][1]
+        if indent == 0 or stripped.startswith(EOS_SUBMODES):
+            stanza = parent.get(stripped)
+            if stanza is None:
+                stanza = parent[stripped] = Stanza()
+            stack.append((indent, stanza))
+        else:
+            parent[stripped] = None
+    return root
+
+
+def parse(text, syntax):
+    return parse_junos(text) if syntax == "junos" else parse_eos(text)
+
+
+def keeps_order(old, new):
+    # The statements of both in the same order, the new ones after them
+    common = [key for key in new if key in old]
+    if common != [key for key in old if key in new]:
+        return False
+    return not common or all(key in old for key in list(new)[:list(new).index(common[-1])])
+
+
+def diff(old, new, ordered):
+    """Delta from old to new: a list of (action, key, value)
+
+    Actions are "delete", "add" (value: the new Stanza or None),
+    "replace" (value: the new Stanza, deleted then added whole) and "into"
+    (value: the delta of a Stanza in both). With ordered (Junos), a Stanza
+    whose statements moved, or got new ones before the kept ones, is
+    replaced. Otherwise only the statements that differ are in the delta,
+    the removed ones as deletes: the delta is merged, not replaced.
+    """
+    delta = [("delete", key, None) for key in old if key not in new]
+    for key, value in new.items():
+        if key not in old:
+            delta.append(("add", key, value))
+            continue
+        if value is None or old[key] is None:
+            if (value is None) != (old[key] is None):
+                # A leaf became a block or the opposite
+                delta.append(("delete", key, None))
+                delta.append(("add", key, value))
+            continue
+        if old[key] == value:
+            continue
+        if ordered and not keeps_order(old[key], value):
+            delta.append(("replace", key, value))
+        else:
+            delta.append(("into", key, diff(old[key], value, ordered)))
+    return delta
+
+
+def render(tree, syntax, depth=0):
+    """Lines of a whole tree"""
+    indent = INDENT[syntax] * depth
+    lines = []
+    for key, value in tree.items():
+        if value is None:
+            lines.append(indent + key + (";" if syntax == "junos" else ""))
+        elif syntax == "junos":
+            lines.append(indent + key + " {")
+            lines.extend(render(value, syntax, depth + 1))
+            lines.append(indent + "}")
+        else:
+            lines.append(indent + key)
+            lines.extend(render(value, syntax, depth + 1))
+    return lines
+
+
+def delete_line(key, syntax):
+    if syntax == "junos":
+        return "delete: {};".format(key)
+    # A negated EOS command is removed by its positive form, "no no" fails
+    if key.startswith("no "):
+        return key[len("no "):]
+    return "no {}".format(key)
+
+
+def render_delta(delta, syntax, depth=0):
+    """Lines of a delta: Junos delete: tags, EOS "no" commands"""
+    indent = INDENT[syntax] * depth
+    lines = []
+    for action, key, value in delta:
+        if action == "delete":
+            lines.append(indent + delete_line(key, syntax))
+        elif action == "into":
+            inner = render_delta(value, syntax, depth + 1)
+            if syntax == "junos":
+                lines.extend([indent + key + " {"] + inner + [indent + "}"])
+            else:
+                lines.extend([indent + key] + inner)
+        else:
+            if action == "replace":
+                # A "replace:" tag only applies to a load replace
+                lines.append(indent + delete_line(key, syntax))
+            lines.extend(render(Stanza([(key, value)]), syntax, depth))
+    return lines
+
+
+def delta_config(deployed, new, syntax=None):
+    """Config applying only the changes from deployed to new, "" if none"""
+    syntax = syntax or guess_syntax(new)
+    delta = diff(parse(deployed, syntax), parse(new, syntax), syntax == "junos")
+    lines = render_delta(delta, syntax)
+    return "".join(line + "\n" for line in lines)
+
+
+def main():
+    args = vars(parse_cli_args(sys.argv[1:]))
+    with open(args['deployed']) as deployed_file:
+        deployed = deployed_file.read()
+    with open(args['new']) as new_file:
+        new = new_file.read()
+    sys.stdout.write(delta_config(deployed, new, args['syntax']))
+
+
+if __name__ == '__main__':
+    main()
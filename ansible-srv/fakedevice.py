@@ -0,0 +1,107 @@
+import threading
+import time
+
+
+class FakeNetwork(object):
+    """Simulated lab: devices answering pings to the addresses of the inventory
+
+    Every loopback and interco address of the hosts answers, except the
+    ones in down. A config committed on a host in broken takes its
+    addresses and BGP sessions down until it is rolled back. Each session
+    open, CLI call and config operation costs latency seconds, like a
+    round trip to a device. The sessions opened and the most open at once
+    are counted.
+    """
+
+    def __init__(self, hostvars, down=(), latency=0.0, broken=()):
+        self.host_addresses = {}
+        for host, variables in hostvars.items():
+            igp = variables.get("igp", {})
+            addresses = self.host_addresses[host] = set()
+            for address in igp.get("loopbacks", {}).values():
+                addresses.add(address["local_ip"])
+            for neighbor in igp.get("neighbors", []):
+                for version in ("ipv4", "ipv6"):
+                    if version in neighbor:
+                        addresses.add(neighbor[version]["local_ip"])
+        self.addresses = set().union(*self.host_addresses.values())
+        self.down = set(down)
+        self.addresses -= self.down
+        self.broken = set(broken)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.open_now = 0
+        self.max_open = 0
+        self.calls = 0
+        # host -> last config committed and whether it was merged, and
+        # its state: pending, confirmed or rolled back
+        self.configs = {}
+        self.states = {}
+
+    def session(self, host, variables):
+        return FakeSession(self, host)
+
+
+class FakeSession(object):
+    def __init__(self, network, host):
+        self.network = network
+        self.host = host
+        self.candidate = None
+        self.merge = False
+
+    def call(self):
+        time.sleep(self.network.latency)
+        with self.network.lock:
+            self.network.calls += 1
+
+    def open(self):
+        time.sleep(self.network.latency)
+        with self.network.lock:
+            self.network.opened += 1
+            self.network.open_now += 1
+            self.network.max_open = max(self.network.max_open, self.network.open_now)
+
+    def close(self):
+        with self.network.lock:
+            self.network.open_now -= 1
+
+    def ping(self, checks):
+        self.call()
+        return [
+            check.dest in self.network.addresses and check.source in self.network.addresses
+            for check in checks
+        ]
+
+    def load_config(self, content, merge=False):
+        self.call()
+        self.candidate = content
+        self.merge = merge
+
+    def commit_confirmed(self, minutes):
+        self.call()
+        network = self.network
+        with network.lock:
+            network.configs[self.host] = (self.candidate, self.merge)
+            network.states[self.host] = "pending"
+            if self.host in network.broken:
+                network.addresses -= network.host_addresses[self.host]
+
+    def confirm(self):
+        self.call()
+        with self.network.lock:
+            self.network.states[self.host] = "confirmed"
+
+    def rollback(self):
+        self.call()
+        network = self.network
+        with network.lock:
+            network.states[self.host] = "rolled back"
+            network.addresses |= network.host_addresses[self.host] - network.down
+
+    def bgp_down(self):
+        self.call()
+        with self.network.lock:
+            if self.network.states.get(self.host) == "pending" and self.host in self.network.broken:
+                return ["all"]
+        return []
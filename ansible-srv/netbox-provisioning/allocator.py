@@ -0,0 +1,128 @@
+import bisect
+import ipaddress
+
+
+class AllocationError(ValueError):
+    pass
+
+
+def address(network, index):
+    """index-th address of a network, with its prefix length: "10.0.0.1/31" """
+    return str(ipaddress.ip_interface((int(network.network_address) + index, network.prefixlen)))
+
+
+class Pool(object):
+    """Free-space index of a prefix
+
+    Allocations are [start, end) offsets from the first address, kept sorted
+    so a new block is checked against its neighbours only.
+    """
+
+    def __init__(self, prefix):
+        self.network = ipaddress.ip_network(prefix)
+        self.first = int(self.network.network_address)
+        self.starts = []
+        self.ends = []
+
+    def block_size(self, prefixlen):
+        if not self.network.prefixlen <= prefixlen <= self.network.max_prefixlen:
+            raise AllocationError("{}: no /{} in this pool".format(self.network, prefixlen))
+        return 1 << (self.network.max_prefixlen - prefixlen)
+
+    def reserve(self, offset, size):
+        if offset < 0 or offset + size > self.network.num_addresses:
+            raise AllocationError("{}: pool exhausted".format(self.network))
+        i = bisect.bisect_right(self.starts, offset)
+        overlaps_previous = i and self.ends[i - 1] > offset
+        overlaps_next = i < len(self.starts) and self.starts[i] < offset + size
+        if overlaps_previous or overlaps_next:
+            raise AllocationError("{}: {} - {} overlaps an allocation".format(
+                self.network,
+                ipaddress.ip_address(self.first + offset),
+                ipaddress.ip_address(self.first + offset + size - 1),
+            ))
+        self.starts.insert(i, offset)
+        self.ends.insert(i, offset + size)
+
+    def network_at(self, offset, size):
+        prefixlen = self.network.max_prefixlen - size.bit_length() + 1
+        return ipaddress.ip_network((self.first + offset, prefixlen))
+
+    def subnet(self, prefixlen, index):
+        """The index-th /prefixlen of the pool"""
+        size = self.block_size(prefixlen)
+        self.reserve(index * size, size)
+        return self.network_at(index * size, size)
+
+    def carve(self, prefixlen, count):
+        """count consecutive /prefixlen, from the first gap large enough"""
+        size = self.block_size(prefixlen)
+        offset = 0
+        for start, end in zip(self.starts, self.ends):
+            if start - offset >= size * count:
+                break
+            # Next aligned offset after this allocation
+            offset = max(offset, -(-end // size) * size)
+        self.reserve(offset, size * count)
+        return [self.network_at(offset + i * size, size) for i in range(count)]
+
+
+class Allocator(object):
+    """Named parent pools, each pod takes the block at the index of its ID
+
+    Point-to-point links and loopbacks are carved from the pod blocks. A
+    pod always gets the same addresses, whichever pods are planned along
+    with it, and asking twice for the same pod returns the same addresses.
+    """
+
+    def __init__(self, pools):
+        self.pools = {}
+        self.block_lens = {}
+        self.blocks = {}
+        self.allocations = {}
+        for name, (prefix, block_len) in pools.items():
+            self.pools[name] = Pool(prefix)
+            self.block_lens[name] = block_len
+        networks = sorted(
+            (pool.network for pool in self.pools.values()),
+            key=lambda net: (net.version, net.network_address),
+        )
+        for net, next_net in zip(networks, networks[1:]):
+            if net.overlaps(next_net):
+                raise AllocationError("pools {} and {} overlap".format(net, next_net))
+
+    def block(self, name, pod_id):
+        key = (name, pod_id)
+        if key not in self.blocks:
+            try:
+                network = self.pools[name].subnet(self.block_lens[name], pod_id)
+            except AllocationError as exc:
+                raise AllocationError("pod{:02d} {}: {}".format(pod_id, name, exc))
+            self.blocks[key] = Pool(network)
+        return self.blocks[key]
+
+    def links(self, name, pod_id, count):
+        """count point-to-point networks (/31, /127) of the pod"""
+        key = ("links", name, pod_id)
+        if key not in self.allocations:
+            block = self.block(name, pod_id)
+            try:
+                self.allocations[key] = block.carve(block.network.max_prefixlen - 1, count)
+            except AllocationError as exc:
+                raise AllocationError("pod{:02d} {}: {}".format(pod_id, name, exc))
+        if len(self.allocations[key]) != count:
+            raise AllocationError("pod{:02d} {}: {} links already allocated".format(
+                pod_id, name, len(self.allocations[key])
+            ))
+        return self.allocations[key]
+
+    def host(self, name, pod_id, host_id):
+        """Host network (/32, /128) at the index host_id of the pod block"""
+        key = ("host", name, pod_id, host_id)
+        if key not in self.allocations:
+            block = self.block(name, pod_id)
+            try:
+                self.allocations[key] = block.subnet(block.network.max_prefixlen, host_id)
+            except AllocationError as exc:
+                raise AllocationError("pod{:02d} {}: {}".format(pod_id, name, exc))
+        return self.allocations[key]
@@ -0,0 +1,292 @@
+import asyncio
+import collections
+import json
+import time
+import types
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from podgraph import BATCH_SIZE, KINDS, chunks, ref_kind
+from reconcile import KEEP_KINDS
+from transport import (
+    BACKOFF, IDEMPOTENT_METHODS, RETRIES, RETRY_STATUSES, TIMEOUT, bulk_writes
+)
+
+# Requests in flight at most
+CONCURRENCY = 32
+# Objects per page of the list calls, values per filter of the lookups
+PAGE_SIZE = 1000
+FILTER_SIZE = 100
+
+# Connection failures: nothing was sent, any method can be retried
+CONNECT_ERRORS = (aiohttp.ClientConnectorError,) if aiohttp else ()
+# The request may have reached NetBox, only idempotent methods are retried
+READ_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError) if aiohttp else ()
+
+
+class AsyncRequestError(Exception):
+    """A failed request: an error status, or no response (status None)"""
+
+    def __init__(self, method, url, status, body):
+        detail = body if status is None else "{} {}".format(status, body)
+        super(AsyncRequestError, self).__init__("{} {}: {}".format(method, url, detail))
+        self.status = status
+
+
+def describe(exc):
+    return "{}: {}".format(type(exc).__name__, exc)
+
+
+class AsyncNetBox(object):
+    """NetBox REST client on aiohttp, in-flight requests capped by a semaphore
+
+    Retries follow transport.py: connection failures for every method,
+    429 and 5xx for the idempotent ones only. A session with the aiohttp
+    request() interface can be given instead of the default one. version
+    is the API-Version header of the last response, like pynetbox.
+    """
+
+    def __init__(self, url, token, concurrency=CONCURRENCY, retries=RETRIES,
+                 timeout=TIMEOUT, session=None, recorder=None):
+        self.url = url.rstrip("/") + "/api/"
+        self.token = token
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.session = session
+        self.own_session = session is None
+        self.recorder = recorder
+        self.requests = 0
+        self.semaphore = None
+        self.version = None
+
+    async def __aenter__(self):
+        # Bound to the running loop
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        if self.session is None:
+            if aiohttp is None:
+                raise RuntimeError("the async engine needs aiohttp: pip install aiohttp")
+            self.session = aiohttp.ClientSession(
+                headers={
+                    "Authorization": "Token {}".format(self.token),
+                    "Accept": "application/json",
+                    "Accept-Encoding": "gzip",
+                },
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+            )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.own_session:
+            await self.session.close()
+            self.session = None
+
+    async def send(self, method, url, payload, params):
+        # One attempt, holding a slot of the semaphore
+        async with self.semaphore:
+            self.requests += 1
+            start = time.perf_counter()
+            status = None
+            body = b""
+            try:
+                async with self.session.request(
+                    method, url, json=payload, params=params
+                ) as response:
+                    status = response.status
+                    self.version = response.headers.get("API-Version", self.version)
+                    body = await response.read()
+            finally:
+                if self.recorder is not None:
+                    self.recorder.record(
+                        start, method, url,
+                        types.SimpleNamespace(status_code=status, content=body),
+                        {"json": payload},
+                    )
+        return status, body
+
+    async def request(self, method, endpoint, payload=None, params=None, record_id=None):
+        """JSON response of one call to an "app.endpoint" path, or a record of it"""
+        url = self.url
+        if endpoint:
+            url += endpoint.replace(".", "/") + "/"
+        if record_id is not None:
+            url += "{}/".format(record_id)
+        attempt = 0
+        while True:
+            retry = attempt < self.retries
+            try:
+                status, body = await self.send(method, url, payload, params)
+            except CONNECT_ERRORS as exc:
+                if not retry:
+                    raise AsyncRequestError(method, url, None, describe(exc)) from exc
+            except READ_ERRORS as exc:
+                if not (retry and method in IDEMPOTENT_METHODS):
+                    raise AsyncRequestError(method, url, None, describe(exc)) from exc
+            else:
+                if status < 400:
+                    return json.loads(body) if body else None
+                if not (retry and status in RETRY_STATUSES and method in IDEMPOTENT_METHODS):
+                    raise AsyncRequestError(method, url, status, body.decode(errors="replace"))
+            await asyncio.sleep(BACKOFF * 2 ** attempt)
+            attempt += 1
+
+    async def bulk_writes(self):
+        """Whether NetBox takes bulk PATCH and DELETE, 2.10 and later"""
+        if self.version is None:
+            # The API root, its answer has the version on every NetBox
+            await self.request("GET", "")
+        return bulk_writes(self)
+
+    async def list(self, endpoint, **filters):
+        """Every record matching the filters, the pages after the first at once"""
+        params = [
+            (field, value)
+            for field, values in filters.items()
+            for value in (values if isinstance(values, list) else [values])
+        ]
+        first = await self.request("GET", endpoint, params=params + [("limit", PAGE_SIZE)])
+        pages = await asyncio.gather(*[
+            self.request("GET", endpoint, params=params + [("limit", PAGE_SIZE), ("offset", offset)])
+            for offset in range(PAGE_SIZE, first["count"], PAGE_SIZE)
+        ])
+        return first["results"] + [record for page in pages for record in page["results"]]
+
+
+async def lookup_known(client, graph):
+    """IDs of the shared objects of the graph already in NetBox, by slug"""
+    kinds = []
+    calls = []
+    for kind in KEEP_KINDS:
+        slugs = sorted(node["fields"]["slug"] for node in graph.objects[kind].values())
+        for chunk in chunks(slugs, FILTER_SIZE):
+            kinds.append(kind)
+            calls.append(client.list(kind, slug=chunk))
+    known = {kind: {} for kind in KINDS}
+    for kind, records in zip(kinds, await asyncio.gather(*calls)):
+        for record in records:
+            known[kind][record["slug"]] = record["id"]
+    return known
+
+
+async def provision(client, graph, batch_size=BATCH_SIZE, journal=None):
+    """Create the graph objects, each batch as soon as its references exist
+
+    Objects are grouped per kind and dependency depth into list POSTs of
+    batch_size objects, then the deferred references into bulk PATCHes,
+    one PATCH per record before NetBox 2.10.
+    Every batch is a task waiting for the batches creating the objects it
+    references, so the whole lab is in flight at once and the run takes
+    about the depth of the graph in round trips. The shared objects found
+    in NetBox are referenced instead of created, and so are the objects of
+    the journal, which gets the new ones. Returns the NetBox ID of every
+    node and the counts.
+    """
+    ids = await lookup_known(client, graph)
+    bulk = await client.bulk_writes()
+    if journal is not None:
+        for kind in KINDS:
+            ids[kind].update(
+                (key, journal.created[kind][key])
+                for key in graph.objects[kind] if key in journal.created[kind]
+            )
+    report = collections.Counter()
+    # Node -> task of the batch creating it
+    creating = {}
+    tasks = []
+
+    async def create(kind, batch, after):
+        await asyncio.gather(*after)
+        values = []
+        for key, node in batch:
+            fields = dict(node["fields"])
+            for field, ref in node["refs"].items():
+                fields[field] = ids[ref_kind(kind, field, node["fields"])][ref]
+            values.append(fields)
+        records = await client.request("POST", kind, values)
+        for (key, _), record in zip(batch, records):
+            ids[kind][key] = record["id"]
+        if journal is not None:
+            journal.create(kind, [(key, ids[kind][key]) for key, _ in batch])
+        report["create"] += len(batch)
+
+    async def link(kind, batch, after):
+        await asyncio.gather(*after)
+        updates = []
+        for key, node in batch:
+            update = {"id": ids[kind][key]}
+            for field, ref in node["deferred"].items():
+                update[field] = ids[ref_kind(kind, field, node["fields"])][ref]
+            updates.append(update)
+        if bulk:
+            await client.request("PATCH", kind, updates)
+        else:
+            # Each a request of its own, the semaphore caps them
+            await asyncio.gather(*[
+                client.request("PATCH", kind, update, record_id=update["id"])
+                for update in updates
+            ])
+        if journal is not None:
+            journal.link(kind, [key for key, _ in batch])
+        report["update"] += len(batch)
+
+    def waits(kind, batch, refs_name):
+        # Tasks creating the nodes referenced by the batch
+        nodes = set()
+        for key, node in batch:
+            for field, ref in node[refs_name].items():
+                nodes.add((ref_kind(kind, field, node["fields"]), ref))
+        return {creating[node] for node in nodes if node in creating}
+
+    depth = {}
+    for kind, nodes in graph.objects.items():
+        groups = collections.OrderedDict()
+        for key, node in nodes.items():
+            if key in ids[kind]:
+                continue
+            depth[(kind, key)] = 1 + max([
+                depth.get((ref_kind(kind, field, node["fields"]), ref), 0)
+                for field, ref in node["refs"].items()
+            ] or [0])
+            groups.setdefault(depth[(kind, key)], []).append((key, node))
+        for group in groups.values():
+            for batch in chunks(group, batch_size):
+                task = asyncio.ensure_future(create(kind, batch, waits(kind, batch, "refs")))
+                tasks.append(task)
+                for key, _ in batch:
+                    creating[(kind, key)] = task
+
+    for kind, nodes in graph.objects.items():
+        deferred = [
+            (key, node) for key, node in nodes.items()
+            if node["deferred"] and not (journal is not None and key in journal.linked[kind])
+        ]
+        for batch in chunks(deferred, batch_size):
+            # The nodes themselves and the targets of their references
+            own = {creating[(kind, key)] for key, _ in batch if (kind, key) in creating}
+            tasks.append(asyncio.ensure_future(
+                link(kind, batch, own | waits(kind, batch, "deferred"))
+            ))
+
+    # Every task runs to its end, the first failure is raised
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    report["requests"] = client.requests
+    return ids, report
+
+
+def run_graph(graph, url, token, concurrency=CONCURRENCY, retries=RETRIES, timeout=TIMEOUT,
+              recorder=None, batch_size=BATCH_SIZE, journal=None):
+    """Provision the graph from synchronous code, see provision()"""
+    async def main():
+        async with AsyncNetBox(
+            url, token, concurrency, retries, timeout, recorder=recorder
+        ) as client:
+            return await provision(client, graph, batch_size, journal)
+
+    return asyncio.run(main())
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import ipaddress
+import sys
+import timeit
+
+from peer_enrichment import compute_peer_ip
+
+
+def find_peer_ip_hosts(address, netmask):
+    # Previous implementation, enumerating the hosts of the network
+    local_ip = ipaddress.ip_interface("{}/{}".format(address, netmask))
+    peer_ip = [ip for ip in list(local_ip.network.hosts()) if ip != local_ip.ip]
+    try:
+        assert len(peer_ip) == 1
+    except AssertionError:
+        sys.exit("The auto peer IP discovering is only possible for /30, /31, /127 and /126 subnets.")
+    return str(peer_ip[0])
+
+
+CASES = [
+    ("10.1.0.0", 31),
+    ("10.1.0.1", 30),
+    ("fd00:1:1::", 127),
+    ("fd00:1:1::7", 127),
+]
+
+
+def per_call(func, number):
+    seconds = timeit.timeit(
+        lambda: [func(address, netmask) for address, netmask in CASES],
+        number=number,
+    )
+    return seconds / (number * len(CASES)) * 1e6
+
+
+def main():
+    number = 20000
+    for address, netmask in CASES:
+        assert compute_peer_ip(address, netmask) == find_peer_ip_hosts(address, netmask)
+
+    before = per_call(find_peer_ip_hosts, number)
+    cached = per_call(compute_peer_ip, number)
+    uncached = per_call(compute_peer_ip.__wrapped__, number)
+    print("hosts() enumeration  {:8.2f} us/call".format(before))
+    print("integer arithmetic   {:8.2f} us/call".format(uncached))
+    print("integer + LRU cache  {:8.2f} us/call".format(cached))
+
+
+if __name__ == '__main__':
+    main()
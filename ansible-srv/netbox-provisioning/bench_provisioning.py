@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import contextlib
+import io
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+import makelab
+import makepod
+from async_engine import CONCURRENCY, AsyncNetBox, provision
+from fakenetbox import FakeAsyncSession, FakeNetBox
+from podgraph import Graph
+from reconcile import apply
+
+
+def parse_cli_args(script_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--pod-count', type=int, nargs='+', default=[1, 10, 100], action='store',
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0, action='store',
+        help="Milliseconds added to every fake NetBox request"
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int, default=8, action='store',
+        help="Workers of the makelab.main --bulk run"
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=CONCURRENCY, action='store',
+        help="Requests in flight at most in the --async runs"
+    )
+
+    return parser.parse_args(script_args)
+
+
+class Run(object):
+    """Fake NetBox instances of one benchmark run and its measures"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.apis = []
+        self.begin()
+
+    def connect(self, *args, **kwargs):
+        api_connector = FakeNetBox(self.latency)
+        self.apis.append(api_connector)
+        return api_connector
+
+    def begin(self):
+        # Called again by the scenarios once their setup is done
+        for api_connector in self.apis:
+            api_connector.requests.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def requests(self):
+        return sum(sum(api_connector.requests.values()) for api_connector in self.apis)
+
+
+def makepod_serial(run, pod_count):
+    # makepod sets up a single pod per NetBox, each one gets its own
+    for pod_id in range(1, pod_count + 1):
+        api_connector = run.connect()
+        pods_refs = makepod.make_pod(pod_id, api_connector)
+        makepod.make_uplinks(pod_id, api_connector, pods_refs)
+
+
+def makepod_bulk(run, pod_count):
+    for pod_id in range(1, pod_count + 1):
+        apply(run.connect(), makepod.pod_graph(pod_id))
+
+
+def makelab_pods(run, pod_count, bulk):
+    api_connector = run.connect()
+    makelab.CACHE = makelab.LookupCache()
+    makelab.preload_cache(api_connector, pod_count)
+    makelab.make_pods(api_connector, pod_count, bulk=bulk)
+
+
+def makelab_tier1(run, pod_count):
+    api_connector = run.connect()
+    makelab.CACHE = makelab.LookupCache()
+    makelab.preload_cache(api_connector, pod_count)
+    pods_refs, _ = makelab.make_pods(api_connector, pod_count)
+    run.begin()
+    makelab.make_tier1(api_connector, pod_count, pods_refs)
+
+
+def provision_async(run, graph, concurrency):
+    api_connector = run.connect()
+
+    async def provision_all():
+        async with AsyncNetBox(
+            "http://netbox.fake", "fake", concurrency,
+            session=FakeAsyncSession(api_connector),
+        ) as client:
+            await provision(client, graph)
+
+    asyncio.run(provision_all())
+
+
+def makepod_async(run, pod_count, concurrency):
+    graph = Graph()
+    for pod_id in range(1, pod_count + 1):
+        makepod.pod_graph(pod_id, graph)
+    provision_async(run, graph, concurrency)
+
+
+def makelab_main(run, pod_count, *options):
+    makelab.CACHE = makelab.LookupCache()
+    argv = ["makelab.py", "--netbox-url", "fake", "--netbox-token", "fake", "-c", str(pod_count)]
+    with mock.patch.object(makelab, "connect", run.connect), \
+            mock.patch.object(sys, "argv", argv + list(options)):
+        makelab.main()
+
+
+def scenarios(workers, concurrency):
+    return [
+        ("makepod.make_pod", makepod_serial),
+        ("makepod --bulk", makepod_bulk),
+        (
+            "makepod --async",
+            lambda run, pod_count: makepod_async(run, pod_count, concurrency),
+        ),
+        ("makelab.make_pod", lambda run, pod_count: makelab_pods(run, pod_count, bulk=False)),
+        ("makelab --bulk", lambda run, pod_count: makelab_pods(run, pod_count, bulk=True)),
+        ("makelab.make_tier1", makelab_tier1),
+        ("makelab.main", makelab_main),
+        (
+            "makelab.main --bulk -w {}".format(workers),
+            lambda run, pod_count: makelab_main(run, pod_count, "--bulk", "-w", str(workers)),
+        ),
+        (
+            "makelab --async",
+            lambda run, pod_count: provision_async(
+                run, makelab.lab_graph(pod_count), concurrency
+            ),
+        ),
+    ]
+
+
+def measure(scenario, pod_count, latency, trace=False):
+    run = Run(latency)
+    if trace:
+        tracemalloc.start()
+    try:
+        # The scripts report their progress on stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            run.begin()
+            scenario(run, pod_count)
+        result = {
+            "requests": run.requests() / pod_count,
+            "wall": time.perf_counter() - run.wall,
+            "cpu": (time.process_time() - run.cpu) / pod_count * 1e3,
+        }
+        if trace:
+            result["peak"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        if trace:
+            tracemalloc.stop()
+    return result
+
+
+def main():
+    args = vars(parse_cli_args(sys.argv[1:]))
+    latency = args['latency'] / 1e3
+    print("{:<26} {:>5} {:>10} {:>9} {:>12} {:>9}".format(
+        "scenario", "pods", "req/pod", "wall s", "CPU ms/pod", "peak MiB"
+    ))
+    for name, scenario in scenarios(args['workers'], args['concurrency']):
+        for pod_count in args['pod_count']:
+            result = measure(scenario, pod_count, latency)
+            # Memory is traced in a run of its own, tracing slows Python down
+            result["peak"] = measure(scenario, pod_count, 0.0, trace=True)["peak"]
+            print("{:<26} {:>5} {requests:>10.1f} {wall:>9.2f} {cpu:>12.2f} {peak:>9.2f}".format(
+                name, pod_count, **result
+            ))
+
+
+if __name__ == '__main__':
+    main()
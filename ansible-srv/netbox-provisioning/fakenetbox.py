@@ -0,0 +1,448 @@
+import asyncio
+import collections
+import copy
+import itertools
+import json
+import threading
+import time
+
+from instrument import endpoint_name, record_id
+from podgraph import CHOICES
+from transport import BULK_WRITES_VERSION, api_version
+
+
+# Foreign keys per endpoint: field -> endpoint of the referenced objects
+FOREIGN_KEYS = {
+    "dcim.sites": {"tenant": "tenancy.tenants"},
+    "dcim.racks": {"site": "dcim.sites", "tenant": "tenancy.tenants"},
+    "dcim.device_types": {"manufacturer": "dcim.manufacturers"},
+    "dcim.devices": {
+        "device_role": "dcim.device_roles",
+        "device_type": "dcim.device_types",
+        "tenant": "tenancy.tenants",
+        "site": "dcim.sites",
+        "rack": "dcim.racks",
+        "primary_ip4": "ipam.ip_addresses",
+        "primary_ip6": "ipam.ip_addresses",
+    },
+    "dcim.interfaces": {"device": "dcim.devices"},
+    "ipam.ip_addresses": {
+        "interface": "dcim.interfaces",
+        "tenant": "tenancy.tenants",
+    },
+    "ipam.prefixes": {
+        "site": "dcim.sites",
+        "tenant": "tenancy.tenants",
+    },
+    "circuits.circuits": {
+        "provider": "circuits.providers",
+        "type": "circuits.circuit_types",
+        "tenant": "tenancy.tenants",
+    },
+    "circuits.circuit_terminations": {
+        "circuit": "circuits.circuits",
+        "site": "dcim.sites",
+    },
+}
+
+# Fields NetBox keeps unique per endpoint
+UNIQUE_KEYS = {
+    "tenancy.tenants": [("slug",)],
+    "dcim.sites": [("slug",)],
+    "dcim.racks": [("site", "name")],
+    "dcim.device_roles": [("slug",)],
+    "dcim.manufacturers": [("slug",)],
+    "dcim.device_types": [("manufacturer", "slug")],
+    "dcim.devices": [("site", "tenant", "name")],
+    "dcim.interfaces": [("device", "name")],
+    "circuits.providers": [("slug",)],
+    "circuits.circuit_types": [("slug",)],
+    "circuits.circuits": [("provider", "cid")],
+}
+
+TERMINATION_ENDPOINTS = {
+    "dcim.interface": "dcim.interfaces",
+    "circuits.circuittermination": "circuits.circuit_terminations",
+}
+
+
+class FakeRequestError(Exception):
+    pass
+
+
+def connected_endpoint(interface):
+    # Type and record at the other end of the cable plugged into an interface
+    cables = interface.endpoint.api.endpoint("dcim.cables")
+    for cable in list(cables.records.values()):
+        values = cable.values
+        for near, far in (("a", "b"), ("b", "a")):
+            if (values["termination_{}_type".format(near)] == "dcim.interface"
+                    and values["termination_{}_id".format(near)] == interface.id):
+                far_type = values["termination_{}_type".format(far)]
+                far_endpoint = interface.endpoint.api.endpoint(TERMINATION_ENDPOINTS[far_type])
+                return far_type, far_endpoint.records.get(values["termination_{}_id".format(far)])
+    return None, None
+
+
+# Read-only fields computed by NetBox
+COMPUTED = {
+    "dcim.interfaces": {
+        "connected_endpoint_type": lambda interface: connected_endpoint(interface)[0],
+        "connected_endpoint": lambda interface: connected_endpoint(interface)[1],
+    },
+}
+
+
+class FakeChoice(object):
+    """A choice field as NetBox returns it, the slug value and its label"""
+
+    def __init__(self, value):
+        self.value = value
+        self.label = value
+
+    def serialize(self):
+        return {"value": self.value, "label": self.label}
+
+
+class FakeRecord(object):
+    """A NetBox object, foreign keys are resolved to records on access"""
+
+    def __init__(self, endpoint, values):
+        self.__dict__["endpoint"] = endpoint
+        self.__dict__["values"] = values
+
+    def __getattr__(self, name):
+        computed = COMPUTED.get(self.endpoint.name, {})
+        if name in computed:
+            return computed[name](self)
+        foreign_key = FOREIGN_KEYS.get(self.endpoint.name, {}).get(name)
+        if name not in self.values:
+            if foreign_key:
+                return None
+            if name == "tags":
+                return []
+            raise AttributeError(name)
+        if foreign_key and self.values[name] is not None:
+            return self.endpoint.api.endpoint(foreign_key).records.get(self.values[name])
+        if name in CHOICES.get(self.endpoint.name, {}) and self.values[name] is not None:
+            return FakeChoice(self.values[name])
+        return self.values[name]
+
+    def __setattr__(self, name, value):
+        self.values.update(self.endpoint.clean({name: value}))
+
+    def __repr__(self):
+        return str(self.values.get("name", self.values["id"]))
+
+    def serialize(self):
+        values = dict(self.values)
+        for name in CHOICES.get(self.endpoint.name, {}):
+            if values.get(name) is not None:
+                values[name] = FakeChoice(values[name]).serialize()
+        return values
+
+    def save(self):
+        self.endpoint.api.request(self.endpoint.name, "PATCH", self.serialize())
+        return True
+
+    def delete(self):
+        self.endpoint.api.request(self.endpoint.name, "DELETE")
+        return self.endpoint.delete_all([self.id])
+
+
+class FakeEndpoint(object):
+    """The pynetbox endpoint calls used by the scripts, on an in-memory store"""
+
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+        self.records = {}
+        # Unique fields -> values -> record ID
+        self.unique = {fields: {} for fields in UNIQUE_KEYS.get(name, [])}
+
+    def clean(self, values):
+        # Records are sent as their ID, lists are copied and legacy numeric
+        # choices stored as their slug, as NetBox would
+        choices = CHOICES.get(self.name, {})
+        values = {
+            field: copy.deepcopy(getattr(value, "value", getattr(value, "id", value)))
+            for field, value in values.items()
+        }
+        for field, legacy in choices.items():
+            if field in values:
+                values[field] = legacy.get(values[field], values[field])
+        return values
+
+    def index(self, values, record_id=None):
+        # Add the unique values of a record, or remove them without an ID
+        for fields, ids in self.unique.items():
+            key = tuple(values.get(field) for field in fields)
+            if None in key:
+                continue
+            if record_id is None:
+                ids.pop(key, None)
+            elif ids.setdefault(key, record_id) != record_id:
+                raise FakeRequestError("{}: {} must be unique".format(self.name, fields))
+
+    def create_one(self, values):
+        values = self.clean(values)
+        values["id"] = next(self.api.ids)
+        self.index(values, values["id"])
+        record = FakeRecord(self, values)
+        self.records[values["id"]] = record
+        return record
+
+    def create(self, *args, **kwargs):
+        self.api.request(self.name, "POST", args[0] if args else kwargs)
+        return self.create_all(args[0] if args else kwargs)
+
+    def create_all(self, payload):
+        with self.api.lock:
+            if isinstance(payload, list):
+                return [self.create_one(values) for values in payload]
+            return self.create_one(payload)
+
+    def get(self, *args, **kwargs):
+        self.api.request(self.name, "GET")
+        if args:
+            return self.records.get(args[0])
+        found = self.match(kwargs)
+        if len(found) > 1:
+            raise ValueError("get() returned more than one result")
+        return found[0] if found else None
+
+    def filter(self, *args, **kwargs):
+        self.api.request(self.name, "GET")
+        return self.match(kwargs)
+
+    def all(self):
+        self.api.request(self.name, "GET")
+        return list(self.records.values())
+
+    def count(self, **kwargs):
+        self.api.request(self.name, "GET")
+        return len(self.match(kwargs))
+
+    def check_bulk(self, method):
+        # NetBox before 2.10 has no PATCH nor DELETE on the list endpoints
+        if api_version(self.api) < BULK_WRITES_VERSION:
+            raise FakeRequestError("{}: bulk {} needs NetBox 2.10, this is {}".format(
+                self.name, method, self.api.version
+            ))
+
+    def update(self, objects):
+        self.api.request(self.name, "PATCH", objects)
+        self.check_bulk("PATCH")
+        return self.update_all(objects)
+
+    def update_all(self, objects):
+        updated = []
+        with self.api.lock:
+            for values in objects:
+                values = self.clean(values)
+                record = self.records[values["id"]]
+                self.index(record.values)
+                record.values.update(values)
+                self.index(record.values, record.id)
+                updated.append(record)
+        return updated
+
+    def delete(self, objects):
+        self.api.request(self.name, "DELETE", [getattr(obj, "id", obj) for obj in objects])
+        self.check_bulk("DELETE")
+        return self.delete_all(objects)
+
+    def delete_all(self, objects):
+        with self.api.lock:
+            for obj in objects:
+                record = self.records.pop(getattr(obj, "id", obj), None)
+                if record is not None:
+                    self.index(record.values)
+        return True
+
+    def matches(self, record, field, wanted):
+        values = record.values
+        foreign_keys = FOREIGN_KEYS.get(self.name, {})
+        if field == "device_id" and self.name == "dcim.cables":
+            interfaces = self.api.endpoint("dcim.interfaces").records
+            ends = [
+                interfaces.get(values["termination_{}_id".format(side)])
+                for side in ("a", "b")
+                if values["termination_{}_type".format(side)] == "dcim.interface"
+            ]
+            return any(end is not None and end.values["device"] in wanted for end in ends)
+        if field == "device_id" and self.name == "ipam.ip_addresses":
+            interface = record.interface
+            return interface is not None and interface.values["device"] in wanted
+        if field == "role" and self.name == "dcim.devices":
+            return record.device_role.values["slug"] in wanted
+        if field.endswith("_id") and field[:-len("_id")] in foreign_keys:
+            return values.get(field[:-len("_id")]) in wanted
+        if field in foreign_keys:
+            # Filtering on a related object by slug or name
+            target = getattr(record, field)
+            return target is not None and (
+                target.values.get("slug") in wanted or target.values.get("name") in wanted
+            )
+        if field == "time_after":
+            # Changelog entries, ISO times in UTC compare as strings
+            return values["time"] >= min(wanted)
+        if field == "tag":
+            return any(tag in (values.get("tags") or []) for tag in wanted)
+        return values.get(field) in wanted or str(values.get(field)) in wanted
+
+    def match(self, filters):
+        filters = {
+            field: wanted if isinstance(wanted, list) else [wanted]
+            for field, wanted in filters.items()
+        }
+        with self.api.lock:
+            records = list(self.records.values())
+        return [
+            record for record in records
+            if all(self.matches(record, field, wanted) for field, wanted in filters.items())
+        ]
+
+    def serve(self, method, payload, params, record_id=None):
+        # JSON answer of the REST API, for the async engine
+        if method == "PATCH" and record_id is not None:
+            return self.update_all([dict(payload, id=record_id)])[0].serialize()
+        if method == "GET":
+            filters = collections.defaultdict(list)
+            for field, value in params or []:
+                filters[field].append(str(value))
+            limit = int(filters.pop("limit", [0])[0]) or len(self.records)
+            offset = int(filters.pop("offset", [0])[0])
+            found = self.match(filters)
+            return {
+                "count": len(found),
+                "results": [record.serialize() for record in found[offset:offset + limit]],
+            }
+        if method == "POST":
+            created = self.create_all(payload)
+            if isinstance(created, list):
+                return [record.serialize() for record in created]
+            return created.serialize()
+        if method == "PATCH":
+            self.check_bulk(method)
+            return [record.serialize() for record in self.update_all(payload)]
+        if method == "DELETE":
+            self.check_bulk(method)
+            self.delete_all(payload)
+            return None
+        raise FakeRequestError("{}: {} not supported".format(self.name, method))
+
+
+class FakeSession(object):
+    """Stands for the HTTP session of pynetbox.api, a request is a delay"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def request(self, method, url, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeAsyncResponse(object):
+    """One call of FakeAsyncSession, an aiohttp-like response context"""
+
+    def __init__(self, api, method, url, payload, params):
+        self.api = api
+        self.method = method
+        self.url = url
+        self.payload = payload
+        self.params = params
+        self.status = None
+        self.headers = {"API-Version": api.version}
+        self.body = b""
+
+    async def __aenter__(self):
+        name = endpoint_name(self.url)
+        self.api.count_request(name, self.method)
+        if self.api.http_session.latency:
+            await asyncio.sleep(self.api.http_session.latency)
+        try:
+            if not name:
+                # The API root
+                result = {}
+            else:
+                result = self.api.endpoint(name).serve(
+                    self.method, self.payload, self.params, record_id(self.url)
+                )
+        except FakeRequestError as exc:
+            self.status = 400
+            result = {"detail": str(exc)}
+        else:
+            self.status = 201 if self.method == "POST" else 200
+        if result is not None:
+            self.body = json.dumps(result).encode()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.body
+
+
+class FakeAsyncSession(object):
+    """Stands for the aiohttp session of async_engine.AsyncNetBox"""
+
+    def __init__(self, api):
+        self.api = api
+
+    def request(self, method, url, json=None, params=None):
+        return FakeAsyncResponse(self.api, method, url, json, params)
+
+
+class FakeApp(object):
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+
+    def __getattr__(self, name):
+        return self.api.endpoint("{}.{}".format(self.name, name))
+
+
+class FakeNetBox(object):
+    """In-process stand-in for pynetbox.api, for benchmarks and dry runs
+
+    Only what the provisioning and inventory scripts use is implemented:
+    single and list creates, record and bulk updates and deletes, the
+    latter refused below version 2.10 like NetBox, and the filters they
+    send. Every call counts as one request, (endpoint, method) -> count,
+    and waits for latency seconds like a round trip to NetBox.
+    FakeAsyncSession serves the same store to the async engine.
+    """
+
+    def __init__(self, latency=0.0, version="2.10"):
+        self.http_session = FakeSession(latency)
+        # API-Version of NetBox, bulk PATCH and DELETE from 2.10
+        self.version = version
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.endpoints = {}
+        self.requests = collections.Counter()
+        for app in ("tenancy", "dcim", "ipam", "circuits", "extras"):
+            setattr(self, app, FakeApp(self, app))
+
+    def endpoint(self, name):
+        with self.lock:
+            if name not in self.endpoints:
+                self.endpoints[name] = FakeEndpoint(self, name)
+            return self.endpoints[name]
+
+    def count_request(self, endpoint, method):
+        with self.lock:
+            self.requests[(endpoint, method)] += 1
+
+    def request(self, endpoint, method, payload=None):
+        self.count_request(endpoint, method)
+        # Outside of the lock, concurrent requests wait together
+        self.http_session.request(
+            method, "http://netbox.fake/api/{}/".format(endpoint.replace(".", "/")), json=payload
+        )
+
+    def counts(self):
+        return {name: len(endpoint.records) for name, endpoint in self.endpoints.items()}
@@ -0,0 +1,132 @@
+import collections
+import json
+import math
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def endpoint_name(url):
+    # "https://netbox/api/dcim/devices/12/" -> "dcim.devices"
+    path = urlsplit(url).path.split("/api/", 1)[-1]
+    return ".".join(path.strip("/").split("/")[:2])
+
+
+def record_id(url):
+    # "https://netbox/api/dcim/devices/12/" -> 12, None for a list
+    path = urlsplit(url).path.split("/api/", 1)[-1]
+    parts = path.strip("/").split("/")
+    return int(parts[2]) if len(parts) > 2 else None
+
+
+def payload_size(response, kwargs):
+    request = getattr(response, "request", None)
+    body = getattr(request, "body", None)
+    if body is None and kwargs.get("json") is not None:
+        body = json.dumps(kwargs["json"], default=str)
+    return len(body) if body else 0
+
+
+def percentile(values, percent):
+    # Nearest rank on sorted values
+    return values[max(math.ceil(percent / 100.0 * len(values)), 1) - 1]
+
+
+class Recorder(object):
+    """Endpoint, method, latency and payload size of every NetBox request
+
+    attach() wraps the HTTP session of a pynetbox.api object, so the calls
+    of the endpoints, the record saves and the pagination of the list calls
+    are all seen, from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.calls = []
+
+    def attach(self, api_connector):
+        session = api_connector.http_session
+        send = session.request
+
+        def request(method, url, *args, **kwargs):
+            start = time.perf_counter()
+            response = None
+            try:
+                response = send(method, url, *args, **kwargs)
+                return response
+            finally:
+                self.record(start, method, url, response, kwargs)
+
+        session.request = request
+        return api_connector
+
+    def record(self, start, method, url, response, kwargs):
+        call = {
+            "endpoint": endpoint_name(url),
+            "method": method.upper(),
+            "url": url,
+            "start": start - self.started,
+            "latency": time.perf_counter() - start,
+            "status": getattr(response, "status_code", None),
+            "request_bytes": payload_size(response, kwargs),
+            "response_bytes": len(getattr(response, "content", None) or b""),
+            "thread": threading.get_ident(),
+        }
+        with self.lock:
+            self.calls.append(call)
+
+    def summary(self, slowest=10):
+        """Calls and latency per endpoint and method, the slowest calls"""
+        groups = collections.defaultdict(list)
+        for call in self.calls:
+            groups[(call["endpoint"], call["method"])].append(call)
+        endpoints = collections.OrderedDict()
+        for (endpoint, method), calls in sorted(groups.items()):
+            latencies = sorted(call["latency"] for call in calls)
+            endpoints.setdefault(endpoint, collections.OrderedDict())[method] = {
+                "calls": len(calls),
+                "total": sum(latencies),
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1],
+                "request_bytes": sum(call["request_bytes"] for call in calls),
+                "response_bytes": sum(call["response_bytes"] for call in calls),
+            }
+        return {
+            "calls": len(self.calls),
+            "wall": time.perf_counter() - self.started,
+            "endpoints": endpoints,
+            "slowest": sorted(self.calls, key=lambda call: call["latency"], reverse=True)[:slowest],
+        }
+
+    def trace(self):
+        # Chrome trace-event format, for chrome://tracing or Perfetto
+        return {
+            "traceEvents": [
+                {
+                    "name": "{} {}".format(call["method"], call["endpoint"]),
+                    "cat": call["endpoint"],
+                    "ph": "X",
+                    "ts": call["start"] * 1e6,
+                    "dur": call["latency"] * 1e6,
+                    "pid": 1,
+                    "tid": call["thread"],
+                    "args": {
+                        "url": call["url"],
+                        "status": call["status"],
+                        "request_bytes": call["request_bytes"],
+                        "response_bytes": call["response_bytes"],
+                    },
+                }
+                for call in self.calls
+            ],
+        }
+
+    def write(self, metrics_path=None, trace_path=None):
+        if metrics_path:
+            with open(metrics_path, "w") as metrics_file:
+                json.dump(self.summary(), metrics_file, indent=2)
+        if trace_path:
+            with open(trace_path, "w") as trace_file:
+                json.dump(self.trace(), trace_file)
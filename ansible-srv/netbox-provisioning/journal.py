@@ -0,0 +1,73 @@
+import collections
+import json
+import os
+import threading
+
+
+# Stands for a record created by an earlier run, only its ID is known
+Ref = collections.namedtuple("Ref", ["id"])
+
+
+class Journal(object):
+    """Append-only JSON lines of the objects created, by natural key
+
+    Each line is {"kind", "key", "id"} once NetBox created the object, or
+    {"kind", "key", "deferred": true} once its deferred references are
+    set. Lines are written and synced per bulk call, so a run killed at
+    any point leaves every object it created in the journal. Opened with
+    resume, the lines of the earlier runs are replayed first: their
+    objects are not created again.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.created = collections.defaultdict(dict)
+        self.linked = collections.defaultdict(set)
+        if resume and os.path.exists(path):
+            self.replay()
+        # A new run never appends to the journal of another one
+        self.file = open(path, "a" if resume else "x")
+
+    def replay(self):
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line cut short by a crash, its call is sent again
+                    continue
+                if entry.get("deferred"):
+                    self.linked[entry["kind"]].add(entry["key"])
+                else:
+                    self.created[entry["kind"]][entry["key"]] = entry["id"]
+
+    def write(self, entries):
+        lines = "".join(json.dumps(entry, sort_keys=True) + "\n" for entry in entries)
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def create(self, kind, created):
+        """Objects of one bulk create, (key, NetBox ID) pairs"""
+        created = list(created)
+        with self.lock:
+            self.created[kind].update(created)
+        self.write({"kind": kind, "key": key, "id": object_id} for key, object_id in created)
+
+    def link(self, kind, keys):
+        """Objects whose deferred references were set by one bulk update"""
+        keys = list(keys)
+        with self.lock:
+            self.linked[kind].update(keys)
+        self.write({"kind": kind, "key": key, "deferred": True} for key in keys)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
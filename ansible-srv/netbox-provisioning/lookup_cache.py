@@ -0,0 +1,71 @@
+import threading
+
+
+def get_endpoint(api_connector, endpoint):
+    """Resolve an "app.endpoint" path such as "dcim.device_roles" """
+    app, name = endpoint.split(".")
+    return getattr(getattr(api_connector, app), name)
+
+
+class LookupCache(object):
+    """Process-wide get-or-create cache keyed by (endpoint, natural key)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.objects = {}
+        self.hits = 0
+        self.misses = 0
+        self.preloads = 0
+
+    def preload(self, api_connector, endpoint, field, values):
+        # One filtered list call for every value, missing ones are remembered
+        # so the next lookup goes straight to create
+        values = [v for v in set(values) if (endpoint, field, v) not in self.objects]
+        if not values:
+            return
+        records = get_endpoint(api_connector, endpoint).filter(**{field: values})
+        with self.lock:
+            self.preloads += 1
+            for value in values:
+                self.objects.setdefault((endpoint, field, value), None)
+            for record in records:
+                self.objects[(endpoint, field, getattr(record, field))] = record
+
+    def get_or_create(self, api_connector, endpoint, field, value, **create_args):
+        key = (endpoint, field, value)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # Only one thread resolves a given key, the others wait for its result
+        with key_lock:
+            with self.lock:
+                record = self.objects.get(key)
+                if record is not None:
+                    self.hits += 1
+                    return record
+                self.misses += 1
+                known_missing = key in self.objects
+
+            api_endpoint = get_endpoint(api_connector, endpoint)
+            if not known_missing:
+                record = api_endpoint.get(**{field: value})
+            if record is None:
+                record = api_endpoint.create(**create_args)
+
+            with self.lock:
+                self.objects[key] = record
+            return record
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "preloads": self.preloads,
+        }
+
+    def report(self):
+        return (
+            "lookup cache: {hits} hits, {misses} misses, {preloads} preload "
+            "calls, round trips saved: {hits}".format(**self.stats())
+        )
@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 import sys
-import pynetbox
 import json
 import argparse
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from allocator import AllocationError, Allocator, address
+from async_engine import CONCURRENCY, AsyncRequestError, run_graph
+from instrument import Recorder
+from journal import Journal, Ref
+from lookup_cache import LookupCache
+from podgraph import Graph, KINDS, node_key
+from reconcile import apply, update_records
+from transport import RETRIES, TIMEOUT, bulk_writes, connect
+
+# Get-or-create lookups shared by every pod of the run
+CACHE = LookupCache()
 
 class LAB_SPEC:
     TENANT = "tier1-operator"
     RTR_NAMING = "tier1-rtr{rtr_id}"
-    LOOPBACK = "10.0.1.{rtr_id}/32"
+    # Block of the pod pools holding the tier1 addresses, pod IDs start at 1
+    POOL_BLOCK = 0
     DEVICE_TYPES = [
         {
             "model": "MX10k",
@@ -36,7 +51,13 @@ class POD_SPECS:
         }
     ]
     RTR_NAMING = "pod{pod_id:02d}-rtr{rtr_id}"
-    LOOPBACK = "10.{pod_id}.1.{rtr_id}/32"
+    # Parent pools and the prefix length of the block each pod takes in
+    # them, at the index of its ID
+    POOLS = {
+        "loopback": ("10.200.0.0/16", 28),
+        "interco": ("10.0.0.0/12", 27),
+        "uplink": ("10.99.0.0/16", 28),
+    }
     SITE = "site-pod{pod_id:02d}"
     DEVICE_ROLE = "lab-pod"
     MODEL = {
@@ -52,6 +73,10 @@ class POD_SPECS:
                     {
                         "name": "ge-0/0/1",
                         "id": 2
+                    },
+                    {
+                        "name": "ge-0/0/2",
+                        "id": 9
                     }
                 ]
             },
@@ -99,48 +124,157 @@ class POD_SPECS:
             },
         ],
         "connections": [
-            {"a": 1, "z": 3, "subnet": "10.{pod_id}.0.0/31"},
-            {"a": 4, "z": 6, "subnet": "10.{pod_id}.0.2/31"},
-            {"a": 5, "z": 7, "subnet": "10.{pod_id}.0.4/31"},
-            {"a": 8, "z": 2, "subnet": "10.{pod_id}.0.6/31"}
-        ]
+            {"a": 1, "z": 3},
+            {"a": 4, "z": 6},
+            {"a": 5, "z": 7},
+            {"a": 8, "z": 2}
+        ],
+        # Interface wired to the tier1 interface of the pod
+        "uplink": 9
     }
 
 def parse_cli_args(script_args):
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '--netbox-url', required=True, action='store',
+        '--netbox-url', action='store',
     )
     parser.add_argument(
-        '--netbox-token', required=True, action='store',
+        '--netbox-token', action='store',
     )
     parser.add_argument(
         '-c', '--pod-count', type=int, required=True, action='store',
     )
+    parser.add_argument(
+        '-w', '--workers', type=int, default=1, action='store',
+        help="Number of pods provisioned at the same time"
+    )
+    parser.add_argument(
+        '--bulk', action='store_true',
+        help="Create each object kind of a pod with a single list POST"
+    )
+    parser.add_argument(
+        '--plan', action='store', metavar='FILE',
+        help="Write the object graph of the lab as JSON, without NetBox"
+    )
+    parser.add_argument(
+        '--async', action='store_true',
+        help="Create the whole lab graph with asyncio, needs aiohttp"
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=CONCURRENCY, action='store',
+        help="Requests in flight at most with --async"
+    )
+    parser.add_argument(
+        '--journal', action='store', metavar='FILE',
+        help="Append every created object to FILE as JSON lines, with --bulk or --async"
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help="Skip the objects already in the journal of a failed run"
+    )
+    parser.add_argument(
+        '--retries', type=int, default=RETRIES, action='store',
+        help="Attempts on connection errors, 429 and 5xx (idempotent requests only)"
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=TIMEOUT, action='store',
+        help="Seconds to wait for NetBox on each request"
+    )
+    parser.add_argument(
+        '--metrics', action='store', metavar='FILE',
+        help="Write the NetBox calls per endpoint, latencies and slowest calls as JSON"
+    )
+    parser.add_argument(
+        '--trace', action='store', metavar='FILE',
+        help="Write the NetBox calls as a Chrome trace-event file"
+    )
 
     # Parse script arguments and return the result
-    return parser.parse_args(script_args)
+    args = parser.parse_args(script_args)
+    if not args.plan and not (args.netbox_url and args.netbox_token):
+        parser.error("--netbox-url and --netbox-token are required")
+    # The serial steps hold records, not the natural keys of the journal
+    if args.journal and not (args.bulk or getattr(args, 'async')):
+        parser.error("--journal needs --bulk or --async")
+    if args.resume and not args.journal:
+        parser.error("--resume needs --journal")
+    return args
+
+
+def pod_addresses(pod_id, rtrs, connections, allocator=None):
+    """Loopbacks of the routers and networks of the connections"""
+    if allocator is None:
+        allocator = Allocator(POD_SPECS.POOLS)
+    return {
+        "loopbacks": {
+            rtr['id']: str(allocator.host("loopback", pod_id, rtr['id'])) for rtr in rtrs
+        },
+        "connections": allocator.links("interco", pod_id, len(connections)) if connections else [],
+    }
+
+
+def uplink_interface(pod_id):
+    # Node key of the pod uplink interface, the pod may be in another graph
+    SPEC = POD_SPECS
+    for rtr in SPEC.MODEL["rtrs"]:
+        for intf in rtr["interfaces"]:
+            if intf["id"] == SPEC.MODEL["uplink"]:
+                site = node_key("dcim.sites", {"slug": SPEC.SITE.format(pod_id=pod_id)}, {})
+                device = node_key(
+                    "dcim.devices",
+                    {"name": SPEC.RTR_NAMING.format(pod_id=pod_id, rtr_id=rtr['id'])},
+                    {"site": site},
+                )
+                return node_key("dcim.interfaces", {"name": intf["name"]}, {"device": device})
+    raise KeyError(SPEC.MODEL["uplink"])
+
+
+def uplink_network(pod_id, allocator=None):
+    """Network between the tier1 and the pod"""
+    if allocator is None:
+        allocator = Allocator(POD_SPECS.POOLS)
+    return allocator.links("uplink", pod_id, 1)[0]
+
+
+def preload_cache(api_connector, pod_count):
+    # Fetch the objects the get-or-create helpers will ask for, one list
+    # call per endpoint
+    specs = [LAB_SPEC, POD_SPECS]
+    CACHE.preload(
+        api_connector, "tenancy.tenants", "name",
+        [LAB_SPEC.TENANT] + [
+            POD_SPECS.TENANT.format(pod_id=pod_id + 1) for pod_id in range(0, pod_count)
+        ]
+    )
+    CACHE.preload(
+        api_connector, "dcim.device_roles", "name",
+        [spec.DEVICE_ROLE for spec in specs]
+    )
+    CACHE.preload(
+        api_connector, "dcim.manufacturers", "name",
+        [dt["manufacturer"] for spec in specs for dt in spec.DEVICE_TYPES]
+    )
+    CACHE.preload(
+        api_connector, "dcim.device_types", "slug",
+        [dt["model"] for spec in specs for dt in spec.DEVICE_TYPES]
+    )
 
 
 def setup_device_role(api_connector, spec, color):
-    device_role = api_connector.dcim.device_roles.get(name=spec.DEVICE_ROLE)
-    if device_role is None:
-        device_role = api_connector.dcim.device_roles.create(
-            name=spec.DEVICE_ROLE,
-            slug=spec.DEVICE_ROLE,
-            color=color,
-        )
-    return device_role
+    return CACHE.get_or_create(
+        api_connector, "dcim.device_roles", "name", spec.DEVICE_ROLE,
+        name=spec.DEVICE_ROLE,
+        slug=spec.DEVICE_ROLE,
+        color=color,
+    )
 
 
 def setup_tenant(api_connector, tenant_name):
-    tenant = api_connector.tenancy.tenants.get(name=tenant_name)
-    if tenant is None:
-        tenant = api_connector.tenancy.tenants.create(
-            name=tenant_name,
-            slug=tenant_name
-        )
-    return tenant
+    return CACHE.get_or_create(
+        api_connector, "tenancy.tenants", "name", tenant_name,
+        name=tenant_name,
+        slug=tenant_name
+    )
 
 def setup_site(api_connector, slug, tenant):
     return api_connector.dcim.sites.create(
@@ -157,37 +291,43 @@ def setup_rack(api_connector, pod_id, site):
 
 def setup_device_type(api_connector, spec, dt_id):
     mnf_name = spec.DEVICE_TYPES[dt_id]["manufacturer"]
-    manufacturer = api_connector.dcim.manufacturers.get(
+    manufacturer = CACHE.get_or_create(
+        api_connector, "dcim.manufacturers", "name", mnf_name,
         name=mnf_name,
+        slug=mnf_name.replace(' ', '_')
     )
-    if manufacturer is None:
-        manufacturer = api_connector.dcim.manufacturers.create(
-            name=mnf_name,
-            slug=mnf_name.replace(' ', '_')
-        )
 
     model = spec.DEVICE_TYPES[dt_id]["model"]
 
-    device_type = api_connector.dcim.device_types.get(
+    return CACHE.get_or_create(
+        api_connector, "dcim.device_types", "slug", model,
+        manufacturer=manufacturer.id,
+        model=model,
         slug=model
     )
-    if device_type is None:
-        device_type = api_connector.dcim.device_types.create(
-            manufacturer=manufacturer.id,
-            model=model,
-            slug=model
-        )
 
-    return device_type
+def setup_shared(api_connector, spec, color):
+    # Objects shared by every pod, set up once before the workers start so
+    # they do not race on the get-or-create helpers
+    return {
+        "device_role": setup_device_role(api_connector, spec=spec, color=color),
+        "device_types": [
+            setup_device_type(api_connector, spec=spec, dt_id=dt_id)
+            for dt_id in range(len(spec.DEVICE_TYPES))
+        ],
+    }
 
-def setup_device(api_connector, name, device_role, device_type, tenant, site):
-    return api_connector.dcim.devices.create(
-        name=name,
-        device_role=device_role.id,
-        device_type=device_type.id,
-        tenant=tenant.id,
-        site=site.id
-    )
+def setup_devices(api_connector, names, device_role, device_types, tenant, site):
+    return api_connector.dcim.devices.create([
+        {
+            "name": name,
+            "device_role": device_role.id,
+            "device_type": device_type.id,
+            "tenant": tenant.id,
+            "site": site.id,
+        }
+        for name, device_type in zip(names, device_types)
+    ])
 
 def setup_interface(api_connector, device, name):
     return api_connector.dcim.interfaces.create(
@@ -195,48 +335,76 @@ def setup_interface(api_connector, device, name):
         device=device.id
     )
 
-def setup_loopback(api_connector, device, address):
-    interface = api_connector.dcim.interfaces.create(
-        name="lo",
-        device=device.id,
-        type=0
-    )
-    ip = api_connector.ipam.ip_addresses.create(
-        address=address,
-        interface=interface.id
-    )
-    device.primary_ip4 = ip
-    device.save()
-
+def setup_interfaces(api_connector, device, names):
+    return api_connector.dcim.interfaces.create([
+        {
+            "name": name,
+            "device": device.id,
+        }
+        for name in names
+    ])
 
-def setup_connection(api_connector, a, z):
-    api_connector.dcim.cables.create(
-        termination_a_type="dcim.interface",
-        termination_a_id=a.id,
-        termination_b_type="dcim.interface",
-        termination_b_id=z.id
+def setup_loopbacks(api_connector, devices, addresses):
+    # One list POST for the interfaces, one for the IPs, one bulk PATCH for
+    # the primary IPs, device by device before NetBox 2.10
+    interfaces = api_connector.dcim.interfaces.create([
+        {
+            "name": "lo",
+            "device": device.id,
+            "type": 0,
+        }
+        for device in devices
+    ])
+    ips = api_connector.ipam.ip_addresses.create([
+        {
+            "address": ip,
+            "interface": interface.id,
+        }
+        for interface, ip in zip(interfaces, addresses)
+    ])
+    update_records(
+        api_connector.dcim.devices,
+        [{"id": device.id, "primary_ip4": ip.id} for device, ip in zip(devices, ips)],
+        {device.id: device for device in devices},
+        bulk_writes(api_connector)
     )
+    return devices
 
 
-def setup_ico_network(api_connector, a, z, subnet):
-    api_connector.ipam.prefixes.create(prefix=subnet)
-    spl = subnet.split('/')
-    mask = spl[1]
-    ip = spl[0].split(".")[:-1]
-    hosta = spl[0].split(".")[-1]
-    hostz = str(int(hosta) + 1)
-
-    ipa = api_connector.ipam.ip_addresses.create(
-        address="{}/{}".format('.'.join(ip + [hosta]), mask),
-        interface=a.id,
-    )
-    ipz = api_connector.ipam.ip_addresses.create(
-        address="{}/{}".format('.'.join(ip + [hostz]), mask),
-        interface=z.id,
-    )
+def setup_connections(api_connector, links):
+    # One list POST for the cables of every (a, z, network) link
+    if not links:
+        return []
+    return api_connector.dcim.cables.create([
+        {
+            "termination_a_type": "dcim.interface",
+            "termination_a_id": a.id,
+            "termination_b_type": "dcim.interface",
+            "termination_b_id": z.id,
+        }
+        for a, z, _ in links
+    ])
+
+
+def setup_ico_networks(api_connector, links):
+    # One list POST for the prefixes, one for the IPs: the first address
+    # of each network on a, the second on z
+    if not links:
+        return
+    api_connector.ipam.prefixes.create([
+        {"prefix": str(network)} for _, _, network in links
+    ])
+    api_connector.ipam.ip_addresses.create([
+        {
+            "address": address(network, i),
+            "interface": end.id,
+        }
+        for a, z, network in links
+        for i, end in enumerate((a, z))
+    ])
 
 
-def make_pod(pod_id, api_connector):
+def make_pod(pod_id, api_connector, shared=None):
     # Setup regular routeurs
     model = POD_SPECS.MODEL
     SPEC = POD_SPECS
@@ -244,30 +412,32 @@ def make_pod(pod_id, api_connector):
         "devices": {},
         "interfaces": {}
     }
+    if shared is None:
+        shared = setup_shared(api_connector, spec=SPEC, color="f44336")
+    addresses = pod_addresses(pod_id, model["rtrs"], model["connections"])
     tenant = setup_tenant(api_connector, tenant_name=SPEC.TENANT.format(pod_id=pod_id))
-    device_role = setup_device_role(api_connector, spec=SPEC, color="f44336")
+    device_role = shared["device_role"]
 
     # make_site
     site = setup_site(api_connector, slug=SPEC.SITE.format(pod_id=pod_id), tenant=tenant)
 
-    for rtr in model["rtrs"]:
-        assert rtr['id'] not in pod_refs["devices"]
-        device_type = setup_device_type(api_connector, spec=SPEC, dt_id=rtr["device_type"])
+    # make_devices
+    devices = setup_devices(
+        api_connector,
+        names=[SPEC.RTR_NAMING.format(pod_id=pod_id, rtr_id=rtr['id']) for rtr in model["rtrs"]],
+        device_role=device_role,
+        device_types=[shared["device_types"][rtr["device_type"]] for rtr in model["rtrs"]],
+        tenant=tenant,
+        site=site
+    )
+    devices = setup_loopbacks(
+        api_connector,
+        devices=devices,
+        addresses=[addresses["loopbacks"][rtr['id']] for rtr in model["rtrs"]]
+    )
 
-        # make_device
-        device = setup_device(
-            api_connector,
-            name=SPEC.RTR_NAMING.format(pod_id=pod_id, rtr_id=rtr['id']),
-            device_role=device_role,
-            device_type=device_type,
-            tenant=tenant,
-            site=site
-        )
-        setup_loopback(
-            api_connector,
-            device=device,
-            address=SPEC.LOOPBACK.format(pod_id=pod_id, rtr_id=rtr['id'])
-        )
+    for rtr, device in zip(model["rtrs"], devices):
+        assert rtr['id'] not in pod_refs["devices"]
         pod_refs["devices"][rtr['id']] = device
         for intf in rtr['interfaces']:
             # make_interface
@@ -275,16 +445,240 @@ def make_pod(pod_id, api_connector):
             interface = setup_interface(api_connector, device, intf["name"])
             pod_refs["interfaces"][intf['id']] = interface
 
-    for co in model["connections"]:
-        # make ip
-        # make connections
-        a = pod_refs["interfaces"][co["a"]]
-        z = pod_refs["interfaces"][co["z"]]
-        setup_ico_network(api_connector, a, z, co["subnet"].format(pod_id=pod_id))
-        setup_connection(api_connector, a, z)
+    # make ips and connections
+    links = [
+        (pod_refs["interfaces"][co["a"]], pod_refs["interfaces"][co["z"]], network)
+        for co, network in zip(model["connections"], addresses["connections"])
+    ]
+    setup_ico_networks(api_connector, links)
+    setup_connections(api_connector, links)
     return pod_refs
 
 
+def shared_graph(graph, spec, color):
+    device_role = graph.add(
+        "dcim.device_roles",
+        name=spec.DEVICE_ROLE,
+        slug=spec.DEVICE_ROLE,
+        color=color,
+    )
+    device_types = []
+    for dt in spec.DEVICE_TYPES:
+        manufacturer = graph.add(
+            "dcim.manufacturers",
+            name=dt["manufacturer"],
+            slug=dt["manufacturer"].replace(' ', '_'),
+        )
+        device_types.append(graph.add(
+            "dcim.device_types",
+            refs={"manufacturer": manufacturer},
+            model=dt["model"],
+            slug=dt["model"],
+        ))
+    return device_role, device_types
+
+
+def shared_ids(shared):
+    # Shared records provisioned beforehand, as known IDs for apply()
+    return {
+        "dcim.device_roles": {shared["device_role"].slug: shared["device_role"].id},
+        "dcim.device_types": {dt.slug: dt.id for dt in shared["device_types"]},
+    }
+
+
+def add_router(graph, name, device_role, device_type, tenant, site, loopback):
+    device = graph.add(
+        "dcim.devices",
+        refs={
+            "device_role": device_role,
+            "device_type": device_type,
+            "tenant": tenant,
+            "site": site,
+        },
+        deferred={"primary_ip4": loopback},
+        name=name,
+    )
+    interface = graph.add(
+        "dcim.interfaces",
+        refs={"device": device},
+        name="lo",
+        type=0,
+    )
+    graph.add(
+        "ipam.ip_addresses",
+        refs={"interface": interface},
+        address=loopback,
+    )
+    return device
+
+
+def pod_graph(pod_id, graph=None, shared=None, allocator=None):
+    # Desired state of a pod as an object graph. When the shared objects
+    # are given as records, they are referenced but left out of the graph.
+    model = POD_SPECS.MODEL
+    SPEC = POD_SPECS
+    if graph is None:
+        graph = Graph()
+    addresses = pod_addresses(pod_id, model["rtrs"], model["connections"], allocator)
+    if shared is None:
+        device_role, device_types = shared_graph(graph, spec=SPEC, color="f44336")
+    else:
+        device_role = shared["device_role"].slug
+        device_types = [dt.slug for dt in shared["device_types"]]
+
+    tenant = graph.add(
+        "tenancy.tenants",
+        name=SPEC.TENANT.format(pod_id=pod_id),
+        slug=SPEC.TENANT.format(pod_id=pod_id),
+    )
+    site = graph.add(
+        "dcim.sites",
+        refs={"tenant": tenant},
+        name=SPEC.SITE.format(pod_id=pod_id),
+        slug=SPEC.SITE.format(pod_id=pod_id),
+    )
+
+    interfaces = {}
+    for rtr in model["rtrs"]:
+        device = add_router(
+            graph,
+            name=SPEC.RTR_NAMING.format(pod_id=pod_id, rtr_id=rtr['id']),
+            device_role=device_role,
+            device_type=device_types[rtr["device_type"]],
+            tenant=tenant,
+            site=site,
+            loopback=addresses["loopbacks"][rtr['id']],
+        )
+        graph.aliases[("devices", pod_id, rtr['id'])] = device
+        for intf in rtr['interfaces']:
+            assert intf['id'] not in interfaces
+            interfaces[intf['id']] = graph.add(
+                "dcim.interfaces",
+                refs={"device": device},
+                name=intf["name"],
+            )
+            graph.aliases[("interfaces", pod_id, intf['id'])] = interfaces[intf['id']]
+
+    for co, net in zip(model["connections"], addresses["connections"]):
+        ends = [interfaces[co["a"]], interfaces[co["z"]]]
+        graph.add("ipam.prefixes", prefix=str(net))
+        for i in range(len(ends)):
+            graph.add(
+                "ipam.ip_addresses",
+                refs={"interface": ends[i]},
+                address=address(net, i),
+            )
+        graph.add(
+            "dcim.cables",
+            refs={
+                "termination_a_id": ends[0],
+                "termination_b_id": ends[1],
+            },
+            termination_a_type="dcim.interface",
+            termination_b_type="dcim.interface",
+        )
+    return graph
+
+
+def tier1_graph(pod_count, graph=None, allocator=None, pods=None, shared=None):
+    # Uplinks to the given pod indexes, all the pods by default. The shared
+    # objects are referenced when given as records, as in pod_graph.
+    model = LAB_SPEC.MODEL["tier1"]
+    SPEC = LAB_SPEC
+    if graph is None:
+        graph = Graph()
+    if allocator is None:
+        allocator = Allocator(POD_SPECS.POOLS)
+    addresses = pod_addresses(SPEC.POOL_BLOCK, model["devices"], [], allocator)
+    if shared is None:
+        device_role, device_types = shared_graph(graph, spec=SPEC, color="43f436")
+    else:
+        device_role = shared["device_role"].slug
+        device_types = [dt.slug for dt in shared["device_types"]]
+    tenant = graph.add("tenancy.tenants", name=SPEC.TENANT, slug=SPEC.TENANT)
+    site = graph.add(
+        "dcim.sites",
+        refs={"tenant": tenant},
+        name=SPEC.TIER1_SITE,
+        slug=SPEC.TIER1_SITE,
+    )
+    for rtr in model["devices"]:
+        device = add_router(
+            graph,
+            name=SPEC.RTR_NAMING.format(rtr_id=rtr["id"]),
+            device_role=device_role,
+            device_type=device_types[rtr["device_type"]],
+            tenant=tenant,
+            site=site,
+            loopback=addresses["loopbacks"][rtr['id']],
+        )
+        for i in range(0, pod_count):
+            interface = graph.add(
+                "dcim.interfaces",
+                refs={"device": device},
+                name="ge-0/0/{}".format(i),
+            )
+            if pods is not None and i not in pods:
+                continue
+            ends = [interface, uplink_interface(i + 1)]
+            net = uplink_network(i + 1, allocator)
+            graph.add("ipam.prefixes", prefix=str(net))
+            for j in range(len(ends)):
+                graph.add(
+                    "ipam.ip_addresses",
+                    refs={"interface": ends[j]},
+                    address=address(net, j),
+                )
+            graph.add(
+                "dcim.cables",
+                refs={
+                    "termination_a_id": ends[0],
+                    "termination_b_id": ends[1],
+                },
+                termination_a_type="dcim.interface",
+                termination_b_type="dcim.interface",
+            )
+    return graph
+
+
+def lab_graph(pod_count, allocator=None):
+    # Every pod and the tier1 in one graph, for --plan and --async
+    graph = Graph()
+    if allocator is None:
+        allocator = Allocator(POD_SPECS.POOLS)
+    for pod_id in range(0, pod_count):
+        pod_graph(pod_id + 1, graph, allocator=allocator)
+    tier1_graph(pod_count, graph, allocator)
+    return graph
+
+
+def make_pod_bulk(pod_id, api_connector, shared, journal=None, bulk_update=True):
+    # Same objects as make_pod, one list POST per object kind
+    graph = pod_graph(pod_id, shared=shared)
+    records = {kind: {} for kind in KINDS}
+    ids, _ = apply(
+        api_connector, graph, matched=records, known=shared_ids(shared), journal=journal,
+        bulk_update=bulk_update
+    )
+
+    def ref(kind, alias):
+        # Objects of the journal have no record, their ID is enough
+        key = graph.aliases[alias]
+        return records[kind].get(key) or Ref(ids[kind][key])
+
+    return {
+        "devices": {
+            rtr['id']: ref("dcim.devices", ("devices", pod_id, rtr['id']))
+            for rtr in POD_SPECS.MODEL["rtrs"]
+        },
+        "interfaces": {
+            intf['id']: ref("dcim.interfaces", ("interfaces", pod_id, intf['id']))
+            for rtr in POD_SPECS.MODEL["rtrs"]
+            for intf in rtr['interfaces']
+        },
+    }
+
+
 def make_tier1(api_connector, pod_count, refs):
     model = LAB_SPEC.MODEL["tier1"]
     SPEC = LAB_SPEC
@@ -293,59 +687,185 @@ def make_tier1(api_connector, pod_count, refs):
         "interfaces": {}
     }
 
+    shared = setup_shared(api_connector, spec=SPEC, color="43f436")
+    allocator = Allocator(POD_SPECS.POOLS)
+    addresses = pod_addresses(SPEC.POOL_BLOCK, model["devices"], [], allocator)
     tenant = setup_tenant(api_connector, tenant_name=SPEC.TENANT)
-    device_role = setup_device_role(api_connector, spec=SPEC, color="43f436")
+    device_role = shared["device_role"]
 
     # make_site
     site = setup_site(api_connector, slug=SPEC.TIER1_SITE, tenant=tenant)
 
-    for rtr in model["devices"]:
-        assert rtr['id'] not in pod_refs["devices"]
-        device_type = setup_device_type(api_connector, spec=SPEC, dt_id=rtr["device_type"])
+    # make_devices
+    devices = setup_devices(
+        api_connector,
+        names=[SPEC.RTR_NAMING.format(rtr_id=rtr["id"]) for rtr in model["devices"]],
+        device_role=device_role,
+        device_types=[shared["device_types"][rtr["device_type"]] for rtr in model["devices"]],
+        tenant=tenant,
+        site=site
+    )
+    devices = setup_loopbacks(
+        api_connector,
+        devices=devices,
+        addresses=[addresses["loopbacks"][rtr['id']] for rtr in model["devices"]]
+    )
 
-        # make_device
-        device = setup_device(
-            api_connector,
-            name=SPEC.RTR_NAMING.format(rtr_id=rtr["id"]),
-            device_role=device_role,
-            device_type=device_type,
-            tenant=tenant,
-            site=site
-        )
-        setup_loopback(
-            api_connector,
-            device=device,
-            address=SPEC.LOOPBACK.format(rtr_id=rtr["id"]),
-        )
+    links = []
+    for rtr, device in zip(model["devices"], devices):
+        assert rtr['id'] not in pod_refs["devices"]
         pod_refs["devices"][rtr['id']] = device
-        for i in range(0, pod_count):
-            # make_interface
+        # make_interfaces, one per pod
+        interfaces = setup_interfaces(
+            api_connector, device, ["ge-0/0/{}".format(i) for i in range(0, pod_count)]
+        )
+        for i, interface in enumerate(interfaces):
             assert i not in pod_refs['interfaces']
-            interface = setup_interface(api_connector, device, "ge-0/0/{}".format(i))
             pod_refs["interfaces"][i] = interface
+            # Pods that failed are left unwired
+            if i in refs:
+                links.append((
+                    interface,
+                    refs[i]["interfaces"][POD_SPECS.MODEL["uplink"]],
+                    uplink_network(i + 1, allocator),
+                ))
+
+    # make ips and connections of every uplink
+    setup_ico_networks(api_connector, links)
+    setup_connections(api_connector, links)
+    return pod_refs
+
+
+def make_tier1_bulk(api_connector, pod_count, refs, journal=None, bulk_update=True):
+    # Same objects as make_tier1, the pod uplink interfaces as known IDs
+    shared = setup_shared(api_connector, spec=LAB_SPEC, color="43f436")
+    known = shared_ids(shared)
+    known["dcim.interfaces"] = {
+        uplink_interface(i + 1): pod_refs["interfaces"][POD_SPECS.MODEL["uplink"]].id
+        for i, pod_refs in refs.items()
+    }
+    graph = tier1_graph(pod_count, pods=refs, shared=shared)
+    apply(api_connector, graph, known=known, journal=journal, bulk_update=bulk_update)
 
-    # for co in model["connections"]:
-    #     # make ip
-    #     # make connections
-    #     a = pod_refs["interfaces"][co["a"]]
-    #     z = pod_refs["interfaces"][co["z"]]
-    #     setup_ico_network(api_connector, a, z, co["subnet"].format(pod_id=pod_id))
-    #     setup_connection(api_connector, a, z)
-    #     return pod_refs
+
+def make_pods(api_connector, pod_count, workers=1, bulk=False, journal=None, bulk_update=True):
+    shared = setup_shared(api_connector, spec=POD_SPECS, color="f44336")
+    provision = make_pod
+    if bulk:
+        provision = functools.partial(make_pod_bulk, journal=journal, bulk_update=bulk_update)
+
+    pods_refs = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        started = time.monotonic()
+        futures = {
+            executor.submit(provision, pod_id + 1, api_connector, shared): pod_id
+            for pod_id in range(0, pod_count)
+        }
+        for future in as_completed(futures):
+            pod_id = futures[future]
+            # One failed pod must not stop the others
+            try:
+                pods_refs[pod_id] = future.result()
+            except Exception as exc:
+                failures[pod_id] = exc
+                print("pod{:02d}: failed: {}".format(pod_id + 1, exc), file=sys.stderr)
+            else:
+                print("pod{:02d}: done ({:.1f}s)".format(pod_id + 1, time.monotonic() - started))
+
+    return pods_refs, failures
 
 
 def main():
     args = vars(parse_cli_args(sys.argv[1:]))
-    api_connector = pynetbox.api(
-        url=args['netbox_url'],
-        token=args['netbox_token']
-    )
 
-    pods_refs = {}
-    for pod_id in range(0, args['pod_count']):
-        pods_refs[pod_id] = make_pod(pod_id + 1, api_connector)
+    if args['plan'] or args['async']:
+        try:
+            graph = lab_graph(args['pod_count'])
+        except AllocationError as exc:
+            sys.exit(str(exc))
+
+    if args['plan']:
+        # --bulk applies the graph of each pod in turn, then the tier1 one
+        parts = [pod_graph(pod_id + 1) for pod_id in range(0, args['pod_count'])]
+        parts.append(tier1_graph(args['pod_count']))
+        print(graph.summary(parts))
+        with open(args['plan'], 'w') as plan_file:
+            json.dump(graph.to_dict(parts), plan_file, indent=2)
+        errors = graph.validate()
+        if errors:
+            sys.exit("\n".join(errors))
+        return
+
+    journal = None
+    if args['journal']:
+        try:
+            journal = Journal(args['journal'], resume=args['resume'])
+        except FileExistsError:
+            sys.exit("{}: journal of another run, use --resume or remove it".format(
+                args['journal']
+            ))
+
+    recorder = Recorder()
+    if args['async']:
+        started = time.monotonic()
+        try:
+            _, report = run_graph(
+                graph,
+                args['netbox_url'],
+                args['netbox_token'],
+                concurrency=args['concurrency'],
+                retries=args['retries'],
+                timeout=args['timeout'],
+                recorder=recorder if args['metrics'] or args['trace'] else None,
+                journal=journal,
+            )
+        except AsyncRequestError as exc:
+            sys.exit(str(exc))
+        finally:
+            recorder.write(args['metrics'], args['trace'])
+            if journal is not None:
+                journal.close()
+        print("{} created, {} updated, {} requests ({:.1f}s)".format(
+            report["create"], report["update"], report["requests"], time.monotonic() - started
+        ))
+        return
+
+    api_connector = connect(
+        args['netbox_url'],
+        args['netbox_token'],
+        workers=args['workers'],
+        retries=args['retries'],
+        timeout=args['timeout'],
+    )
+    if args['metrics'] or args['trace']:
+        recorder.attach(api_connector)
+
+    try:
+        preload_cache(api_connector, args['pod_count'])
+        # Primary IPs in bulk PATCHes only where NetBox has them
+        bulk_update = args['bulk'] and bulk_writes(api_connector)
+        pods_refs, failures = make_pods(
+            api_connector, args['pod_count'], args['workers'], args['bulk'], journal,
+            bulk_update
+        )
 
-    make_tier1(api_connector, args['pod_count'], pods_refs)
+        if args['bulk']:
+            make_tier1_bulk(api_connector, args['pod_count'], pods_refs, journal, bulk_update)
+        else:
+            make_tier1(api_connector, args['pod_count'], pods_refs)
+        print(CACHE.report())
+    finally:
+        # Also when the run fails, to see what happened until then
+        recorder.write(args['metrics'], args['trace'])
+        if journal is not None:
+            journal.close()
+
+    if failures:
+        sys.exit("{} pod(s) failed: {}".format(
+            len(failures),
+            ", ".join("pod{:02d}".format(pod_id + 1) for pod_id in sorted(failures))
+        ))
 
 
 if __name__ == '__main__':
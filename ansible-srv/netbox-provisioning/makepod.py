@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 import sys
-import pynetbox
 import json
 import argparse
-import ipaddress
+
+from allocator import AllocationError, Allocator, address
+from async_engine import CONCURRENCY, AsyncRequestError, run_graph
+from instrument import Recorder
+from journal import Journal
+from podgraph import Graph
+from reconcile import KEEP_KINDS, apply, lookup_known, reconcile, update_records
+from transport import RETRIES, TIMEOUT, bulk_writes, connect
 
 
 class POD_SPECS:
@@ -30,8 +36,17 @@ class POD_SPECS:
             "asn": 33930,
         },
     ]
-    LOOPBACKv4 = "10.{pod_id}.200.{rtr_id}/32"
-    LOOPBACKv6 = "fd00:{pod_id}::{rtr_id}/128"
+    CIRCUIT_ID = "ID-{pod_id:02d}-{circuit_id}"
+    # Parent pools and the prefix length of the block each pod takes in
+    # them, at the index of its ID
+    POOLS = {
+        "loopbackv4": ("10.200.0.0/16", 28),
+        "loopbackv6": ("fd00:200::/48", 124),
+        "intercov4": ("10.0.0.0/12", 27),
+        "intercov6": ("fd00:1::/48", 64),
+        "uplinkv4": ("10.99.0.0/16", 28),
+        "uplinkv6": ("fdaa::/48", 64),
+    }
     SITE_NAME = "site-pod{pod_id:02d}"
     DEVICE_ROLE = "lab-pod"
     RACK = "rack-pod{pod_id:02d}"
@@ -135,51 +150,35 @@ class POD_SPECS:
         "connections": [
             {
                 "a": 1,
-                "z": 7,
-                "prefixv4": "10.{pod_id}.0.0/31",
-                "prefixv6": "fd00:{pod_id}:1::0/127"
+                "z": 7
             },
             {
                 "a": 2,
-                "z": 6,
-                "prefixv4": "10.{pod_id}.0.2/31",
-                "prefixv6": "fd00:{pod_id}:1::2/127"
+                "z": 6
             },
             {
                 "a": 5,
-                "z": 11,
-                "prefixv4": "10.{pod_id}.0.4/31",
-                "prefixv6": "fd00:{pod_id}:1::4/127"
+                "z": 11
             },
             {
                 "a": 8,
-                "z": 12,
-                "prefixv4": "10.{pod_id}.0.6/31",
-                "prefixv6": "fd00:{pod_id}:1::6/127"
+                "z": 12
             }
         ],
         "uplinks": [
             {
-                "prefixv4": "10.{pod_id}.99.0/31",
-                "prefixv6": "fdaa:{pod_id}::0/127",
                 "interface": 3,
                 "tags": ["tier-1", "Acorus"]
             },
             {
-                "prefixv4": "10.{pod_id}.99.2/31",
-                "prefixv6": "fdaa:{pod_id}::2/127",
                 "interface": 4,
                 "tags": ["tier-1", "Acorus"]
             },
             {
-                "prefixv4": "10.{pod_id}.99.4/31",
-                "prefixv6": "fdaa:{pod_id}::4/127",
                 "interface": 9,
                 "tags": ["tier-1", "Cloud Temple"]
             },
             {
-                "prefixv4": "10.{pod_id}.99.6/31",
-                "prefixv6": "fdaa:{pod_id}::6/127",
                 "interface": 10,
                 "tags": ["tier-1", "Cloud Temple"]
             }
@@ -190,23 +189,105 @@ class POD_SPECS:
 def parse_cli_args(script_args):
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '--netbox-url', required=True, action='store',
+        '--netbox-url', action='store',
+    )
+    parser.add_argument(
+        '--netbox-token', action='store',
+    )
+    parser.add_argument(
+        '--id', required=True, action='store', type=int, nargs='+'
+    )
+    parser.add_argument(
+        '--retries', type=int, default=RETRIES, action='store',
+        help="Attempts on connection errors, 429 and 5xx (idempotent requests only)"
     )
     parser.add_argument(
-        '--netbox-token', required=True, action='store',
+        '--timeout', type=float, default=TIMEOUT, action='store',
+        help="Seconds to wait for NetBox on each request"
+    )
+    parser.add_argument(
+        '--metrics', action='store', metavar='FILE',
+        help="Write the NetBox calls per endpoint, latencies and slowest calls as JSON"
+    )
+    parser.add_argument(
+        '--trace', action='store', metavar='FILE',
+        help="Write the NetBox calls as a Chrome trace-event file"
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--bulk', action='store_true',
+        help="Create each object kind with a single list POST"
+    )
+    mode.add_argument(
+        '--reconcile', action='store_true',
+        help="Only send the changes needed to match the model"
+    )
+    mode.add_argument(
+        '--plan', action='store', metavar='FILE',
+        help="Write the object graph of the pods as JSON, without NetBox"
+    )
+    mode.add_argument(
+        '--async', action='store_true',
+        help="Create every pod at once with asyncio, needs aiohttp"
     )
     parser.add_argument(
-        '--id', required=True, action='store', type=int
+        '--concurrency', type=int, default=CONCURRENCY, action='store',
+        help="Requests in flight at most with --async"
+    )
+    parser.add_argument(
+        '--journal', action='store', metavar='FILE',
+        help="Append every created object to FILE as JSON lines, with --bulk or --async"
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help="Skip the objects already in the journal of a failed run"
     )
 
-    return parser.parse_args(script_args)
+    args = parser.parse_args(script_args)
+    if not args.plan and not (args.netbox_url and args.netbox_token):
+        parser.error("--netbox-url and --netbox-token are required")
+    # The serial steps hold records, not the natural keys of the journal
+    if args.journal and not (args.bulk or getattr(args, 'async')):
+        parser.error("--journal needs --bulk or --async")
+    if args.resume and not args.journal:
+        parser.error("--resume needs --journal")
+    # The serial steps create the shared objects of every pod they set up
+    serial = not (args.plan or args.reconcile or args.bulk or getattr(args, 'async'))
+    if serial and len(args.id) > 1:
+        parser.error("several --id need --plan, --reconcile, --bulk or --async")
+    return args
 
 
+def pod_addresses(pod_id, allocator=None):
+    """Loopbacks and IPv4/IPv6 networks of the connections and uplinks"""
+    SPEC = POD_SPECS
+    model = SPEC.MODEL
+    if allocator is None:
+        allocator = Allocator(SPEC.POOLS)
+    return {
+        "loopbacks": {
+            dev['id']: [
+                str(allocator.host("loopbackv4", pod_id, dev['id'])),
+                str(allocator.host("loopbackv6", pod_id, dev['id'])),
+            ]
+            for dev in model["devices"]
+        },
+        "connections": list(zip(
+            allocator.links("intercov4", pod_id, len(model["connections"])),
+            allocator.links("intercov6", pod_id, len(model["connections"])),
+        )),
+        "uplinks": list(zip(
+            allocator.links("uplinkv4", pod_id, len(model["uplinks"])),
+            allocator.links("uplinkv6", pod_id, len(model["uplinks"])),
+        )),
+    }
+
 
 def make_pod(pod_id, api_connector):
     # Setup regular routeurs
     SPEC = POD_SPECS
     model = SPEC.MODEL
+    addresses = pod_addresses(pod_id)
     index = {
         "devices": {},
         "interfaces": {},
@@ -268,45 +349,53 @@ def make_pod(pod_id, api_connector):
             )
         )
 
+    # Devices and their loopbacks first, one list POST each, then the
+    # primary IPs in one bulk PATCH, device by device before NetBox 2.10
+    devices = api_connector.dcim.devices.create([
+        {
+            "name": "{}{}".format(index['device_types'][dev['device_type']].model, dev['id']),
+            "device_role": index['device_role'].id,
+            "device_type": index['device_types'][dev['device_type']].id,
+            "tenant": index['tenant'].id,
+            "rack": index['rack'].id,
+            "position": int(dev['id']) + 1,
+            "face": 0,
+            "site": index['site'].id,
+            "tags": dev['tags'],
+        }
+        for dev in model["devices"]
+    ])
+    loopbacks = api_connector.dcim.interfaces.create([
+        {
+            "name": dev["loopback"],
+            "device": device.id,
+            "type": 0,
+        }
+        for dev, device in zip(model["devices"], devices)
+    ])
+    ips = api_connector.ipam.ip_addresses.create([
+        {
+            "address": ip,
+            "interface": loopback.id,
+        }
+        for dev, loopback in zip(model["devices"], loopbacks)
+        for ip in addresses["loopbacks"][dev['id']]
+    ])
+    update_records(
+        api_connector.dcim.devices,
+        [
+            {"id": device.id, "primary_ip4": ips[2 * n].id, "primary_ip6": ips[2 * n + 1].id}
+            for n, device in enumerate(devices)
+        ],
+        {device.id: device for device in devices},
+        bulk_writes(api_connector)
+    )
+
     i = 0
-    for dev in model["devices"]:
+    for dev, device in zip(model["devices"], devices):
         # Avoid looping on the same objects - dev
         assert dev['id'] not in index["devices"]
 
-        # Setup device
-        device = api_connector.dcim.devices.create(
-            name="{}{}".format(index['device_types'][dev['device_type']].model, dev['id']),
-            device_role=index['device_role'].id,
-            device_type=index['device_types'][dev['device_type']].id,
-            tenant=index['tenant'].id,
-            rack=index['rack'].id,
-            position=int(dev['id']) + 1,
-            face=0,
-            site=index['site'].id,
-            tags=dev['tags']
-        )
-
-        # Setup loopback interface
-        interface = api_connector.dcim.interfaces.create(
-            name=dev["loopback"],
-            device=device.id,
-            type=0
-        )
-
-        # Attach IP to loopback
-        ipv4 = api_connector.ipam.ip_addresses.create(
-            address=SPEC.LOOPBACKv4.format(pod_id=pod_id, rtr_id=dev['id']),
-            interface=interface.id
-        )
-        # Attach IP to loopback
-        ipv6 = api_connector.ipam.ip_addresses.create(
-            address=SPEC.LOOPBACKv6.format(pod_id=pod_id, rtr_id=dev['id']),
-            interface=interface.id
-        )
-        device.primary_ip4 = ipv4
-        device.primary_ip6 = ipv6
-        device.save()
-
         # Load device in reference
         index["devices"][dev['id']] = device
 
@@ -322,7 +411,7 @@ def make_pod(pod_id, api_connector):
             )
             if "transit" in tags:
                 c = api_connector.circuits.circuits.create(
-                    cid="ID-{}".format(i),
+                    cid=SPEC.CIRCUIT_ID.format(pod_id=pod_id, circuit_id=i),
                     provider=index['circuit_providers'][intf['provider']].id,
                     type=index['circuit_type'].id,
                 )
@@ -343,14 +432,10 @@ def make_pod(pod_id, api_connector):
             # Load interface in references
             index["interfaces"][intf['id']] = interface
 
-    for co in model["connections"]:
+    for co, (net4, net6) in zip(model["connections"], addresses["connections"]):
         a = index["interfaces"][co["a"]]
         z = index["interfaces"][co["z"]]
         ends = [a, z]
-        prefix4 = co["prefixv4"].format(pod_id=pod_id)
-        prefix6 = co["prefixv6"].format(pod_id=pod_id)
-        net4 = ipaddress.ip_network(prefix4)
-        net6 = ipaddress.ip_network(prefix6)
 
         for net in [net4, net6]:
             api_connector.ipam.prefixes.create(
@@ -359,7 +444,7 @@ def make_pod(pod_id, api_connector):
             )
             for i in range(len(ends)):
                 api_connector.ipam.ip_addresses.create(
-                    address="{}/{}".format(list(net)[i], net.prefixlen),
+                    address=address(net, i),
                     interface=ends[i].id,
                 )
 
@@ -374,55 +459,301 @@ def make_pod(pod_id, api_connector):
     return index
 
 
+def pod_graph(pod_id, graph=None, allocator=None):
+    # Desired state of the pod, uplinks included, as an object graph. Several
+    # pods can be added to the same graph, sharing the allocator checks that
+    # their addresses do not overlap.
+    SPEC = POD_SPECS
+    model = SPEC.MODEL
+    if graph is None:
+        graph = Graph()
+    addresses = pod_addresses(pod_id, allocator)
+
+    tenant = graph.add(
+        "tenancy.tenants",
+        name=SPEC.TENANT_NAME.format(pod_id=pod_id),
+        slug=SPEC.TENANT_NAME.format(pod_id=pod_id),
+    )
+    device_role = graph.add(
+        "dcim.device_roles",
+        name=SPEC.DEVICE_ROLE,
+        slug=SPEC.DEVICE_ROLE,
+        color="f44336",
+    )
+    circuit_type = graph.add(
+        "circuits.circuit_types",
+        name="transit",
+        slug="transit",
+    )
+    site = graph.add(
+        "dcim.sites",
+        refs={"tenant": tenant},
+        name=SPEC.SITE_NAME.format(pod_id=pod_id),
+        slug=SPEC.SITE_NAME.format(pod_id=pod_id),
+        asn="655{pod_id:02d}".format(pod_id=pod_id),
+        description="The site of the {}th pod.".format(pod_id),
+        physical_address="2 Rue Scribe, Paris, France",
+    )
+    rack = graph.add(
+        "dcim.racks",
+        refs={"site": site},
+        name=SPEC.RACK.format(pod_id=pod_id),
+    )
+    providers = [
+        graph.add("circuits.providers", **prov)
+        for prov in SPEC.CIRCUIT_PROVIDERS
+    ]
+    device_types = []
+    for dt in SPEC.DEVICE_TYPES:
+        manufacturer = graph.add(
+            "dcim.manufacturers",
+            name=dt["manufacturer"],
+            slug=dt["manufacturer"].replace(' ', '_'),
+        )
+        device_types.append(graph.add(
+            "dcim.device_types",
+            refs={"manufacturer": manufacturer},
+            model=dt["model"],
+            slug=dt["model"],
+        ))
+
+    interfaces = {}
+    i = 0
+    for dev in model["devices"]:
+        loopbacks = addresses["loopbacks"][dev['id']]
+        device = graph.add(
+            "dcim.devices",
+            refs={
+                "device_role": device_role,
+                "device_type": device_types[dev['device_type']],
+                "tenant": tenant,
+                "rack": rack,
+                "site": site,
+            },
+            deferred={
+                "primary_ip4": loopbacks[0],
+                "primary_ip6": loopbacks[1],
+            },
+            name="{}{}".format(SPEC.DEVICE_TYPES[dev['device_type']]["model"], dev['id']),
+            position=int(dev['id']) + 1,
+            face=0,
+            tags=dev['tags'],
+        )
+        graph.aliases[("devices", pod_id, dev['id'])] = device
+        loopback = graph.add(
+            "dcim.interfaces",
+            refs={"device": device},
+            name=dev["loopback"],
+            type=0,
+        )
+        for ip in loopbacks:
+            graph.add(
+                "ipam.ip_addresses",
+                refs={"interface": loopback, "tenant": tenant},
+                address=ip,
+            )
+
+        for intf in dev['interfaces']:
+            assert intf['id'] not in interfaces
+            tags = intf.get('tags', [])
+            interface = graph.add(
+                "dcim.interfaces",
+                refs={"device": device},
+                name=intf["name"],
+                type=1200,
+                tags=tags,
+            )
+            interfaces[intf['id']] = interface
+            graph.aliases[("interfaces", pod_id, intf['id'])] = interface
+            if "transit" in tags:
+                circuit = graph.add(
+                    "circuits.circuits",
+                    refs={
+                        "provider": providers[intf['provider']],
+                        "type": circuit_type,
+                    },
+                    cid=SPEC.CIRCUIT_ID.format(pod_id=pod_id, circuit_id=i),
+                )
+                termination = graph.add(
+                    "circuits.circuit_terminations",
+                    refs={"circuit": circuit, "site": site},
+                    term_side="A",
+                    port_speed=10000000,
+                )
+                graph.add(
+                    "dcim.cables",
+                    refs={
+                        "termination_a_id": termination,
+                        "termination_b_id": interface,
+                    },
+                    termination_a_type="circuits.circuittermination",
+                    termination_b_type="dcim.interface",
+                )
+                i += 1
+
+    for co, nets in zip(model["connections"], addresses["connections"]):
+        ends = [interfaces[co["a"]], interfaces[co["z"]]]
+        for net in nets:
+            graph.add(
+                "ipam.prefixes",
+                refs={"tenant": tenant},
+                prefix=str(net),
+                description="IPv4 inner interco prefix",
+            )
+            for i in range(len(ends)):
+                graph.add(
+                    "ipam.ip_addresses",
+                    refs={"interface": ends[i], "tenant": tenant},
+                    address=address(net, i),
+                )
+        graph.add(
+            "dcim.cables",
+            refs={
+                "termination_a_id": ends[0],
+                "termination_b_id": ends[1],
+            },
+            termination_a_type="dcim.interface",
+            termination_b_type="dcim.interface",
+        )
+
+    for uplink, nets in zip(model["uplinks"], addresses["uplinks"]):
+        for net, description in zip(nets, ["Tier1-ICO-v4", "Tier1-ICO-v6"]):
+            graph.add(
+                "ipam.prefixes",
+                refs={"tenant": tenant},
+                prefix=str(net),
+                description=description,
+            )
+            graph.add(
+                "ipam.ip_addresses",
+                refs={"interface": interfaces[uplink["interface"]], "tenant": tenant},
+                address=address(net, 1),
+            )
+            graph.add(
+                "ipam.ip_addresses",
+                refs={"tenant": tenant},
+                address=address(net, 0),
+                tags=uplink["tags"],
+            )
+
+    return graph
+
+
+def make_uplinks(pod_id, api_connector, pods_refs):
+    addresses = pod_addresses(pod_id)
+    for uplink, nets in zip(POD_SPECS.MODEL["uplinks"], addresses["uplinks"]):
+        for net, description in zip(nets, ["Tier1-ICO-v4", "Tier1-ICO-v6"]):
+            api_connector.ipam.prefixes.create(
+                prefix=str(net),
+                description=description
+            )
+            api_connector.ipam.ip_addresses.create(
+                address=address(net, 1),
+                interface=pods_refs["interfaces"][uplink["interface"]].id,
+            )
+            api_connector.ipam.ip_addresses.create(
+                address=address(net, 0),
+                tags=uplink["tags"]
+            )
+
+
 def main():
     args = vars(parse_cli_args(sys.argv[1:]))
+
+    if args['plan'] or args['async']:
+        graph = Graph()
+        allocator = Allocator(POD_SPECS.POOLS)
+        try:
+            for pod_id in args['id']:
+                pod_graph(pod_id, graph, allocator)
+        except AllocationError as exc:
+            sys.exit(str(exc))
+
+    if args['plan']:
+        # --bulk applies the graph of each pod in turn
+        parts = [pod_graph(pod_id) for pod_id in args['id']]
+        print(graph.summary(parts))
+        with open(args['plan'], 'w') as plan_file:
+            json.dump(graph.to_dict(parts), plan_file, indent=2)
+        errors = graph.validate()
+        if errors:
+            sys.exit("\n".join(errors))
+        return
+
+    journal = None
+    if args['journal']:
+        try:
+            journal = Journal(args['journal'], resume=args['resume'])
+        except FileExistsError:
+            sys.exit("{}: journal of another run, use --resume or remove it".format(
+                args['journal']
+            ))
+
+    recorder = Recorder()
+    if args['async']:
+        try:
+            _, report = run_graph(
+                graph,
+                args['netbox_url'],
+                args['netbox_token'],
+                concurrency=args['concurrency'],
+                retries=args['retries'],
+                timeout=args['timeout'],
+                recorder=recorder if args['metrics'] or args['trace'] else None,
+                journal=journal,
+            )
+        except AsyncRequestError as exc:
+            sys.exit(str(exc))
+        finally:
+            recorder.write(args['metrics'], args['trace'])
+            if journal is not None:
+                journal.close()
+        print("{} created, {} updated, {} requests".format(
+            report["create"], report["update"], report["requests"]
+        ))
+        return
+
     # Netbox API connector
-    api_connector = pynetbox.api(
-        url=args['netbox_url'],
-        token=args['netbox_token']
+    api_connector = connect(
+        args['netbox_url'],
+        args['netbox_token'],
+        retries=args['retries'],
+        timeout=args['timeout'],
     )
+    if args['metrics'] or args['trace']:
+        recorder.attach(api_connector)
 
-    pods_refs = make_pod(args['id'], api_connector)
+    known = None
+    if args['bulk']:
+        # Shared objects looked up once, then those created by each pod
+        lab = Graph()
+        for pod_id in args['id']:
+            pod_graph(pod_id, lab)
+        known = lookup_known(api_connector, lab)
+        bulk_update = bulk_writes(api_connector)
 
-    for uplink in POD_SPECS.MODEL["uplinks"]:
-        subnet = uplink['prefixv4'].format(pod_id=args['id'])
-        api_connector.ipam.prefixes.create(
-            prefix=subnet,
-            description="Tier1-ICO-v4"
-        )
-        api_connector.ipam.ip_addresses.create(
-            address=(
-                "{}/31"
-                .format(str(list(ipaddress.ip_network(subnet))[1]))
-            ),
-            interface=pods_refs["interfaces"][uplink["interface"]].id,
-        )
-        api_connector.ipam.ip_addresses.create(
-            address=(
-                "{}/31"
-                .format(str(list(ipaddress.ip_network(subnet))[0]))
-            ),
-            tags=uplink["tags"]
-        )
-        subnet = uplink['prefixv6'].format(pod_id=args['id'])
-        api_connector.ipam.prefixes.create(
-            prefix=subnet,
-            description="Tier1-ICO-v6"
-        )
-        api_connector.ipam.ip_addresses.create(
-            address=(
-                "{}/127"
-                .format(str(list(ipaddress.ip_network(subnet))[1]))
-            ),
-            interface=pods_refs["interfaces"][uplink["interface"]].id,
-        )
-        api_connector.ipam.ip_addresses.create(
-            address=(
-                "{}/127"
-                .format(str(list(ipaddress.ip_network(subnet))[0]))
-            ),
-            tags=uplink["tags"]
-        )
+    try:
+        for pod_id in args['id']:
+            if args['reconcile']:
+                _, report = reconcile(api_connector, pod_graph(pod_id))
+                print("pod{:02d}: {} created, {} updated, {} deleted".format(
+                    pod_id, report["create"], report["update"], report["delete"]
+                ))
+            elif args['bulk']:
+                ids, _ = apply(
+                    api_connector, pod_graph(pod_id), known=known, journal=journal,
+                    bulk_update=bulk_update
+                )
+                for kind in KEEP_KINDS:
+                    known[kind].update(ids[kind])
+            else:
+                pods_refs = make_pod(pod_id, api_connector)
+                make_uplinks(pod_id, api_connector, pods_refs)
+    finally:
+        # Also when a pod fails, to see what happened until then
+        recorder.write(args['metrics'], args['trace'])
+        if journal is not None:
+            journal.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import configparser
+import datetime
+import ipaddress
+import json
+import os
+import sys
+import time
+
+from peer_enrichment import add_peer_ip
+from transport import connect
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "netbox_inventory.ini")
+
+# Devices per filter call when looking up interfaces and IPs by device
+CHUNK_SIZE = 100
+
+# Changed object types that may affect every host, the inventory is rebuilt
+FULL_REBUILD_TYPES = [
+    "circuits.provider",
+    "dcim.devicerole",
+    "dcim.devicetype",
+    "dcim.manufacturer",
+    "tenancy.tenant",
+]
+
+# Seconds subtracted from the local clock for the first changelog query
+CLOCK_SKEW = 60
+
+
+def parse_cli_args(script_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--list', action='store_true',
+    )
+    parser.add_argument(
+        '--host', action='store',
+    )
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help="Ignore the cache and query NetBox"
+    )
+    parser.add_argument(
+        '--config', action='store', default=CONFIG_FILE,
+    )
+
+    return parser.parse_args(script_args)
+
+
+def load_config(path):
+    # The environment wins over the configuration file
+    config = configparser.ConfigParser()
+    config.read(path)
+    section = config["netbox"] if config.has_section("netbox") else {}
+    options = {
+        "url": section.get("url"),
+        "token": section.get("token"),
+        "device_role": section.get("device_role", "lab-pod"),
+        "tenant": section.get("tenant"),
+        "cache_path": section.get("cache_path", "~/.cache/netbox_inventory.json"),
+        "cache_ttl": section.get("cache_ttl", "300"),
+        "full_refresh": section.get("full_refresh", "86400"),
+    }
+    for option in options:
+        value = os.environ.get("NETBOX_{}".format(option.upper()))
+        if value is not None:
+            options[option] = value
+    options["cache_path"] = os.path.expanduser(options["cache_path"])
+    options["cache_ttl"] = int(options["cache_ttl"])
+    options["full_refresh"] = int(options["full_refresh"])
+    return options
+
+
+def filter_chunked(endpoint, field, ids, **filters):
+    # Keep the query strings short on large inventories
+    ids = sorted(ids)
+    records = []
+    for i in range(0, len(ids), CHUNK_SIZE):
+        records.extend(endpoint.filter(**dict(filters, **{field: ids[i:i + CHUNK_SIZE]})))
+    return records
+
+
+def slugs(tags):
+    return [getattr(tag, "slug", tag) for tag in tags or []]
+
+
+def ip_vars(address):
+    interface = ipaddress.ip_interface(address)
+    return "ipv{}".format(interface.version), {
+        "local_ip": str(interface.ip),
+        "netmask": interface.network.prefixlen,
+    }
+
+
+def fetch(api_connector, options, device_ids=None):
+    """Query NetBox: devices, their sites, interfaces and IPs, the providers
+
+    With device_ids, only the devices among them still in the inventory.
+    """
+    filters = {"role": options["device_role"]}
+    if options["tenant"]:
+        filters["tenant"] = options["tenant"]
+    if device_ids is None:
+        devices = list(api_connector.dcim.devices.filter(**filters))
+    else:
+        devices = filter_chunked(api_connector.dcim.devices, "id", device_ids, **filters)
+    device_ids = [device.id for device in devices]
+    return {
+        "devices": devices,
+        "sites": filter_chunked(
+            api_connector.dcim.sites, "id", {device.site.id for device in devices}
+        ),
+        "interfaces": filter_chunked(api_connector.dcim.interfaces, "device_id", device_ids),
+        "ip_addresses": filter_chunked(api_connector.ipam.ip_addresses, "device_id", device_ids),
+        "providers": list(api_connector.circuits.providers.all()),
+    }
+
+
+def build_host(device, site, interfaces, addresses, providers):
+    # Host variables as expected by the roles and peer_enrichment. The
+    # routers have the same names in every pod, device_name is the one of
+    # group_vars management_ip
+    hostvars = {
+        "device_name": device.name,
+        "my_asn": site.asn,
+        "transit_interfaces": [],
+        "transit_sessions": [],
+        "igp": {
+            "loopbacks": {},
+            "neighbors": [],
+        },
+    }
+    for primary in ("primary_ip4", "primary_ip6"):
+        ip = getattr(device, primary, None)
+        if ip:
+            version, values = ip_vars(ip.address)
+            hostvars["igp"]["loopbacks"][version] = values
+
+    for intf in interfaces:
+        ips = dict(ip_vars(ip.address) for ip in addresses.get(intf.id, []))
+        if getattr(intf, "mgmt_only", False) and "ipv4" in ips:
+            hostvars["mgmt_ip"] = ips["ipv4"]["local_ip"]
+            continue
+        tags = slugs(intf.tags)
+        if "transit" in tags:
+            provider = next((providers[t] for t in tags if t in providers), None)
+            peer_name = provider.name if provider else ""
+            hostvars["transit_interfaces"].append(dict(
+                ips, name=intf.name, peer_name=peer_name
+            ))
+            if provider and ips:
+                session = {"name": provider.name, "peer_asn": provider.asn}
+                # Copies, peer_enrichment removes local_ip/netmask from sessions
+                for version, values in ips.items():
+                    session[version] = dict(values)
+                hostvars["transit_sessions"].append(session)
+        elif ips and getattr(intf, "connected_endpoint_type", None) == "dcim.interface":
+            hostvars["igp"]["neighbors"].append(dict(
+                ips,
+                interface=intf.name,
+                peer=intf.connected_endpoint.device.name,
+            ))
+    # Reached on its management address. The loopbacks only exist once the
+    # configuration is pushed, without one ansible_host is left to Ansible
+    if "mgmt_ip" in hostvars:
+        hostvars["ansible_host"] = hostvars["mgmt_ip"]
+    return hostvars
+
+
+def build_inventory(data, names=None):
+    """Inventory of the fetched devices and its index
+
+    The index maps NetBox IDs (as strings, they are JSON keys) to the
+    devices they belong to, so changed objects can be traced back to hosts.
+    names counts the device names of the whole inventory, hosts with a
+    shared name are prefixed with their tenant.
+    """
+    addresses = {}
+    for ip in data["ip_addresses"]:
+        if ip.interface:
+            addresses.setdefault(ip.interface.id, []).append(ip)
+    interfaces = {}
+    for intf in data["interfaces"]:
+        interfaces.setdefault(intf.device.id, []).append(intf)
+    providers = {provider.slug: provider for provider in data["providers"]}
+    sites = {site.id: site for site in data["sites"]}
+
+    if names is None:
+        names = collections.Counter(device.name for device in data["devices"])
+    inventory = {
+        "_meta": {"hostvars": {}},
+        "all": {"children": []},
+    }
+    index = {
+        "devices": {},
+        "interfaces": {},
+        "ip_addresses": {},
+        "sites": {},
+        "peers": {},
+    }
+    for device in data["devices"]:
+        host = device.name
+        tenant = device.tenant.slug if device.tenant else None
+        if names[device.name] > 1:
+            # Same router names in every pod
+            host = "{}-{}".format(tenant, device.name)
+        inventory["_meta"]["hostvars"][host] = build_host(
+            device, sites[device.site.id], interfaces.get(device.id, []), addresses, providers
+        )
+        for group in (device.device_type.manufacturer.slug, tenant):
+            if group is None:
+                continue
+            if group not in inventory:
+                inventory[group] = {"hosts": []}
+                inventory["all"]["children"].append(group)
+            inventory[group]["hosts"].append(host)
+
+        device_id = str(device.id)
+        index["devices"][device_id] = {"host": host, "name": device.name}
+        index["sites"].setdefault(str(device.site.id), []).append(device_id)
+        index["peers"][device_id] = []
+        for intf in interfaces.get(device.id, []):
+            index["interfaces"][str(intf.id)] = device_id
+            for ip in addresses.get(intf.id, []):
+                index["ip_addresses"][str(ip.id)] = device_id
+            if getattr(intf, "connected_endpoint_type", None) == "dcim.interface":
+                index["peers"][device_id].append(str(intf.connected_endpoint.device.id))
+
+    return add_peer_ip(inventory), index
+
+
+def data_ref(data, field):
+    # Changelog snapshots hold foreign keys as IDs
+    value = data.get(field) if isinstance(data, dict) else getattr(data, field, None)
+    if isinstance(value, dict):
+        value = value.get("id")
+    value = getattr(value, "id", value)
+    return None if value is None else str(value)
+
+
+def affected_devices(changes, index):
+    """IDs of the devices touched by the changes, None to rebuild everything"""
+    interfaces = dict(index["interfaces"])
+    affected = set()
+    for change in sorted(changes, key=lambda c: c.time):
+        kind = change.changed_object_type
+        object_id = str(change.changed_object_id)
+        data = change.object_data or {}
+        if kind in FULL_REBUILD_TYPES:
+            return None
+        if kind == "dcim.device":
+            # Peers hold the device name in their IGP neighbors
+            affected.add(object_id)
+            affected.update(index["peers"].get(object_id, []))
+        elif kind == "dcim.interface":
+            affected.add(interfaces.get(object_id))
+            interfaces[object_id] = data_ref(data, "device")
+            affected.add(interfaces[object_id])
+        elif kind == "ipam.ipaddress":
+            # Where the address was and where it is now
+            affected.add(index["ip_addresses"].get(object_id))
+            affected.add(interfaces.get(data_ref(data, "interface")))
+        elif kind == "dcim.cable":
+            for side in ("a", "b"):
+                if data_ref(data, "termination_{}_type".format(side)) == "dcim.interface":
+                    affected.add(interfaces.get(data_ref(data, "termination_{}_id".format(side))))
+        elif kind == "dcim.site":
+            affected.update(index["sites"].get(object_id, []))
+    affected.discard(None)
+    return affected
+
+
+def remove_hosts(inventory, index, device_ids):
+    hosts = {index["devices"].pop(d)["host"] for d in device_ids if d in index["devices"]}
+    for host in hosts:
+        del inventory["_meta"]["hostvars"][host]
+    for group in list(inventory["all"]["children"]):
+        inventory[group]["hosts"] = [h for h in inventory[group]["hosts"] if h not in hosts]
+        if not inventory[group]["hosts"]:
+            del inventory[group]
+            inventory["all"]["children"].remove(group)
+    for table in ("interfaces", "ip_addresses"):
+        index[table] = {k: d for k, d in index[table].items() if d not in device_ids}
+    for site, devices in list(index["sites"].items()):
+        index["sites"][site] = [d for d in devices if d not in device_ids]
+        if not index["sites"][site]:
+            del index["sites"][site]
+    for device_id in device_ids:
+        index["peers"].pop(device_id, None)
+
+
+def merge_inventory(inventory, index, update, update_index):
+    inventory["_meta"]["hostvars"].update(update["_meta"]["hostvars"])
+    for group in update["all"]["children"]:
+        if group not in inventory:
+            inventory[group] = {"hosts": []}
+            inventory["all"]["children"].append(group)
+        inventory[group]["hosts"].extend(update[group]["hosts"])
+    for table in ("devices", "interfaces", "ip_addresses", "peers"):
+        index[table].update(update_index[table])
+    for site, devices in update_index["sites"].items():
+        index["sites"].setdefault(site, []).extend(devices)
+
+
+def read_cache(path):
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    if "index" not in cache:
+        # Written by an older version, no changelog mark
+        return None
+    return cache
+
+
+def write_cache(path, cache):
+    # Write then rename so a concurrent run never reads a partial file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(tmp_path, path)
+
+
+def build_cache(api_connector, options):
+    # Changes made while fetching are replayed by the next refresh
+    now = datetime.datetime.now(datetime.timezone.utc)
+    mark = (now - datetime.timedelta(seconds=CLOCK_SKEW)).isoformat()
+    inventory, index = build_inventory(fetch(api_connector, options))
+    return {
+        "timestamp": time.time(),
+        "built": time.time(),
+        "mark": mark,
+        "seen": [],
+        "inventory": inventory,
+        "index": index,
+    }
+
+
+def refresh_cache(api_connector, options, cache):
+    """Apply the NetBox changelog since the last sync to the cached inventory
+
+    Only the hosts touched by a change are fetched, rebuilt and peer
+    enriched again. Returns None when the inventory must be rebuilt.
+    """
+    # time_after includes the mark, skip the changes already applied
+    changes = [
+        change
+        for change in api_connector.extras.object_changes.filter(time_after=cache["mark"])
+        if change.id not in cache["seen"]
+    ]
+    cache["timestamp"] = time.time()
+    if not changes:
+        return cache
+    index = cache["index"]
+    affected = affected_devices(changes, index)
+    if affected is None:
+        return None
+
+    if affected:
+        data = fetch(api_connector, options, sorted(int(d) for d in affected))
+        names = collections.Counter(
+            entry["name"] for device_id, entry in index["devices"].items()
+            if device_id not in affected
+        )
+        names.update(device.name for device in data["devices"])
+        for device_id, entry in index["devices"].items():
+            # A name becoming shared, or unique, renames hosts outside of
+            # the change set
+            prefixed = entry["host"] != entry["name"]
+            if device_id not in affected and (names[entry["name"]] > 1) != prefixed:
+                return None
+        update, update_index = build_inventory(data, names)
+        remove_hosts(cache["inventory"], index, affected)
+        merge_inventory(cache["inventory"], index, update, update_index)
+
+    mark = max(change.time for change in changes)
+    seen = [change.id for change in changes if change.time == mark]
+    if mark == cache["mark"]:
+        seen.extend(cache["seen"])
+    cache["mark"] = mark
+    cache["seen"] = seen
+    return cache
+
+
+def get_inventory(options, refresh=False):
+    cache = None if refresh else read_cache(options["cache_path"])
+    if cache is not None and time.time() - cache["timestamp"] <= options["cache_ttl"]:
+        return cache["inventory"]
+
+    api_connector = connect(options['url'], options['token'], threading=True)
+    if cache is not None and time.time() - cache["built"] <= options["full_refresh"]:
+        cache = refresh_cache(api_connector, options, cache)
+    else:
+        cache = None
+    if cache is None:
+        cache = build_cache(api_connector, options)
+    write_cache(options["cache_path"], cache)
+    return cache["inventory"]
+
+
+def main():
+    args = vars(parse_cli_args(sys.argv[1:]))
+    options = load_config(args['config'])
+    if args['host']:
+        # Everything is already in _meta
+        print(json.dumps({}))
+        return
+    print(json.dumps(get_inventory(options, args['refresh'])))
+
+
+if __name__ == '__main__':
+    main()
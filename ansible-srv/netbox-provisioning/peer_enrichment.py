@@ -1,51 +1,124 @@
+import functools
 import ipaddress
+import multiprocessing
 import sys
 
+# Host bits of the point-to-point subnets the peer can be derived from
+P2P_HOST_BITS = {
+    4: {30: 2, 31: 1},
+    6: {126: 2, 127: 1},
+}
+
+
+class PeerIPError(ValueError):
+    pass
+
+
+@functools.lru_cache(maxsize=16384)
+def compute_peer_ip(address, netmask):
+    """Determine peer ip when given /31, /30, /127 or /126 network"""
+    local_ip = ipaddress.ip_address(address)
+    if str(netmask).isdigit():
+        prefixlen = int(netmask)
+    else:
+        # Dotted netmask, e.g. 255.255.255.254
+        prefixlen = ipaddress.ip_interface("{}/{}".format(address, netmask)).network.prefixlen
+    host_bits = P2P_HOST_BITS[local_ip.version].get(prefixlen)
+
+    local = int(local_ip)
+    if host_bits == 1:
+        peer = local ^ 1
+    elif host_bits == 2 and local & 3 in (1, 2):
+        # Only the two middle addresses of a /30 or /126 are usable
+        peer = local ^ 3
+    else:
+        raise PeerIPError(
+            "The auto peer IP discovering is only possible for /30, /31, /127 and /126 subnets."
+        )
+    return str(type(local_ip)(peer))
+
+
 def find_peer_ip(address, netmask):
-    """Determine peer ip when given /31 or /30 network"""
-    local_ip = ipaddress.ip_interface("{}/{}".format(address, netmask))
-    peer_ip = [ip for ip in list(local_ip.network.hosts()) if ip != local_ip.ip]
+    """Determine peer ip when given /31, /30, /127 or /126 network"""
     try:
-        assert len(peer_ip) == 1
-    except AssertionError:
-        sys.exit("The auto peer IP discovering is only possible for /30, /31, /127 and /126 subnets.")
-    return str(peer_ip[0])
-
-def add_peer_ip(inventory):
-    # Iterate over full inventory
-    for host, definition in inventory["_meta"]["hostvars"].items():
-        # Iterate over transit_interfaces
-        for intf in definition["transit_interfaces"]:
-            # Apply for both ipv4 and ipv6
-            for v in ["ipv4", "ipv6"]:
-                try:
-                    # Determine peer_ip
-                    peer_ip = find_peer_ip(
-                        intf[v]["local_ip"],
-                        intf[v]["netmask"]
-                    )
-                    # Set peer_ip
-                    intf[v]["peer_ip"] = peer_ip
-                except KeyError:
-                    # If an error occured, then this host is not concerned
-                    pass
-        # Iterate over transit_sessions
-        for session in definition["transit_sessions"]:
-            # Apply for both ipv4 and ipv6
-            for v in ["ipv4", "ipv6"]:
-                try:
-                    # Determine peer_ip
-                    peer_ip = find_peer_ip(
-                        session[v]["local_ip"],
-                        session[v]["netmask"]
-                    )
-                    # Set peer_ip
-                    session[v]["peer_ip"] = peer_ip
-                    # Optional: Clean temp variables
-                    del session[v]["local_ip"]
-                    del session[v]["netmask"]
-                except KeyError:
-                    # If an error occured, then this host is not concerned
-                    pass
-
-    return inventory
\ No newline at end of file
+        return compute_peer_ip(address, netmask)
+    except PeerIPError as exc:
+        sys.exit(str(exc))
+
+
+def enrich_host(item):
+    """Set the peer_ip of one host, returning (host, definition, errors)"""
+    host, definition = item
+    errors = []
+    # Iterate over transit_interfaces
+    for i, intf in enumerate(definition.get("transit_interfaces", [])):
+        # Apply for both ipv4 and ipv6
+        for v in ["ipv4", "ipv6"]:
+            try:
+                # Set peer_ip
+                intf[v]["peer_ip"] = compute_peer_ip(
+                    intf[v]["local_ip"],
+                    intf[v]["netmask"]
+                )
+            except KeyError:
+                # If an error occured, then this host is not concerned
+                pass
+            except ValueError as exc:
+                # Unsupported subnet or invalid address, reported per host
+                errors.append("transit_interfaces[{}].{}: {}".format(i, v, exc))
+    # Iterate over transit_sessions
+    for i, session in enumerate(definition.get("transit_sessions", [])):
+        # Apply for both ipv4 and ipv6
+        for v in ["ipv4", "ipv6"]:
+            try:
+                # Set peer_ip
+                session[v]["peer_ip"] = compute_peer_ip(
+                    session[v]["local_ip"],
+                    session[v]["netmask"]
+                )
+                # Optional: Clean temp variables
+                del session[v]["local_ip"]
+                del session[v]["netmask"]
+            except KeyError:
+                # If an error occured, then this host is not concerned
+                pass
+            except ValueError as exc:
+                # Unsupported subnet or invalid address, reported per host
+                errors.append("transit_sessions[{}].{}: {}".format(i, v, exc))
+    return host, definition, errors
+
+
+def enrich_hosts(items, processes=1, chunksize=64):
+    """Stream (host, definition, errors) for (host, definition) pairs
+
+    With more than one process, hosts are enriched across a process pool
+    and come back in their original order.
+    """
+    if processes <= 1:
+        for item in items:
+            yield enrich_host(item)
+        return
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap(enrich_host, items, chunksize):
+            yield result
+
+
+def add_peer_ip(inventory, processes=1, report=None):
+    """Add peer_ip to every transit interface and session of the inventory
+
+    Hosts with an unsupported subnet keep their other values; their errors
+    are stored in report (host -> messages) or printed on stderr.
+    """
+    hostvars = inventory["_meta"]["hostvars"]
+    for host, definition, errors in enrich_hosts(hostvars.items(), processes):
+        # Enriched in a worker process, the definition is a copy
+        hostvars[host] = definition
+        if not errors:
+            continue
+        if report is None:
+            for error in errors:
+                print("{}: {}".format(host, error), file=sys.stderr)
+        else:
+            report[host] = errors
+
+    return inventory
@@ -0,0 +1,216 @@
+import collections
+
+# Objects per list POST or bulk PATCH
+BATCH_SIZE = 100
+
+# Object kinds in creation order, with the fields forming their natural key
+# and the kind each reference field points to (None: given by the matching
+# *_type field, see ref_kind)
+KINDS = collections.OrderedDict([
+    ("tenancy.tenants", {
+        "key": ["slug"],
+        "refs": {},
+    }),
+    ("dcim.device_roles", {
+        "key": ["slug"],
+        "refs": {},
+    }),
+    ("circuits.circuit_types", {
+        "key": ["slug"],
+        "refs": {},
+    }),
+    ("circuits.providers", {
+        "key": ["slug"],
+        "refs": {},
+    }),
+    ("dcim.manufacturers", {
+        "key": ["slug"],
+        "refs": {},
+    }),
+    ("dcim.device_types", {
+        "key": ["slug"],
+        "refs": {"manufacturer": "dcim.manufacturers"},
+    }),
+    ("dcim.sites", {
+        "key": ["slug"],
+        "refs": {"tenant": "tenancy.tenants"},
+    }),
+    ("dcim.racks", {
+        "key": ["site", "name"],
+        "refs": {"site": "dcim.sites"},
+    }),
+    ("dcim.devices", {
+        "key": ["site", "name"],
+        "refs": {
+            "device_role": "dcim.device_roles",
+            "device_type": "dcim.device_types",
+            "tenant": "tenancy.tenants",
+            "site": "dcim.sites",
+            "rack": "dcim.racks",
+            "primary_ip4": "ipam.ip_addresses",
+            "primary_ip6": "ipam.ip_addresses",
+        },
+    }),
+    ("dcim.interfaces", {
+        "key": ["device", "name"],
+        "refs": {"device": "dcim.devices"},
+    }),
+    ("circuits.circuits", {
+        "key": ["provider", "cid"],
+        "refs": {
+            "provider": "circuits.providers",
+            "type": "circuits.circuit_types",
+        },
+    }),
+    ("circuits.circuit_terminations", {
+        "key": ["circuit", "term_side"],
+        "refs": {
+            "circuit": "circuits.circuits",
+            "site": "dcim.sites",
+        },
+    }),
+    ("ipam.prefixes", {
+        "key": ["prefix"],
+        "refs": {"tenant": "tenancy.tenants"},
+    }),
+    ("ipam.ip_addresses", {
+        "key": ["address"],
+        "refs": {
+            "interface": "dcim.interfaces",
+            "tenant": "tenancy.tenants",
+        },
+    }),
+    ("dcim.cables", {
+        "key": [
+            "termination_a_type", "termination_a_id",
+            "termination_b_type", "termination_b_id",
+        ],
+        "refs": {
+            "termination_a_id": None,
+            "termination_b_id": None,
+        },
+    }),
+])
+
+# Choice fields per kind, with the legacy numeric values the scripts send
+# and the slug values NetBox answers with
+CHOICES = {
+    "dcim.devices": {
+        "face": {0: "front", 1: "rear"},
+    },
+    "dcim.interfaces": {
+        "type": {0: "virtual", 1200: "10gbase-x-sfpp"},
+    },
+    "circuits.circuit_terminations": {
+        "term_side": {},
+    },
+}
+
+TERMINATION_KINDS = {
+    "dcim.interface": "dcim.interfaces",
+    "circuits.circuittermination": "circuits.circuit_terminations",
+}
+
+
+def ref_kind(kind, field, fields):
+    target = KINDS[kind]["refs"][field]
+    if target is None:
+        target = TERMINATION_KINDS[fields[field[:-len("_id")] + "_type"]]
+    return target
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def node_key(kind, fields, refs):
+    return "|".join(
+        refs[field] if field in refs else str(fields[field])
+        for field in KINDS[kind]["key"]
+    )
+
+
+class Graph(object):
+    """Desired NetBox objects, referencing each other by natural key
+
+    Every node holds its plain fields, the references resolved to IDs at
+    creation time and the deferred references (device primary IPs) that can
+    only be set once their target exists.
+    """
+
+    def __init__(self):
+        self.objects = collections.OrderedDict((kind, collections.OrderedDict()) for kind in KINDS)
+        self.conflicts = []
+        # Model IDs to node keys, e.g. ("devices", pod_id, rtr_id)
+        self.aliases = {}
+
+    def add(self, kind, refs=None, deferred=None, **fields):
+        node = {
+            "fields": fields,
+            "refs": refs or {},
+            "deferred": deferred or {},
+        }
+        key = node_key(kind, fields, node["refs"])
+        # Objects shared between pods are only added once
+        existing = self.objects[kind].setdefault(key, node)
+        if existing != node:
+            self.conflicts.append("{} {}: defined twice with different values".format(kind, key))
+        return key
+
+    def validate(self, known=None):
+        """Conflicting definitions and references to missing objects"""
+        known = known or {}
+        errors = list(self.conflicts)
+        for kind, nodes in self.objects.items():
+            for key, node in nodes.items():
+                for field, ref in list(node["refs"].items()) + list(node["deferred"].items()):
+                    target = ref_kind(kind, field, node["fields"])
+                    if ref not in self.objects[target] and ref not in known.get(target, {}):
+                        errors.append("{} {}: {} {} does not exist".format(kind, key, target, ref))
+        return errors
+
+    def counts(self):
+        return collections.OrderedDict(
+            (kind, len(nodes)) for kind, nodes in self.objects.items() if nodes
+        )
+
+    def expected_calls(self, batch_size=BATCH_SIZE, parts=None):
+        # Serial: one POST per object plus one PATCH per node with deferred
+        # references. Bulk: per kind, one list POST per batch_size objects
+        # plus one bulk PATCH per batch_size nodes with deferred references.
+        # With parts, the graphs the bulk path applies one after the other
+        # (one per pod), the objects of an earlier part are not created again.
+        deferred = collections.Counter(
+            kind
+            for kind, nodes in self.objects.items()
+            for node in nodes.values() if node["deferred"]
+        )
+        created = {kind: set() for kind in KINDS}
+        bulk = 0
+        for part in parts or [self]:
+            for kind, nodes in part.objects.items():
+                new = [key for key in nodes if key not in created[kind]]
+                linked = [key for key in new if nodes[key]["deferred"]]
+                bulk += -(-len(new) // batch_size) + -(-len(linked) // batch_size)
+                created[kind].update(new)
+        return {
+            "serial": sum(self.counts().values()) + sum(deferred.values()),
+            "bulk": bulk,
+        }
+
+    def to_dict(self, parts=None):
+        return {
+            "counts": self.counts(),
+            "expected_calls": self.expected_calls(parts=parts),
+            "objects": collections.OrderedDict(
+                (kind, [dict(node, key=key) for key, node in nodes.items()])
+                for kind, nodes in self.objects.items() if nodes
+            ),
+        }
+
+    def summary(self, parts=None):
+        lines = ["{:<32} {:>6}".format(kind, count) for kind, count in self.counts().items()]
+        calls = self.expected_calls(parts=parts)
+        lines.append("{:<32} {:>6}".format("total", sum(self.counts().values())))
+        lines.append("expected API calls: {serial} serial, {bulk} bulk".format(**calls))
+        return "\n".join(lines)
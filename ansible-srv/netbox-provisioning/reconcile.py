@@ -0,0 +1,284 @@
+import collections
+
+from lookup_cache import get_endpoint
+from podgraph import BATCH_SIZE, CHOICES, KINDS, chunks, node_key, ref_kind
+from transport import bulk_writes
+
+
+# Kinds shared between pods or owning the pod, never deleted by a reconcile
+KEEP_KINDS = [
+    "tenancy.tenants",
+    "dcim.device_roles",
+    "circuits.circuit_types",
+    "circuits.providers",
+    "dcim.manufacturers",
+    "dcim.device_types",
+    "dcim.sites",
+]
+
+
+def normalize(value):
+    # Nested records compare by ID, choice fields by value and tags by name
+    if isinstance(value, list):
+        return sorted(str(normalize(getattr(v, "name", v))) for v in value)
+    if hasattr(value, "id"):
+        return value.id
+    if hasattr(value, "value"):
+        return value.value
+    return value
+
+
+def normalize_field(kind, field, value):
+    # Legacy numeric choices compare as the slug NetBox answers with
+    value = normalize(value)
+    if field in CHOICES.get(kind, {}):
+        return CHOICES[kind][field].get(value, value)
+    return value
+
+
+def fetch_current(api_connector, graph):
+    """Current state of the pod, a few bulk list calls per object kind
+
+    Objects are looked up by the natural fields of the desired objects and
+    by scope (site, tenant, devices of the pod). Only the objects found by
+    scope are candidates for deletion.
+    """
+    current = collections.OrderedDict((kind, collections.OrderedDict()) for kind in KINDS)
+
+    def desired_values(kind, field):
+        return sorted({str(node["fields"][field]) for node in graph.objects[kind].values()})
+
+    def ids(kind):
+        return sorted(current[kind])
+
+    def fetch(kind, deletable, **filters):
+        # An empty filter value means there is nothing to look for
+        if not all(filters.values()):
+            return
+        for record in get_endpoint(api_connector, kind).filter(**filters):
+            known = current[kind].get(record.id)
+            current[kind][record.id] = (record, deletable or (known is not None and known[1]))
+
+    for kind in KEEP_KINDS:
+        fetch(kind, False, slug=desired_values(kind, "slug"))
+    fetch("dcim.racks", True, site_id=ids("dcim.sites"))
+    fetch("dcim.devices", True, site_id=ids("dcim.sites"))
+    fetch("dcim.interfaces", True, device_id=ids("dcim.devices"))
+    fetch("circuits.circuit_terminations", True, site_id=ids("dcim.sites"))
+    fetch(
+        "circuits.circuits", True,
+        id=sorted({r.circuit.id for r, _ in current["circuits.circuit_terminations"].values()})
+    )
+    fetch("circuits.circuits", False, cid=desired_values("circuits.circuits", "cid"))
+    fetch("ipam.prefixes", True, tenant_id=ids("tenancy.tenants"))
+    fetch("ipam.prefixes", False, prefix=desired_values("ipam.prefixes", "prefix"))
+    fetch("ipam.ip_addresses", True, tenant_id=ids("tenancy.tenants"))
+    # Also the IPs without a tenant, on the interfaces of the pod
+    fetch("ipam.ip_addresses", True, device_id=ids("dcim.devices"))
+    fetch("ipam.ip_addresses", False, address=desired_values("ipam.ip_addresses", "address"))
+    fetch("dcim.cables", True, device_id=ids("dcim.devices"))
+
+    return current
+
+
+def lookup_known(api_connector, graph, kinds=KEEP_KINDS):
+    """IDs of the objects of these kinds already in NetBox, by slug
+
+    For apply(known=...): shared objects created by another pod or run
+    are referenced instead of created again.
+    """
+    known = {kind: {} for kind in KINDS}
+    for kind in kinds:
+        slugs = sorted(node["fields"]["slug"] for node in graph.objects[kind].values())
+        if not slugs:
+            continue
+        for record in get_endpoint(api_connector, kind).filter(slug=slugs):
+            known[kind][record.slug] = record.id
+    return known
+
+
+def record_key(kind, record, keys):
+    fields = {}
+    refs = {}
+    for field in KINDS[kind]["key"]:
+        value = normalize_field(kind, field, getattr(record, field, None))
+        fields[field] = value
+        if field in KINDS[kind]["refs"]:
+            target = ref_kind(kind, field, fields)
+            if value not in keys[target]:
+                # Points to an object outside of the pod
+                return None
+            refs[field] = keys[target][value]
+    return node_key(kind, fields, refs)
+
+
+def same(current, desired):
+    current = normalize(current)
+    desired = normalize(desired)
+    if isinstance(current, list) or isinstance(desired, list):
+        return current == desired
+    # The API may echo numbers as strings and the other way around
+    return str(current) == str(desired)
+
+
+def changes(kind, record, node, ids, refs_name="refs"):
+    updates = {}
+    values = dict(node["fields"])
+    for field, key in node[refs_name].items():
+        values[field] = ids[ref_kind(kind, field, node["fields"])][key]
+    for field, value in values.items():
+        if not hasattr(record, field):
+            # Not returned by the API, nothing to compare with
+            continue
+        if not same(
+            normalize_field(kind, field, getattr(record, field)),
+            normalize_field(kind, field, value)
+        ):
+            updates[field] = value
+    return updates
+
+
+def diff(graph, current):
+    """Match current records with desired nodes, find the stale records"""
+    keys = {kind: {} for kind in KINDS}
+    matched = {kind: {} for kind in KINDS}
+    stale = {kind: [] for kind in KINDS}
+    for kind in KINDS:
+        for record, deletable in current[kind].values():
+            key = record_key(kind, record, keys)
+            if key in graph.objects[kind] and key not in matched[kind]:
+                keys[kind][record.id] = key
+                matched[kind][key] = record
+            elif deletable:
+                stale[kind].append(record)
+    return matched, stale
+
+
+def update_records(endpoint, updates, records, bulk=True):
+    """Send the updates, {"id": ..., field: value}, as one bulk PATCH
+
+    Without bulk (NetBox before 2.10), each record is saved on its own,
+    records gives those already at hand by ID.
+    """
+    if bulk:
+        return endpoint.update(updates)
+    for update in updates:
+        record = records.get(update["id"]) or endpoint.get(update["id"])
+        for field, value in update.items():
+            if field != "id":
+                setattr(record, field, value)
+        record.save()
+
+
+def apply(api_connector, graph, matched=None, stale=None, known=None, journal=None,
+          batch_size=BATCH_SIZE, bulk_delete=True, bulk_update=True):
+    """Send the deletes, creates and updates bringing NetBox to the graph
+
+    Each step is one bulk call per object kind, per batch_size objects:
+    deletes in reverse dependency order first, so unique fields and cable
+    endpoints are freed, then creates and updates in dependency order,
+    then the deferred references. Without bulk_delete and bulk_update
+    (NetBox before 2.10), the stale records are deleted and the updated
+    ones saved one at a time. Objects referenced by the graph but managed
+    elsewhere are given as known IDs, graph nodes among them are not
+    created. With a journal, the objects it holds are not created again
+    and the new ones are added to it. Returns the NetBox ID of every node
+    and the request counts.
+    """
+    matched = matched if matched is not None else {kind: {} for kind in KINDS}
+    stale = stale or {kind: [] for kind in KINDS}
+    ids = {kind: {key: r.id for key, r in matched[kind].items()} for kind in KINDS}
+    for kind, known_ids in (known or {}).items():
+        ids[kind].update(known_ids)
+    # Known but not matched: there is no record to compare with
+    unmatched = {
+        kind: {key for key in (known or {}).get(kind, {}) if key not in matched[kind]}
+        for kind in KINDS
+    }
+    journaled = {kind: {} for kind in KINDS}
+    if journal is not None:
+        for kind in KINDS:
+            journaled[kind] = {
+                key: journal.created[kind][key]
+                for key in graph.objects[kind] if key in journal.created[kind]
+            }
+            ids[kind].update(journaled[kind])
+    report = collections.Counter()
+
+    for kind in reversed(KINDS):
+        if not bulk_delete:
+            for record in stale[kind]:
+                record.delete()
+                report["delete"] += 1
+            continue
+        for batch in chunks(stale[kind], batch_size):
+            get_endpoint(api_connector, kind).delete([r.id for r in batch])
+            report["delete"] += len(batch)
+
+    for kind, nodes in graph.objects.items():
+        endpoint = get_endpoint(api_connector, kind)
+        creates = []
+        updates = []
+        for key, node in nodes.items():
+            record = matched[kind].get(key)
+            if key in journaled[kind] or key in unmatched[kind]:
+                # Created by an earlier run or managed elsewhere
+                continue
+            if record is None:
+                values = dict(node["fields"])
+                for field, ref in node["refs"].items():
+                    values[field] = ids[ref_kind(kind, field, node["fields"])][ref]
+                creates.append((key, values))
+            else:
+                update = changes(kind, record, node, ids)
+                if update:
+                    update["id"] = record.id
+                    updates.append(update)
+        for batch in chunks(creates, batch_size):
+            records = endpoint.create([values for _, values in batch])
+            for (key, _), record in zip(batch, records):
+                ids[kind][key] = record.id
+                matched[kind][key] = record
+            if journal is not None:
+                journal.create(kind, [(key, ids[kind][key]) for key, _ in batch])
+            report["create"] += len(batch)
+        records = {record.id: record for record in matched[kind].values()}
+        for batch in chunks(updates, batch_size):
+            update_records(endpoint, batch, records, bulk_update)
+            report["update"] += len(batch)
+
+    for kind, nodes in graph.objects.items():
+        updates = []
+        linked = []
+        for key, node in nodes.items():
+            if not node["deferred"] or key in unmatched[kind]:
+                continue
+            if key in journaled[kind]:
+                if key in journal.linked[kind]:
+                    continue
+                # No record to compare with, all the references are sent
+                update = {
+                    field: ids[ref_kind(kind, field, node["fields"])][ref]
+                    for field, ref in node["deferred"].items()
+                }
+            else:
+                update = changes(kind, matched[kind][key], dict(node, fields={}), ids, "deferred")
+            if update:
+                update["id"] = ids[kind][key]
+                updates.append(update)
+                linked.append(key)
+        records = {record.id: record for record in matched[kind].values()}
+        for batch, keys in zip(chunks(updates, batch_size), chunks(linked, batch_size)):
+            update_records(get_endpoint(api_connector, kind), batch, records, bulk_update)
+            report["update"] += len(batch)
+            if journal is not None:
+                journal.link(kind, keys)
+
+    return ids, report
+
+
+def reconcile(api_connector, graph):
+    current = fetch_current(api_connector, graph)
+    matched, stale = diff(graph, current)
+    bulk = bulk_writes(api_connector)
+    return apply(api_connector, graph, matched, stale, bulk_delete=bulk, bulk_update=bulk)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from makepod import pod_graph
+from podgraph import KINDS, Graph
+from reconcile import apply, fetch_current
+from transport import RETRIES, TIMEOUT, bulk_writes, connect
+
+# Found by slug like the shared kinds, but they belong to the pod
+POD_KINDS = ("tenancy.tenants", "dcim.sites")
+
+
+def parse_cli_args(script_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--netbox-url', required=True, action='store',
+    )
+    parser.add_argument(
+        '--netbox-token', required=True, action='store',
+    )
+    parser.add_argument(
+        '--id', required=True, action='store', type=int, nargs='+'
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int, default=8, action='store',
+        help="Number of pods torn down at the same time"
+    )
+    parser.add_argument(
+        '--retries', type=int, default=RETRIES, action='store',
+        help="Attempts on connection errors, 429 and 5xx (idempotent requests only)"
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=TIMEOUT, action='store',
+        help="Seconds to wait for NetBox on each request"
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="Only count the objects that would be deleted"
+    )
+
+    return parser.parse_args(script_args)
+
+
+def pod_records(api_connector, pod_id):
+    """Records of the pod per kind, the shared ones excepted
+
+    The pod model gives the tenant and site, the objects in their scope are
+    found with the reconcile lookups, a few list calls per kind. Only the
+    records the lookups mark deletable are kept: the ones found by natural
+    key alone may belong to another pod.
+    """
+    current = fetch_current(api_connector, pod_graph(pod_id))
+    return {
+        kind: [
+            record for record, deletable in current[kind].values()
+            if deletable or kind in POD_KINDS
+        ]
+        for kind in KINDS
+    }
+
+
+def teardown(api_connector, pod_id, dry_run=False, bulk_delete=True):
+    records = pod_records(api_connector, pod_id)
+    if dry_run:
+        return sum(len(kind_records) for kind_records in records.values())
+    # Nothing desired: the records are deleted in reverse dependency order,
+    # one bulk DELETE per kind when NetBox has them
+    _, report = apply(api_connector, Graph(), stale=records, bulk_delete=bulk_delete)
+    return report["delete"]
+
+
+def teardown_pods(api_connector, pod_ids, workers=8, dry_run=False):
+    failures = {}
+    bulk_delete = bulk_writes(api_connector)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        started = time.monotonic()
+        futures = {
+            executor.submit(teardown, api_connector, pod_id, dry_run, bulk_delete): pod_id
+            for pod_id in pod_ids
+        }
+        for future in as_completed(futures):
+            pod_id = futures[future]
+            # One failed pod must not stop the others
+            try:
+                deleted = future.result()
+            except Exception as exc:
+                failures[pod_id] = exc
+                print("pod{:02d}: failed: {}".format(pod_id, exc), file=sys.stderr)
+            else:
+                print("pod{:02d}: {} {} ({:.1f}s)".format(
+                    pod_id, deleted, "to delete" if dry_run else "deleted",
+                    time.monotonic() - started
+                ))
+
+    return failures
+
+
+def main():
+    args = vars(parse_cli_args(sys.argv[1:]))
+
+    api_connector = connect(
+        args['netbox_url'],
+        args['netbox_token'],
+        workers=args['workers'],
+        retries=args['retries'],
+        timeout=args['timeout'],
+    )
+
+    failures = teardown_pods(api_connector, args['id'], args['workers'], args['dry_run'])
+    if failures:
+        sys.exit("{} pod(s) failed: {}".format(
+            len(failures),
+            ", ".join("pod{:02d}".format(pod_id) for pod_id in sorted(failures))
+        ))
+
+
+if __name__ == '__main__':
+    main()
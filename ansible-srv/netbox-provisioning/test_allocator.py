@@ -0,0 +1,55 @@
+import ipaddress
+
+import pytest
+
+import makepod
+from allocator import AllocationError, Allocator, Pool
+
+
+def networks(addresses):
+    # Every network handed out in a pod_addresses() result
+    for loopbacks in addresses["loopbacks"].values():
+        for loopback in loopbacks:
+            yield ipaddress.ip_network(loopback)
+    for table in ("connections", "uplinks"):
+        for pair in addresses[table]:
+            yield from pair
+
+
+def test_no_overlap_across_pods():
+    allocator = Allocator(makepod.POD_SPECS.POOLS)
+    handed = [
+        net for pod_id in range(1, 65) for net in networks(makepod.pod_addresses(pod_id, allocator))
+    ]
+    assert len(handed) == len(set(handed))
+    for version in (4, 6):
+        ordered = sorted(net for net in handed if net.version == version)
+        for net, next_net in zip(ordered, ordered[1:]):
+            assert not net.overlaps(next_net)
+
+
+def test_stable_per_pod():
+    # The same addresses alone, among other pods, and asked twice
+    alone = makepod.pod_addresses(7)
+    allocator = Allocator(makepod.POD_SPECS.POOLS)
+    for pod_id in (9, 3, 7, 12):
+        makepod.pod_addresses(pod_id, allocator)
+    assert makepod.pod_addresses(7, allocator) == alone
+
+
+def test_pool_rejects_overlaps():
+    pool = Pool("10.0.0.0/24")
+    assert str(pool.subnet(26, 1)) == "10.0.0.64/26"
+    with pytest.raises(AllocationError):
+        pool.reserve(96, 8)
+    # Carving skips the taken block
+    assert [str(net) for net in pool.carve(26, 2)] == ["10.0.0.128/26", "10.0.0.192/26"]
+    with pytest.raises(AllocationError):
+        pool.carve(26, 2)
+
+
+def test_pod_beyond_the_pool():
+    allocator = Allocator({"loopbackv4": ("10.200.0.0/24", 28)})
+    allocator.host("loopbackv4", 15, 1)
+    with pytest.raises(AllocationError):
+        allocator.host("loopbackv4", 16, 1)
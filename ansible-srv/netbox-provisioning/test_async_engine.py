@@ -0,0 +1,67 @@
+import asyncio
+import types
+
+import pytest
+
+import makepod
+from async_engine import AsyncNetBox, AsyncRequestError, provision
+from fakenetbox import FakeAsyncSession, FakeNetBox
+
+aiohttp = pytest.importorskip("aiohttp")
+
+
+class FailingSession(object):
+    """aiohttp-like session whose requests all fail with error"""
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def request(self, method, url, json=None, params=None):
+        self.calls += 1
+        raise self.error
+
+
+CONNECTION = types.SimpleNamespace(host="netbox.fake", port=80, ssl=None)
+
+
+@pytest.mark.parametrize("method, error, calls", [
+    # Nothing was sent, retried whatever the method
+    ("POST", aiohttp.ClientConnectorError(CONNECTION, OSError(111, "refused")), 2),
+    # Maybe received, a POST is not sent again
+    ("POST", aiohttp.ServerDisconnectedError(), 1),
+    ("POST", asyncio.TimeoutError(), 1),
+    ("GET", asyncio.TimeoutError(), 2),
+])
+def test_transport_errors_are_request_errors(monkeypatch, method, error, calls):
+    monkeypatch.setattr("async_engine.BACKOFF", 0)
+    session = FailingSession(error)
+
+    async def main():
+        async with AsyncNetBox("http://netbox.fake", "token", retries=1, session=session) as client:
+            await client.request(method, "dcim.devices")
+
+    with pytest.raises(AsyncRequestError) as failure:
+        asyncio.run(main())
+    assert failure.value.status is None
+    assert str(failure.value).startswith("{} http://netbox.fake/api/dcim/devices/: ".format(method))
+    assert session.calls == calls
+
+
+@pytest.mark.parametrize("version", ["2.8", "2.10"])
+def test_primary_ips_before_netbox_2_10(version):
+    # One PATCH per device before 2.10, no bulk PATCH
+    api_connector = FakeNetBox(version=version)
+    graph = makepod.pod_graph(1)
+
+    async def main():
+        async with AsyncNetBox(
+            "http://netbox.fake", "token", session=FakeAsyncSession(api_connector)
+        ) as client:
+            return await provision(client, graph)
+
+    asyncio.run(main())
+    devices = api_connector.endpoint("dcim.devices").all()
+    assert all(device.primary_ip4 and device.primary_ip6 for device in devices)
+    patches = api_connector.requests["dcim.devices", "PATCH"]
+    assert patches == (len(devices) if version == "2.8" else 1)
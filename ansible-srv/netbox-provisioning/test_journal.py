@@ -0,0 +1,86 @@
+import contextlib
+import io
+import json
+from unittest import mock
+
+import pytest
+
+import makelab
+from fakenetbox import FakeNetBox, FakeRequestError
+from journal import Journal
+
+ARGS = ["--netbox-url", "http://netbox.fake", "--netbox-token", "token", "-c", "3", "--bulk"]
+
+
+def run(api_connector, *args):
+    makelab.CACHE = makelab.LookupCache()
+    with mock.patch.object(makelab, "connect", lambda *a, **kw: api_connector), \
+            mock.patch("sys.argv", ["makelab.py"] + ARGS + list(args)), \
+            contextlib.redirect_stdout(io.StringIO()):
+        makelab.main()
+
+
+def fail_once(api_connector, endpoint, method, nth):
+    # The nth (endpoint, method) request fails, as a crash or a lost connection
+    request = api_connector.request
+    seen = []
+
+    def failing(name, verb, payload=None):
+        if (name, verb) == (endpoint, method):
+            seen.append(name)
+            if len(seen) == nth:
+                raise FakeRequestError("injected failure")
+        return request(name, verb, payload)
+
+    api_connector.request = failing
+
+
+@pytest.mark.parametrize("endpoint, method, nth", [
+    ("ipam.ip_addresses", "POST", 2),
+    ("dcim.devices", "PATCH", 2),
+    ("dcim.cables", "POST", 3),
+])
+def test_resume_after_failure(tmp_path, endpoint, method, nth):
+    clean = FakeNetBox()
+    run(clean)
+
+    api_connector = FakeNetBox()
+    fail_once(api_connector, endpoint, method, nth)
+    path = str(tmp_path / "journal.jsonl")
+    with pytest.raises((FakeRequestError, SystemExit)):
+        run(api_connector, "--journal", path)
+    assert api_connector.counts() != clean.counts()
+
+    run(api_connector, "--journal", path, "--resume")
+    assert api_connector.counts() == clean.counts()
+    devices = api_connector.endpoint("dcim.devices").records.values()
+    assert all(device.primary_ip4 for device in devices)
+
+
+def test_journal_of_another_run_is_not_reused(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    run(FakeNetBox(), "--journal", path)
+    with pytest.raises(SystemExit):
+        run(FakeNetBox(), "--journal", path)
+
+
+def test_replay_skips_a_cut_line(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    with Journal(path) as journal:
+        journal.create("dcim.sites", [("site-pod01", 1)])
+        journal.link("dcim.devices", ["1|vqfx1"])
+    with open(path, "a") as journal_file:
+        journal_file.write(json.dumps({"kind": "dcim.sites", "key": "site-pod02", "id": 2})[:20])
+    with Journal(path, resume=True) as journal:
+        assert journal.created["dcim.sites"] == {"site-pod01": 1}
+        assert journal.linked["dcim.devices"] == {"1|vqfx1"}
+
+
+def test_bulk_before_netbox_2_10():
+    # Pods and tier1 wiring, the primary IPs saved device by device
+    api_connector = FakeNetBox(version="2.8")
+    run(api_connector)
+    devices = api_connector.endpoint("dcim.devices").all()
+    assert all(device.primary_ip4 for device in devices)
+    assert api_connector.requests["dcim.devices", "PATCH"] == len(devices)
+    assert api_connector.counts()["dcim.cables"] > 0
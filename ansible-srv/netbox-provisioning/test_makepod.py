@@ -0,0 +1,76 @@
+from unittest import mock
+
+import pytest
+
+import makepod
+from fakenetbox import FakeNetBox
+
+ARGS = ["--netbox-url", "http://netbox.fake", "--netbox-token", "token"]
+
+
+def run(api_connector, *args):
+    with mock.patch.object(makepod, "connect", lambda *a, **kw: api_connector), \
+            mock.patch("sys.argv", ["makepod.py"] + ARGS + list(args)):
+        makepod.main()
+
+
+def test_bulk_several_pods_share_objects():
+    api_connector = FakeNetBox()
+    run(api_connector, "--id", "1", "2", "--bulk")
+    counts = api_connector.counts()
+    assert counts["dcim.device_roles"] == 1
+    assert counts["circuits.circuit_types"] == 1
+    assert counts["dcim.sites"] == 2
+    assert counts["dcim.devices"] == 2 * len(makepod.POD_SPECS.MODEL["devices"])
+
+    # A later run finds the shared objects of the first one
+    run(api_connector, "--id", "3", "--bulk")
+    assert api_connector.counts()["dcim.device_roles"] == 1
+    assert api_connector.counts()["dcim.sites"] == 3
+
+
+def test_bulk_before_netbox_2_10():
+    # The primary IPs are saved device by device, no bulk PATCH
+    api_connector = FakeNetBox(version="2.8")
+    run(api_connector, "--id", "1", "2", "--bulk")
+    devices = api_connector.endpoint("dcim.devices").all()
+    assert len(devices) == 2 * len(makepod.POD_SPECS.MODEL["devices"])
+    assert all(device.primary_ip4 and device.primary_ip6 for device in devices)
+    assert api_connector.requests["dcim.devices", "PATCH"] == len(devices)
+
+
+@pytest.mark.parametrize("version, patches", [("2.8", None), ("2.10", 1)])
+def test_serial_primary_ips(version, patches):
+    # One bulk PATCH from NetBox 2.10, one per device before
+    api_connector = FakeNetBox(version=version)
+    run(api_connector, "--id", "1")
+    devices = api_connector.endpoint("dcim.devices").all()
+    assert all(device.primary_ip4 and device.primary_ip6 for device in devices)
+    assert api_connector.requests["dcim.devices", "PATCH"] == (patches or len(devices))
+
+
+def test_serial_rejects_several_pods():
+    with pytest.raises(SystemExit):
+        run(FakeNetBox(), "--id", "1", "2")
+
+
+def test_plan_counts_the_bulk_calls(tmp_path, capsys):
+    api_connector = FakeNetBox()
+    run(api_connector, "--id", "1", "2", "3", "--bulk")
+    writes = sum(
+        count for (_, method), count in api_connector.requests.items()
+        if method in ("POST", "PATCH")
+    )
+    run(None, "--id", "1", "2", "3", "--plan", str(tmp_path / "plan.json"))
+    assert capsys.readouterr().out.splitlines()[-1].endswith(", {} bulk".format(writes))
+
+
+def test_bulk_calls_in_batches():
+    graph = makepod.pod_graph(1)
+    api_connector = FakeNetBox()
+    _, report = makepod.apply(api_connector, graph, batch_size=4)
+    assert report["create"] == sum(graph.counts().values())
+    requests = api_connector.requests
+    posts = sum(count for (_, method), count in requests.items() if method == "POST")
+    assert posts == sum(-(-count // 4) for count in graph.counts().values())
+    assert graph.expected_calls(batch_size=4)["bulk"] == posts + requests["dcim.devices", "PATCH"]
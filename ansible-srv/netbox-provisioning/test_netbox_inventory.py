@@ -0,0 +1,101 @@
+import datetime
+from unittest import mock
+
+import pytest
+
+import makepod
+import netbox_inventory
+from fakenetbox import FakeNetBox
+
+
+def get_requests(api_connector):
+    return sum(count for (_, method), count in api_connector.requests.items() if method == "GET")
+
+
+def change(api_connector, kind, object_id, **data):
+    # A changelog entry, as NetBox records it when an object is saved
+    return api_connector.endpoint("extras.object_changes").create_one({
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "changed_object_type": kind,
+        "changed_object_id": object_id,
+        "object_data": data,
+    })
+
+
+@pytest.fixture
+def lab(tmp_path):
+    api_connector = FakeNetBox()
+    makepod.make_pod(1, api_connector)
+    options = {
+        "url": "http://netbox.fake",
+        "token": "token",
+        "device_role": makepod.POD_SPECS.DEVICE_ROLE,
+        "tenant": None,
+        "cache_path": str(tmp_path / "inventory.json"),
+        "cache_ttl": 300,
+        "full_refresh": 86400,
+    }
+    with mock.patch.object(netbox_inventory, "connect", lambda *a, **kw: api_connector):
+        yield api_connector, options
+
+
+def test_host_variables(lab):
+    api_connector, options = lab
+    hostvars = netbox_inventory.get_inventory(options)["_meta"]["hostvars"]
+    assert sorted(hostvars) == ["veos3", "veos4", "vqfx1", "vqfx2"]
+    vqfx1 = hostvars["vqfx1"]
+    assert vqfx1["device_name"] == "vqfx1"
+    # No management interface in NetBox, the loopbacks are not reachable yet
+    assert "ansible_host" not in vqfx1
+    assert "mgmt_ip" not in vqfx1
+
+
+def test_cache_within_ttl(lab):
+    api_connector, options = lab
+    inventory = netbox_inventory.get_inventory(options)
+    requests = get_requests(api_connector)
+    assert netbox_inventory.get_inventory(options) == inventory
+    assert get_requests(api_connector) == requests
+
+    # --refresh ignores the cache
+    netbox_inventory.get_inventory(options, refresh=True)
+    assert get_requests(api_connector) > requests
+
+
+def test_expired_cache_applies_the_changelog(lab):
+    api_connector, options = lab
+    netbox_inventory.get_inventory(options)
+    options["cache_ttl"] = 0
+
+    # Nothing changed: only the changelog is read
+    requests = get_requests(api_connector)
+    netbox_inventory.get_inventory(options)
+    assert get_requests(api_connector) == requests + 1
+
+    site = api_connector.endpoint("dcim.sites").all()[0]
+    site.asn = 65999
+    change(api_connector, "dcim.site", site.id)
+    hostvars = netbox_inventory.get_inventory(options)["_meta"]["hostvars"]
+    assert {host["my_asn"] for host in hostvars.values()} == {65999}
+
+    # The change is not applied twice, its time is the new mark
+    requests = get_requests(api_connector)
+    netbox_inventory.get_inventory(options)
+    assert get_requests(api_connector) == requests + 1
+
+
+def test_full_rebuild(lab):
+    api_connector, options = lab
+    netbox_inventory.get_inventory(options)
+    options["cache_ttl"] = 0
+    build_cache = netbox_inventory.build_cache
+    with mock.patch.object(netbox_inventory, "build_cache", wraps=build_cache) as build:
+        role = api_connector.endpoint("dcim.device_roles").all()[0]
+        change(api_connector, "dcim.devicerole", role.id)
+        netbox_inventory.get_inventory(options)
+        assert build.call_count == 1
+
+        # Past full_refresh, the inventory is rebuilt whatever changed
+        options["full_refresh"] = -1
+        netbox_inventory.get_inventory(options)
+        assert build.call_count == 2
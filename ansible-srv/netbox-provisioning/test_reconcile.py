@@ -0,0 +1,52 @@
+import pytest
+
+import makepod
+from fakenetbox import FakeNetBox
+from reconcile import reconcile
+
+WRITES = ("POST", "PATCH", "DELETE")
+
+
+def writes(api_connector):
+    return sum(count for (_, method), count in api_connector.requests.items() if method in WRITES)
+
+
+# Before 2.10, the updates and deletes are sent record by record
+VERSIONS = pytest.mark.parametrize("version", ["2.8", "2.10"])
+
+
+@VERSIONS
+def test_second_run_makes_no_writes(version):
+    api_connector = FakeNetBox(version=version)
+    _, report = reconcile(api_connector, makepod.pod_graph(1))
+    assert report["create"] > 0
+    counts = api_connector.counts()
+
+    api_connector.requests.clear()
+    _, report = reconcile(api_connector, makepod.pod_graph(1))
+    assert writes(api_connector) == 0
+    assert sum(report.values()) == 0
+    assert api_connector.counts() == counts
+
+
+@VERSIONS
+def test_drift_is_repaired(version):
+    api_connector = FakeNetBox(version=version)
+    reconcile(api_connector, makepod.pod_graph(1))
+    counts = api_connector.counts()
+    sites = api_connector.endpoint("dcim.sites").records
+    site = next(iter(sites.values()))
+    site.description = "changed by hand"
+    cables = api_connector.endpoint("dcim.cables")
+    cables.delete_all([next(iter(cables.records))])
+
+    api_connector.requests.clear()
+    _, report = reconcile(api_connector, makepod.pod_graph(1))
+    assert report["update"] == 1 and report["create"] == 1
+    assert api_connector.counts() == counts
+    assert site.description == "The site of the 1th pod."
+
+    # Then nothing is left to do
+    api_connector.requests.clear()
+    reconcile(api_connector, makepod.pod_graph(1))
+    assert writes(api_connector) == 0
@@ -0,0 +1,41 @@
+import pytest
+
+import makepod
+import teardown
+from fakenetbox import FakeNetBox
+from podgraph import KINDS
+from reconcile import reconcile
+
+
+def deletes(api_connector):
+    return sum(count for (_, method), count in api_connector.requests.items() if method == "DELETE")
+
+
+@pytest.mark.parametrize("version, bulk", [("2.8", False), ("2.10", True)])
+def test_teardown_leaves_the_other_pod(version, bulk):
+    api_connector = FakeNetBox(version=version)
+    reconcile(api_connector, makepod.pod_graph(1))
+    pod = api_connector.counts()
+    reconcile(api_connector, makepod.pod_graph(2))
+    lab = api_connector.counts()
+
+    api_connector.requests.clear()
+    assert teardown.teardown_pods(api_connector, [2]) == {}
+    assert api_connector.counts() == pod
+    deleted = sum(lab[kind] - pod[kind] for kind in lab)
+    if bulk:
+        # One bulk DELETE per kind with records
+        assert deletes(api_connector) == sum(1 for kind in KINDS if lab.get(kind) != pod.get(kind))
+    else:
+        assert deletes(api_connector) == deleted
+
+
+def test_records_found_by_natural_key_are_kept():
+    api_connector = FakeNetBox()
+    reconcile(api_connector, makepod.pod_graph(1))
+    # The address of a pod 1 loopback, assigned to nothing
+    address = next(iter(api_connector.endpoint("ipam.ip_addresses").records.values())).address
+    api_connector.endpoint("ipam.ip_addresses").create_one({"address": address})
+
+    teardown.teardown_pods(api_connector, [1])
+    assert [ip.address for ip in api_connector.endpoint("ipam.ip_addresses").all()] == [address]
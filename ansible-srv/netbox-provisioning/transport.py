@@ -0,0 +1,90 @@
+import pynetbox
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRIES = 5
+# Seconds, doubled after every failed attempt
+BACKOFF = 0.5
+# Seconds to connect and then to wait for each response
+TIMEOUT = 30
+# Transient failures worth another attempt
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Sending these again cannot create an object twice
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE")
+# First NetBox version taking bulk PATCH and DELETE on the list endpoints
+BULK_WRITES_VERSION = (2, 10)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter applying a default timeout, pynetbox does not set one"""
+
+    def __init__(self, *args, **kwargs):
+        self.timeout = kwargs.pop("timeout", TIMEOUT)
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def retry_policy(retries=RETRIES, backoff=BACKOFF):
+    # Connection failures are retried for every method, the request was not
+    # sent. Read errors and retry statuses only for the idempotent methods,
+    # honouring Retry-After on 429 and 503.
+    options = dict(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    try:
+        return Retry(allowed_methods=IDEMPOTENT_METHODS, **options)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=IDEMPOTENT_METHODS, **options)
+
+
+def netbox_session(pool_size=1, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT):
+    """requests session with a pool of keep-alive connections and retries
+
+    The pool blocks at pool_size connections, workers wait for a free one
+    instead of opening and dropping extra connections.
+    """
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        pool_block=True,
+        max_retries=retry_policy(retries, backoff),
+        timeout=timeout,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        "Accept-Encoding": "gzip",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+def connect(url, token, workers=1, retries=RETRIES, timeout=TIMEOUT, **api_options):
+    """pynetbox.api with a session sized for workers parallel requests"""
+    api_connector = pynetbox.api(url=url, token=token, **api_options)
+    api_connector.http_session = netbox_session(
+        pool_size=max(workers, 1), retries=retries, timeout=timeout
+    )
+    return api_connector
+
+
+def api_version(api_connector):
+    """NetBox version as a tuple, (2, 10) for "2.10", () when unknown"""
+    try:
+        return tuple(int(part) for part in str(api_connector.version).split("."))
+    except ValueError:
+        return ()
+
+
+def bulk_writes(api_connector):
+    return api_version(api_connector) >= BULK_WRITES_VERSION
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from jinja2 import meta
+
+# Part of every key, bumped when the key or the rendering changes
+VERSION = 2
+
+# Variables whose value is the whole inventory, a function or the time of
+# the run: a template using them is always rendered
+UNCACHEABLE = {
+    "hostvars", "groups", "vars", "lookup", "query", "q", "now",
+    "ansible_managed", "template_run_date", "template_mtime", "template_uid",
+}
+
+# Stands for a referenced variable that is not defined
+UNDEFINED = {"__undefined__": True}
+
+# Names of the files rendered by the current run, one per line, kept in
+# their directory. The CleanUp plays empty it, the parts not listed there
+# at assemble time are removed.
+MANIFEST = ".rendered"
+
+
+def referenced_vars(environment, source):
+    """Names a template reads from its context"""
+    return meta.find_undeclared_variables(environment.parse(source))
+
+
+def encode_value(value):
+    """JSON of a variable value, as hashed in the keys"""
+    return json.dumps(value, sort_keys=True, default=str).encode()
+
+
+def render_key(name, source, values, encoded=None):
+    """Key of a template rendered with the values of its variables
+
+    encoded holds the encode_value() of some of the values, by name, for
+    callers rendering many hosts sharing them.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([VERSION, name]).encode())
+    digest.update(source.encode())
+    for var in sorted(values):
+        digest.update(json.dumps(var).encode())
+        if encoded and var in encoded:
+            digest.update(encoded[var])
+        else:
+            digest.update(encode_value(values[var]))
+    return digest.hexdigest()
+
+
+def write_if_changed(path, content, dry_run=False):
+    # Atomic replace, only when the content differs: unchanged files keep
+    # their mtime
+    try:
+        with open(path, "rb") as current:
+            if current.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    if dry_run:
+        return True
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def record_rendered(path):
+    """Add a rendered file to the manifest of its directory"""
+    manifest = os.path.join(os.path.dirname(path), MANIFEST)
+    with open(manifest, "a") as manifest_file:
+        manifest_file.write(os.path.basename(path) + "\n")
+
+
+class RenderCache(object):
+    """Rendered templates stored by key under path"""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.file(key), "rb") as cached:
+                return cached.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, content):
+        path = self.file(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_if_changed(path, content)
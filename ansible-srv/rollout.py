@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+from config_diff import delta_config, guess_syntax
+from render_cache import write_if_changed
+from verify_reachability import (
+    BATCH_SIZE, NapalmSession, expected_checks, load_hosts, verify
+)
+
+# Hosts per wave: a canary, then bigger waves, the last size repeated
+WAVES = [1, 4, 16, 64]
+# Device sessions working at once within a wave
+SESSIONS = 16
+# Minutes before a device reverts a commit that is not confirmed, the
+# last seconds of it kept for the confirm itself
+CONFIRM_MINUTES = 5
+CONFIRM_MARGIN = 30
+# Health gate: wait after the commits, then retry until the timeout
+SETTLE = 10
+GATE_TIMEOUT = 120
+GATE_INTERVAL = 10
+# Problems reported per failed wave
+MAX_PROBLEMS = 20
+
+
+def parse_cli_args(script_args):
+    parser = argparse.ArgumentParser(
+        description="Push the assembled configs in waves, each one commit confirmed "
+                    "and confirmed only once its health gate passed"
+    )
+    parser.add_argument(
+        '-i', '--inventory', required=True, action='store',
+        help="Inventory script, its JSON output or an INI file"
+    )
+    parser.add_argument(
+        '-e', '--extra-vars', action='append', default=[], metavar='FILE',
+        help="YAML file of variables overriding the others, e.g. the credentials"
+    )
+    parser.add_argument(
+        '-l', '--limit', nargs='+', action='store',
+        help="Only push to these hosts"
+    )
+    parser.add_argument(
+        '-w', '--waves', nargs='+', type=int, default=WAVES, action='store',
+        help="Hosts per wave, the last size is repeated"
+    )
+    parser.add_argument(
+        '-s', '--sessions', type=int, default=SESSIONS, action='store',
+        help="Device sessions working at once within a wave"
+    )
+    parser.add_argument(
+        '--confirm-minutes', type=int, default=CONFIRM_MINUTES, action='store',
+        help="Minutes before a device reverts a commit of the rollout not yet confirmed"
+    )
+    parser.add_argument(
+        '--settle', type=float, default=SETTLE, action='store',
+        help="Seconds to wait after the commits of a wave before its gate"
+    )
+    parser.add_argument(
+        '--gate-timeout', type=float, default=GATE_TIMEOUT, action='store',
+        help="Seconds to retry the gate of a wave before rolling it back"
+    )
+    parser.add_argument(
+        '--deployed-dir', action='store',
+        help="Configs last confirmed, per host: only the changes from them are pushed"
+    )
+    parser.add_argument(
+        '--fake', action='store_true',
+        help="Push to a simulated lab built from the inventory, see fakedevice.py"
+    )
+
+    args = parser.parse_args(script_args)
+    if args.settle + args.gate_timeout + CONFIRM_MARGIN >= args.confirm_minutes * 60:
+        parser.error(
+            "--settle and --gate-timeout must end {}s before the --confirm-minutes "
+            "timer".format(CONFIRM_MARGIN)
+        )
+    return args
+
+
+class RolloutError(Exception):
+    """A failed wave and what became of its committed hosts"""
+
+    def __init__(self, message, rolled_back=(), confirmed=(), reverting=()):
+        super(RolloutError, self).__init__(message)
+        self.rolled_back = set(rolled_back)
+        self.confirmed = set(confirmed)
+        # Left to the device, reverting when its confirm timer expires
+        self.reverting = set(reverting)
+
+
+class NapalmDevice(NapalmSession):
+    """NAPALM session able to replace the config with a commit confirmed"""
+
+    def load_config(self, content, merge=False):
+        # A delta is merged: on Junos its delete: tags apply, it has no replace:
+        if merge:
+            self.device.load_merge_candidate(config=content)
+        else:
+            self.device.load_replace_candidate(config=content)
+
+    def commit_confirmed(self, minutes):
+        self.device.commit_config(revert_in=minutes * 60)
+
+    def confirm(self):
+        self.device.confirm_commit()
+
+    def rollback(self):
+        self.device.rollback()
+
+    def bgp_down(self):
+        """Peers of every VRF whose session is not up"""
+        return [
+            peer
+            for vrf in self.device.get_bgp_neighbors().values()
+            for peer, state in vrf.get("peers", {}).items()
+            if not state.get("is_up")
+        ]
+
+
+class KeptOpen(object):
+    # A wave session lent to verify(), which opens and closes its sessions
+    def __init__(self, session):
+        self.session = session
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def ping(self, checks):
+        return self.session.ping(checks)
+
+
+def waves(hosts, sizes):
+    """Split hosts into waves of the given sizes, the last size repeated"""
+    hosts = list(hosts)
+    result = []
+    i = 0
+    while hosts[i:]:
+        size = sizes[min(len(result), len(sizes) - 1)]
+        result.append(hosts[i:i + size])
+        i += size
+    return result
+
+
+def config_path(variables):
+    # Where the assemble play and compile_configs.py put the config
+    return os.path.join(
+        os.path.expanduser(variables["config_dir"]), "{}.conf".format(variables["ansible_host"])
+    )
+
+
+def deployed_path(variables, deployed_dir):
+    return os.path.join(deployed_dir, "{}.conf".format(variables["ansible_host"]))
+
+
+def run_all(executor, function, items):
+    """function over items on the executor: item -> error, None when it worked"""
+    futures = {item: executor.submit(function, item) for item in items}
+    errors = {}
+    for item, future in futures.items():
+        try:
+            future.result()
+            errors[item] = None
+        except Exception as exc:
+            errors[item] = "{}: {}".format(type(exc).__name__, exc)
+    return errors
+
+
+def health_gate(hostvars, wave, sessions, sessions_count):
+    """Problems of the wave: unreachable addresses and BGP peers down"""
+    problems = []
+    checks = expected_checks(hostvars, wave)
+
+    def connect(host, variables):
+        return KeptOpen(sessions[host])
+
+    for check, passed, error in verify(hostvars, checks, connect, sessions_count, BATCH_SIZE):
+        if not passed:
+            problems.append("{}: {} -> {} unreachable{}".format(
+                check.host, check.source, check.dest, " ({})".format(error) if error else ""
+            ))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=sessions_count) as executor:
+        futures = {host: executor.submit(sessions[host].bgp_down) for host in wave}
+        for host, future in futures.items():
+            try:
+                down = future.result()
+            except Exception as exc:
+                down = ["{}: {}".format(type(exc).__name__, exc)]
+            problems.extend("{}: BGP {} down".format(host, peer) for peer in down)
+    return problems
+
+
+def summarize(problems):
+    if len(problems) > MAX_PROBLEMS:
+        more = len(problems) - MAX_PROBLEMS
+        problems = problems[:MAX_PROBLEMS] + ["... {} more".format(more)]
+    return "\n".join(problems)
+
+
+def rollout_wave(hostvars, wave, connect, args):
+    """Push, gate then confirm one wave, rolled back when failing before the confirm
+
+    The session of each host stays open from its commit to its confirm,
+    the devices are worked on by at most args["sessions"] threads. With
+    args["deployed_dir"], hosts get the delta from their deployed config,
+    and none when it did not change. Returns the hosts committed. A failed
+    confirm rolls nothing back: the other hosts stay confirmed and the
+    failed ones revert on their timer, the RolloutError tells which. Hosts
+    left with less than CONFIRM_MARGIN of their timer are not confirmed
+    but left to revert, and the wave rolled back like a failed gate.
+    """
+    sessions = {}
+    configs = {}
+    committed = set()
+    # Host -> time.monotonic() before its commit, the timer started after
+    committed_at = {}
+    deployed_dir = args.get('deployed_dir')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args['sessions']) as executor:
+        def push(host):
+            variables = hostvars[host]
+            with open(config_path(variables)) as config_file:
+                content = configs[host] = config_file.read()
+            merge = False
+            if deployed_dir and os.path.exists(deployed_path(variables, deployed_dir)):
+                with open(deployed_path(variables, deployed_dir)) as deployed_file:
+                    deployed = deployed_file.read()
+                syntax = variables.get("ansible_network_os") or guess_syntax(content)
+                content = delta_config(deployed, content, syntax)
+                merge = True
+            # Opened even without changes, the health gate pings over it
+            session = connect(host, variables)
+            session.open()
+            sessions[host] = session
+            if content:
+                session.load_config(content, merge)
+                started = time.monotonic()
+                session.commit_confirmed(args['confirm_minutes'])
+                committed_at[host] = started
+                committed.add(host)
+
+        try:
+            errors = run_all(executor, push, wave)
+            problems = [
+                "{}: {}".format(host, error) for host, error in errors.items() if error
+            ]
+            if not problems:
+                time.sleep(args['settle'])
+                deadline = time.monotonic() + args['gate_timeout']
+                while True:
+                    problems = health_gate(hostvars, wave, sessions, args['sessions'])
+                    if not problems or time.monotonic() >= deadline:
+                        break
+                    time.sleep(GATE_INTERVAL)
+            late = set()
+            if not problems:
+                window = args['confirm_minutes'] * 60 - CONFIRM_MARGIN
+                late = {
+                    host for host in committed if time.monotonic() - committed_at[host] >= window
+                }
+                problems = [
+                    "{}: confirm window over, reverting on its timer".format(host)
+                    for host in sorted(late)
+                ]
+            if problems:
+                # Hosts not committed have nothing to roll back, the late ones
+                # may have reverted already
+                reverting = set(late)
+                for host, error in run_all(
+                    executor, lambda host: sessions[host].rollback(), committed - late
+                ).items():
+                    if error:
+                        reverting.add(host)
+                        problems.append("{}: rollback failed, {}".format(host, error))
+                raise RolloutError(
+                    summarize(problems), rolled_back=committed - reverting, reverting=reverting
+                )
+            # The device reverts by itself when the timer expires
+            reverting = {
+                host: error for host, error in run_all(
+                    executor, lambda host: sessions[host].confirm(), committed
+                ).items() if error
+            }
+            confirmed = committed - set(reverting)
+            if deployed_dir:
+                os.makedirs(deployed_dir, exist_ok=True)
+                for host in confirmed:
+                    write_if_changed(
+                        deployed_path(hostvars[host], deployed_dir), configs[host].encode()
+                    )
+            if reverting:
+                raise RolloutError(
+                    summarize([
+                        "{}: confirm failed, {}".format(host, error)
+                        for host, error in sorted(reverting.items())
+                    ]),
+                    confirmed=confirmed, reverting=reverting
+                )
+            return committed
+        finally:
+            for session in sessions.values():
+                session.close()
+
+
+def rollout(hostvars, hosts, connect, args, log=print):
+    """Roll the hosts out wave by wave, stopping at the first failed wave"""
+    plan = waves(sorted(hosts), args['waves'])
+    for number, wave in enumerate(plan, 1):
+        started = time.monotonic()
+        try:
+            committed = rollout_wave(hostvars, wave, connect, args)
+        except RolloutError as exc:
+            outcome = [
+                "{} host(s) {}".format(len(members), state)
+                for members, state in (
+                    (exc.rolled_back, "rolled back"),
+                    (exc.confirmed, "confirmed"),
+                    (exc.reverting, "reverting on their confirm timer"),
+                ) if members
+            ]
+            log("wave {}/{}: {}".format(
+                number, len(plan), ", ".join(outcome) or "nothing committed"
+            ))
+            raise RolloutError(
+                "wave {}/{} failed:\n{}".format(number, len(plan), exc),
+                exc.rolled_back, exc.confirmed, exc.reverting
+            )
+        log("wave {}/{}: {} host(s) confirmed, {} unchanged ({:.1f}s)".format(
+            number, len(plan), len(committed), len(wave) - len(committed),
+            time.monotonic() - started
+        ))
+
+
+def main():
+    args = vars(parse_cli_args(sys.argv[1:]))
+
+    hostvars = load_hosts(args['inventory'], args['extra_vars'])
+    hosts = [host for host in hostvars if not args['limit'] or host in args['limit']]
+    if args['fake']:
+        from fakedevice import FakeNetwork
+        connect = FakeNetwork(hostvars).session
+    else:
+        connect = NapalmDevice
+
+    try:
+        rollout(hostvars, hosts, connect, args)
+    except RolloutError as exc:
+        sys.exit(str(exc))
+
+
+if __name__ == '__main__':
+    main()
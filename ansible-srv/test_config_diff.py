@@ -0,0 +1,147 @@
+from config_diff import delta_config
+
+NEIGHBOR = """protocols {
+  bgp {
+    group transit {
+      neighbor 192.0.2.1 {
+        description "to transit";
+        peer-as 100;
+      }
+    }
+  }
+}
+"""
+
+
+def test_removed_leaf_is_deleted():
+    new = NEIGHBOR.replace('        description "to transit";\n', "")
+    assert delta_config(NEIGHBOR, new, "junos") == (
+        "protocols {\n"
+        "  bgp {\n"
+        "    group transit {\n"
+        "      neighbor 192.0.2.1 {\n"
+        '        delete: description "to transit";\n'
+        "      }\n"
+        "    }\n"
+        "  }\n"
+        "}\n"
+    )
+
+
+def test_replace_tag_is_not_relied_on():
+    # The delta is merged: the removed statement is deleted explicitly
+    new = NEIGHBOR.replace("neighbor 192.0.2.1 {", "replace: neighbor 192.0.2.1 {")
+    new = new.replace('        description "to transit";\n', "")
+    delta = delta_config(NEIGHBOR, new, "junos")
+    assert "replace:" not in delta
+    assert 'delete: description "to transit";' in delta
+
+
+def test_leaf_becomes_block():
+    old = "system {\n  syslog;\n}\n"
+    new = "system {\n  syslog {\n    file messages;\n  }\n}\n"
+    assert delta_config(old, new, "junos") == (
+        "system {\n"
+        "  delete: syslog;\n"
+        "  syslog {\n"
+        "    file messages;\n"
+        "  }\n"
+        "}\n"
+    )
+
+
+def test_reordered_terms_are_deleted_then_added():
+    old = (
+        "policy-options {\n"
+        "  policy-statement export {\n"
+        "    term a {\n      then accept;\n    }\n"
+        "    term b {\n      then reject;\n    }\n"
+        "  }\n"
+        "}\n"
+    )
+    new = (
+        "policy-options {\n"
+        "  policy-statement export {\n"
+        "    term b {\n      then reject;\n    }\n"
+        "    term a {\n      then accept;\n    }\n"
+        "  }\n"
+        "}\n"
+    )
+    assert delta_config(old, new, "junos") == (
+        "policy-options {\n"
+        "  delete: policy-statement export;\n"
+        "  policy-statement export {\n"
+        "    term b {\n      then reject;\n    }\n"
+        "    term a {\n      then accept;\n    }\n"
+        "  }\n"
+        "}\n"
+    )
+
+
+def test_added_term_at_the_end_is_merged():
+    old = "policy-options {\n  policy-statement export {\n    term a {\n      then accept;\n    }\n  }\n}\n"
+    new = old.replace("    }\n  }\n}\n", "    }\n    term b {\n      then reject;\n    }\n  }\n}\n")
+    delta = delta_config(old, new, "junos")
+    assert "delete:" not in delta
+    assert "term b {" in delta and "term a" not in delta
+
+
+def test_unchanged_is_empty():
+    assert delta_config(NEIGHBOR, NEIGHBOR, "junos") == ""
+
+
+def test_eos_address_family_submode():
+    old = (
+        "router bgp 65000\n"
+        "   neighbor 192.0.2.1 remote-as 100\n"
+        "   !\n"
+        "   address-family ipv4\n"
+        "      neighbor 192.0.2.1 activate\n"
+        "      network 10.0.0.0/24\n"
+        "   !\n"
+        "   address-family ipv6\n"
+        "      neighbor 192.0.2.1 activate\n"
+    )
+    new = old.replace("      network 10.0.0.0/24\n", "      network 10.0.1.0/24\n")
+    assert delta_config(old, new, "eos") == (
+        "router bgp 65000\n"
+        "   address-family ipv4\n"
+        "      no network 10.0.0.0/24\n"
+        "      network 10.0.1.0/24\n"
+    )
+
+
+def test_eos_removed_negation_is_not_negated_again():
+    old = (
+        "interface Ethernet1\n"
+        "   no switchport\n"
+        "   no shutdown\n"
+        "   ip address 10.0.0.1/31\n"
+    )
+    new = old.replace("   no switchport\n", "")
+    assert delta_config(old, new, "eos") == (
+        "interface Ethernet1\n"
+        "   switchport\n"
+    )
+
+
+def test_junos_comment_is_not_cut_in_quotes():
+    old = NEIGHBOR.replace('"to transit";', '"core ## spare"; ## SECRET-DATA')
+    new = NEIGHBOR.replace('"to transit";', '"core ## spare 2";')
+    assert 'description "core ## spare 2";' in delta_config(old, new, "junos")
+    assert delta_config(old, old.replace(" ## SECRET-DATA", ""), "junos") == ""
+
+
+def test_eos_skips_whole_exit_and_end_lines_only():
+    old = (
+        "monitor connectivity\n"
+        "   endpoint 192.0.2.1\n"
+        "   exit\n"
+        "end\n"
+    )
+    new = old.replace("192.0.2.1", "192.0.2.2")
+    assert delta_config(old, new, "eos") == (
+        "monitor connectivity\n"
+        "   no endpoint 192.0.2.1\n"
+        "   endpoint 192.0.2.2\n"
+    )
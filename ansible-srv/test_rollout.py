@@ -0,0 +1,126 @@
+import pytest
+
+import rollout
+from fakedevice import FakeNetwork
+
+HOSTS = ["r{}".format(n) for n in range(1, 8)]
+CONFIG = "protocols {\n  bgp {\n    group ibgp {\n      local-address 10.255.0.%d;\n    }\n  }\n}\n"
+
+
+@pytest.fixture
+def hostvars(tmp_path):
+    # A ring of Junos routers, their configs in tmp_path
+    hostvars = {}
+    for n, host in enumerate(HOSTS, 1):
+        hostvars[host] = {
+            "ansible_host": host,
+            "ansible_network_os": "junos",
+            "config_dir": str(tmp_path),
+            "igp": {
+                "loopbacks": {"ipv4": {"local_ip": "10.255.0.{}".format(n), "netmask": 32}},
+                "neighbors": [],
+            },
+        }
+        (tmp_path / "{}.conf".format(host)).write_text(CONFIG % n)
+    for n, host in enumerate(HOSTS, 1):
+        peer = HOSTS[n % len(HOSTS)]
+        local, remote = "10.0.{}.0".format(n), "10.0.{}.1".format(n)
+        hostvars[host]["igp"]["neighbors"].append({
+            "peer": peer, "ipv4": {"local_ip": local, "netmask": 31, "peer_ip": remote},
+        })
+        hostvars[peer]["igp"]["neighbors"].append({
+            "peer": host, "ipv4": {"local_ip": remote, "netmask": 31, "peer_ip": local},
+        })
+    return hostvars
+
+
+def args(**overrides):
+    return dict(dict(
+        sessions=2, confirm_minutes=5, settle=0, gate_timeout=0, waves=[1, 2, 4],
+        deployed_dir=None,
+    ), **overrides)
+
+
+def test_every_wave_confirmed(hostvars):
+    network = FakeNetwork(hostvars)
+    rollout.rollout(hostvars, HOSTS, network.session, args(), log=lambda line: None)
+    assert network.states == {host: "confirmed" for host in HOSTS}
+    # The sessions of a wave stay open until it is confirmed
+    assert network.max_open <= 4
+
+
+def test_failed_gate_rolls_the_wave_back(hostvars):
+    # Waves: r1, then r2 r3, then r4 to r7
+    network = FakeNetwork(hostvars, broken={"r3"})
+    with pytest.raises(rollout.RolloutError) as failure:
+        rollout.rollout(hostvars, HOSTS, network.session, args(), log=lambda line: None)
+    assert str(failure.value).startswith("wave 2/3 failed")
+    assert network.states == {"r1": "confirmed", "r2": "rolled back", "r3": "rolled back"}
+    assert failure.value.rolled_back == {"r2", "r3"}
+    assert network.open_now == 0
+
+
+def test_failed_confirm_is_not_reported_as_rolled_back(hostvars):
+    network = FakeNetwork(hostvars)
+    session = network.session
+
+    def connect(host, variables):
+        device = session(host, variables)
+        if host == "r3":
+            def confirm():
+                raise IOError("connection lost")
+            device.confirm = confirm
+        return device
+
+    lines = []
+    with pytest.raises(rollout.RolloutError) as failure:
+        rollout.rollout(hostvars, HOSTS, connect, args(), log=lines.append)
+    assert failure.value.confirmed == {"r2"} and failure.value.reverting == {"r3"}
+    assert not failure.value.rolled_back
+    assert lines[-1] == "wave 2/3: 1 host(s) confirmed, 1 host(s) reverting on their confirm timer"
+    assert network.states == {"r1": "confirmed", "r2": "confirmed", "r3": "pending"}
+
+
+def test_deployed_configs_get_a_delta(hostvars, tmp_path):
+    deployed_dir = str(tmp_path / "deployed")
+    network = FakeNetwork(hostvars)
+    rollout.rollout(hostvars, HOSTS, network.session, args(deployed_dir=deployed_dir),
+                    log=lambda line: None)
+    assert all(not merge for _, merge in network.configs.values())
+
+    # Unchanged: nothing committed
+    network = FakeNetwork(hostvars)
+    rollout.rollout(hostvars, HOSTS, network.session, args(deployed_dir=deployed_dir),
+                    log=lambda line: None)
+    assert network.configs == {}
+
+    (tmp_path / "r5.conf").write_text(CONFIG % 50)
+    network = FakeNetwork(hostvars)
+    rollout.rollout(hostvars, HOSTS, network.session, args(deployed_dir=deployed_dir),
+                    log=lambda line: None)
+    assert list(network.configs) == ["r5"]
+    delta, merge = network.configs["r5"]
+    assert merge
+    assert "delete: local-address 10.255.0.5;" in delta and "local-address 10.255.0.50;" in delta
+
+
+def test_late_hosts_are_not_confirmed(hostvars, monkeypatch):
+    # The whole timer is the margin: the gate passes too late
+    monkeypatch.setattr(rollout, "CONFIRM_MARGIN", 60)
+    network = FakeNetwork(hostvars)
+    with pytest.raises(rollout.RolloutError) as failure:
+        rollout.rollout(hostvars, HOSTS, network.session, args(confirm_minutes=1),
+                        log=lambda line: None)
+    assert "r1: confirm window over" in str(failure.value)
+    assert failure.value.reverting == {"r1"} and not failure.value.confirmed
+    assert network.states == {"r1": "pending"}
+
+
+@pytest.mark.parametrize("options", [
+    ["--confirm-minutes", "1", "--gate-timeout", "50"],
+    ["--confirm-minutes", "2", "--settle", "60", "--gate-timeout", "60"],
+])
+def test_gate_must_end_before_the_confirm_timer(options):
+    with pytest.raises(SystemExit):
+        rollout.parse_cli_args(["-i", "hosts"] + options)
+    assert rollout.parse_cli_args(["-i", "hosts"]).confirm_minutes == rollout.CONFIRM_MINUTES
@@ -0,0 +1,96 @@
+from fakedevice import FakeNetwork
+from verify_reachability import Check, NapalmSession, expected_checks, unchecked_hosts, verify
+
+
+def router(n, neighbors=(), transit=()):
+    return {
+        "igp": {
+            "loopbacks": {
+                "ipv4": {"local_ip": "10.255.0.{}".format(n), "netmask": 32},
+                "ipv6": {"local_ip": "fd00:255::{}".format(n), "netmask": 128},
+            },
+            "neighbors": [
+                {"peer": peer, "ipv4": {"local_ip": local, "netmask": 31}}
+                for peer, local in neighbors
+            ],
+        },
+        "transit_interfaces": [
+            {"peer_name": peer, "ipv4": {"local_ip": local, "netmask": 31}}
+            for peer, local in transit
+        ],
+    }
+
+
+# Two pods of two routers, the second one with a transit link to a tier1
+HOSTVARS = {
+    "pod1-r1": router(1, [("r2", "10.0.1.0")]),
+    "pod1-r2": router(2, [("r1", "10.0.1.1")]),
+    "pod2-r1": router(3, [("r2", "10.0.2.0")], [("tier1", "10.99.0.1")]),
+    "pod2-r2": router(4, [("r1", "10.0.2.1")]),
+    "tier1": router(5, transit=[("pod2", "10.99.0.0")]),
+}
+
+
+def loopback_targets(checks, host):
+    return {check.target for check in checks if check.host == host and check.kind == "loopback"}
+
+
+def test_loopbacks_of_the_same_pod_and_transit_peers():
+    checks = expected_checks(HOSTVARS)
+    assert loopback_targets(checks, "pod1-r1") == {"pod1-r2"}
+    assert loopback_targets(checks, "pod2-r1") == {"pod2-r2", "tier1"}
+    assert loopback_targets(checks, "pod2-r2") == {"pod2-r1"}
+    assert loopback_targets(checks, "tier1") == {"pod2-r1"}
+    # Both address families
+    assert len([check for check in checks if check.host == "pod1-r1"]) == 1 + 2
+
+
+def test_isolated_pods_pass():
+    results = verify(HOSTVARS, expected_checks(HOSTVARS), FakeNetwork(HOSTVARS).session)
+    assert all(passed for _, passed, _ in results)
+
+
+def test_hosts_without_igp_data_are_unchecked():
+    # As the static inventory: no igp variables at all
+    hostvars = dict(HOSTVARS, r9={"mgmt_ip": "192.168.100.20"})
+    checks = expected_checks(hostvars)
+    assert unchecked_hosts(hostvars, checks) == ["r9"]
+    assert unchecked_hosts(hostvars, checks, limit=["pod1-r1"]) == []
+    assert expected_checks({"r9": hostvars["r9"]}) == []
+
+
+class FakeDevice(object):
+    def __init__(self):
+        self.commands = []
+
+    def cli(self, commands):
+        self.commands.extend(commands)
+        return {command: "3 packets transmitted, 3 received, 0% packet loss" for command in commands}
+
+
+def session(network_os):
+    # Without napalm: only the command building is tested
+    napalm_session = NapalmSession.__new__(NapalmSession)
+    napalm_session.network_os = network_os
+    napalm_session.count = 3
+    napalm_session.device = FakeDevice()
+    return napalm_session
+
+
+def test_ping_commands():
+    checks = [
+        Check("r1", "r2", "interco", "10.0.1.1", "10.0.1.0", 1),
+        Check("r1", "r2", "loopback", "fd00:255::2", "fd00:255::1", None),
+    ]
+    eos = session("eos")
+    assert eos.ping(checks) == [True, True]
+    assert eos.device.commands == [
+        "ping 10.0.1.1 source 10.0.1.0 repeat 3",
+        "ping ipv6 fd00:255::2 source fd00:255::1 repeat 3",
+    ]
+    junos = session("junos")
+    junos.ping(checks)
+    assert junos.device.commands == [
+        "ping 10.0.1.1 source 10.0.1.0 count 3 rapid ttl 1",
+        "ping fd00:255::2 source fd00:255::1 count 3 rapid",
+    ]
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import re
+import sys
+
+from compile_configs import (
+    build_hosts, host_variables, init_worker, load_inventory, load_vars_file, resolve
+)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, "netbox-provisioning"))
+from peer_enrichment import PeerIPError, compute_peer_ip  # noqa: E402
+
+# Device sessions open at once, at most
+SESSIONS = 16
+# Pings per CLI call of a session
+BATCH_SIZE = 50
+PING_COUNT = 3
+# ansible_network_os -> ping command, ttl only where the CLI has it
+PING_COMMANDS = {
+    "junos": "ping {dest} source {source} count {count} rapid{ttl}",
+    "eos": "ping {dest} source {source} repeat {count}",
+}
+# IPv6 pings, where the CLI needs its own form
+PING6_COMMANDS = {
+    "eos": "ping ipv6 {dest} source {source} repeat {count}",
+}
+PACKET_LOSS = re.compile(r"([\d.]+)% packet loss")
+
+# One ping expected to succeed: from host to target, which owns dest
+Check = collections.namedtuple("Check", ["host", "target", "kind", "dest", "source", "ttl"])
+
+
+def parse_cli_args(script_args):
+    parser = argparse.ArgumentParser(
+        description="Ping every interco peer and the loopbacks of each pod, one session per device"
+    )
+    parser.add_argument(
+        '-i', '--inventory', required=True, action='store',
+        help="Inventory script, its JSON output or an INI file"
+    )
+    parser.add_argument(
+        '-e', '--extra-vars', action='append', default=[], metavar='FILE',
+        help="YAML file of variables overriding the others, e.g. the credentials"
+    )
+    parser.add_argument(
+        '-l', '--limit', nargs='+', action='store',
+        help="Only ping from these hosts"
+    )
+    parser.add_argument(
+        '-s', '--sessions', type=int, default=SESSIONS, action='store',
+        help="Device sessions open at once"
+    )
+    parser.add_argument(
+        '-c', '--count', type=int, default=PING_COUNT, action='store',
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=BATCH_SIZE, action='store',
+        help="Pings sent per CLI call"
+    )
+    parser.add_argument(
+        '--json', action='store_true',
+        help="Print the matrix as JSON"
+    )
+    parser.add_argument(
+        '--fake', action='store_true',
+        help="Ping a simulated lab built from the inventory, see fakedevice.py"
+    )
+
+    return parser.parse_args(script_args)
+
+
+def load_hosts(path, extra_files=()):
+    """Resolved variables of every host of the inventory"""
+    extra_vars = {}
+    for extra_file in extra_files:
+        extra_vars.update(load_vars_file(extra_file))
+    layers, items = build_hosts(load_inventory(path))
+    init_worker({}, layers, extra_vars, None, None)
+    hostvars = {}
+    for host, groups, own in items:
+        variables, _ = host_variables(layers, extra_vars, host, groups, own)
+        hostvars[host] = resolve(variables, variables)
+    return hostvars
+
+
+def peer_address(address):
+    # The other end of a link, None when it cannot be told
+    try:
+        return address.get("peer_ip") or compute_peer_ip(address["local_ip"], address["netmask"])
+    except (KeyError, PeerIPError):
+        return None
+
+
+def link_addresses(variables):
+    """(kind, address) of the IGP neighbors and transit interfaces of a host"""
+    links = [("interco", neighbor) for neighbor in variables.get("igp", {}).get("neighbors", [])]
+    links.extend(("transit", intf) for intf in variables.get("transit_interfaces", []))
+    for kind, link in links:
+        for version in ("ipv4", "ipv6"):
+            if version in link:
+                yield kind, link[version]
+
+
+def reachable_hosts(hostvars):
+    """host -> hosts whose loopbacks it should reach
+
+    Those of its IGP domain, its pod, found through the addresses of the
+    interco links, and its transit peers when they are in the inventory.
+    Isolated pods do not reach each other.
+    """
+    owners = {}
+    for host, variables in hostvars.items():
+        for _, address in link_addresses(variables):
+            owners[address["local_ip"]] = host
+    neighbors = {host: set() for host in hostvars}
+    transit = {host: set() for host in hostvars}
+    for host, variables in hostvars.items():
+        for kind, address in link_addresses(variables):
+            peer = owners.get(peer_address(address))
+            if peer is None or peer == host:
+                continue
+            if kind == "interco":
+                neighbors[host].add(peer)
+                neighbors[peer].add(host)
+            else:
+                transit[host].add(peer)
+                transit[peer].add(host)
+    domains = {}
+    for host in hostvars:
+        if host in domains:
+            continue
+        domain = {host}
+        pending = [host]
+        while pending:
+            for peer in neighbors[pending.pop()] - domain:
+                domain.add(peer)
+                pending.append(peer)
+        for member in domain:
+            domains[member] = domain
+    return {host: (domains[host] | transit[host]) - {host} for host in hostvars}
+
+
+def expected_checks(hostvars, limit=None):
+    """The reachability matrix the lab should have
+
+    Every host pings its interco peers with a TTL of 1, from the local IP
+    of the link, and from its own loopback the loopbacks of the hosts it
+    should reach, see reachable_hosts.
+    """
+    loopbacks = {
+        host: variables.get("igp", {}).get("loopbacks", {})
+        for host, variables in hostvars.items()
+    }
+    reachable = reachable_hosts(hostvars)
+    checks = []
+    for host, variables in sorted(hostvars.items()):
+        if limit and host not in limit:
+            continue
+        for neighbor in variables.get("igp", {}).get("neighbors", []):
+            for version in ("ipv4", "ipv6"):
+                if version not in neighbor:
+                    continue
+                address = neighbor[version]
+                peer = peer_address(address)
+                if peer is None:
+                    continue
+                checks.append(Check(
+                    host, neighbor.get("peer", peer), "interco", peer, address["local_ip"], 1
+                ))
+        for target in sorted(reachable[host]):
+            for version, address in sorted(loopbacks[target].items()):
+                if version in loopbacks[host]:
+                    checks.append(Check(
+                        host, target, "loopback", address["local_ip"],
+                        loopbacks[host][version]["local_ip"], None
+                    ))
+    return checks
+
+
+def unchecked_hosts(hostvars, checks, limit=None):
+    """Hosts without a single check, no igp data in the inventory for them"""
+    checked = {check.host for check in checks}
+    return [
+        host for host in sorted(hostvars)
+        if (not limit or host in limit) and host not in checked
+    ]
+
+
+class NapalmSession(object):
+    """One NAPALM connection to a device, pings sent as batches of CLI commands"""
+
+    def __init__(self, host, variables, count=PING_COUNT):
+        # Import here: napalm is only needed to reach real devices
+        from napalm import get_network_driver
+
+        self.network_os = variables["ansible_network_os"]
+        self.count = count
+        driver = get_network_driver(self.network_os)
+        self.device = driver(
+            hostname=variables.get("ansible_host", host),
+            username=variables.get("ansible_user"),
+            password=variables.get("ansible_password"),
+        )
+
+    def open(self):
+        self.device.open()
+
+    def close(self):
+        self.device.close()
+
+    def ping(self, checks):
+        """Whether each check got an answer, in one CLI call"""
+        commands = []
+        for check in checks:
+            command = PING_COMMANDS[self.network_os]
+            if ":" in check.dest:
+                command = PING6_COMMANDS.get(self.network_os, command)
+            commands.append(command.format(
+                dest=check.dest, source=check.source, count=self.count,
+                ttl=" ttl {}".format(check.ttl) if check.ttl else "",
+            ))
+        outputs = self.device.cli(commands)
+        results = []
+        for command in commands:
+            loss = PACKET_LOSS.search(outputs.get(command, ""))
+            results.append(loss is not None and float(loss.group(1)) < 100)
+        return results
+
+
+def verify_host(connect, host, variables, checks, batch_size):
+    # Results of the checks of one host, over a single session
+    try:
+        session = connect(host, variables)
+        session.open()
+    except Exception as exc:
+        error = "{}: {}".format(type(exc).__name__, exc)
+        return [(check, False, error) for check in checks]
+    results = []
+    try:
+        for i in range(0, len(checks), batch_size):
+            batch = checks[i:i + batch_size]
+            try:
+                answers = session.ping(batch)
+            except Exception as exc:
+                # The session may still work for the next batch
+                error = "{}: {}".format(type(exc).__name__, exc)
+                results.extend((check, False, error) for check in batch)
+                continue
+            results.extend((check, ok, None) for check, ok in zip(batch, answers))
+    finally:
+        session.close()
+    return results
+
+
+def verify(hostvars, checks, connect, sessions=SESSIONS, batch_size=BATCH_SIZE):
+    """(check, passed, error) for every check
+
+    Hosts are verified on at most sessions connections at once, each one
+    opened once and carrying all the pings of its host.
+    """
+    per_host = collections.OrderedDict()
+    for check in checks:
+        per_host.setdefault(check.host, []).append(check)
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=sessions) as executor:
+        futures = [
+            executor.submit(verify_host, connect, host, hostvars[host], host_checks, batch_size)
+            for host, host_checks in per_host.items()
+        ]
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
+def matrix(results):
+    """host -> target -> passed, a cell passing when all its pings did"""
+    cells = collections.OrderedDict()
+    for check, passed, _ in results:
+        row = cells.setdefault(check.host, collections.OrderedDict())
+        row[check.target] = row.get(check.target, True) and passed
+    return cells
+
+
+def print_matrix(cells):
+    targets = sorted({target for row in cells.values() for target in row})
+    width = max([len(name) for name in list(cells) + targets] + [4])
+    print(" ".rjust(width), *[target.rjust(width) for target in targets])
+    for host, row in cells.items():
+        values = [
+            ("" if target not in row else "ok" if row[target] else "FAIL").rjust(width)
+            for target in targets
+        ]
+        print(host.rjust(width), *values)
+
+
+def main():
+    args = vars(parse_cli_args(sys.argv[1:]))
+
+    hostvars = load_hosts(args['inventory'], args['extra_vars'])
+    checks = expected_checks(hostvars, args['limit'])
+    unchecked = unchecked_hosts(hostvars, checks, args['limit'])
+    if not checks:
+        sys.exit("Nothing to verify: no IGP neighbors or loopbacks in the inventory")
+    if args['fake']:
+        from fakedevice import FakeNetwork
+        connect = FakeNetwork(hostvars).session
+    else:
+        def connect(host, variables):
+            return NapalmSession(host, variables, args['count'])
+
+    results = verify(hostvars, checks, connect, args['sessions'], args['batch_size'])
+    cells = matrix(results)
+    if args['json']:
+        print(json.dumps(cells, indent=2))
+    else:
+        print_matrix(cells)
+    failed = [(check, error) for check, passed, error in results if not passed]
+    for check, error in failed:
+        print("{}: {} {} -> {} failed{}".format(
+            check.host, check.kind, check.source, check.dest,
+            " ({})".format(error) if error else ""
+        ), file=sys.stderr)
+    for host in unchecked:
+        print("{}: nothing to verify".format(host), file=sys.stderr)
+    if failed:
+        sys.exit("{}/{} pings failed".format(len(failed), len(results)))
+    if unchecked:
+        sys.exit("{} host(s) not verified".format(len(unchecked)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import argparse
+import ipaddress
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+import jinja2
+import yaml
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROLE_DIR = os.path.join(BASE_DIR, "roles", "ztp")
+# Same mode as the "generate dhcp configuration" task
+DHCP_STANZA_MODE = 0o777
+INCLUDE_LINE = 'include "{}";'
+# The include lines of a batch, next to the dhcpd config including it
+BATCH_INCLUDES = "{}.ztp-batch"
+
+
+def parse_cli_args(script_args):
+    parser = argparse.ArgumentParser(
+        description="Render the ztp role for every switch at once, as ztp_phase1.yml. "
+                    "Run it on the dhcp_pxe_server_ztp host, or stage the files with --root"
+    )
+    parser.add_argument(
+        '-i', '--inventory', required=True, action='store',
+        help="Inventory script or its JSON output"
+    )
+    parser.add_argument(
+        '-e', '--extra-vars', action='append', default=[], metavar='FILE',
+        help="YAML file of variables overriding the others"
+    )
+    parser.add_argument(
+        '-l', '--limit', nargs='+', action='store',
+        help="Only stage these switches"
+    )
+    parser.add_argument(
+        '--root', default="/", action='store',
+        help="Prefix of the paths written, to stage the files elsewhere, then nothing is restarted"
+    )
+    parser.add_argument(
+        '-p', '--processes', type=int, default=multiprocessing.cpu_count(), action='store',
+    )
+    parser.add_argument(
+        '--service', default="isc-dhcp-server", action='store',
+        help="DHCP service restarted once when its configuration changed"
+    )
+    parser.add_argument(
+        '--no-restart', action='store_true',
+    )
+
+    return parser.parse_args(script_args)
+
+
+def ipaddr(value, query=""):
+    """The ipaddr filter queries used by the templates, without netaddr
+
+    An integer query is the address at that index of the network, with the
+    prefix length: "10.0.0.5/21" | ipaddr('-2') is "10.0.7.254/21".
+    "address" is the address alone. Invalid values give False.
+    """
+    try:
+        interface = ipaddress.ip_interface(value)
+    except ValueError:
+        return False
+    if query in ("", None):
+        return str(interface)
+    if query == "address":
+        return str(interface.ip)
+    try:
+        index = int(query)
+    except ValueError:
+        raise jinja2.exceptions.FilterArgumentError("ipaddr: unsupported query {}".format(query))
+    network = interface.network
+    try:
+        return "{}/{}".format(network[index], network.prefixlen)
+    except IndexError:
+        return False
+
+
+def load_inventory(path):
+    with open(path) as inventory_file:
+        head = inventory_file.read(1)
+    if head == "{":
+        with open(path) as inventory_file:
+            return json.load(inventory_file)
+    return json.loads(subprocess.check_output([path, "--list"]))
+
+
+def load_yaml(path):
+    with open(path) as yaml_file:
+        return yaml.safe_load(yaml_file) or {}
+
+
+def build_hosts(inventory, extra_vars, limit=None):
+    """Variables of every host: role defaults, group vars, host vars, extra vars"""
+    defaults = load_yaml(os.path.join(ROLE_DIR, "defaults", "main.yml"))
+    groups = {}
+    for group, definition in inventory.items():
+        if group == "_meta":
+            continue
+        for host in definition.get("hosts", []):
+            groups.setdefault(host, set()).add(group)
+    hosts = set(inventory.get("_meta", {}).get("hostvars", {})) | set(groups)
+    if limit:
+        hosts &= set(limit)
+    items = []
+    for host in sorted(hosts):
+        variables = dict(defaults)
+        for group in ["all"] + sorted(groups.get(host, set()) - {"all"}):
+            variables.update(inventory.get(group, {}).get("vars", {}))
+        variables.update(inventory["_meta"]["hostvars"].get(host, {}))
+        variables.update(extra_vars)
+        variables["inventory_hostname"] = host
+        variables["inventory_hostname_short"] = host.split(".")[0]
+        variables.setdefault("ansible_host", host)
+        items.append((host, variables))
+    return items
+
+
+def write_if_changed(path, content, mode=0o644):
+    # Atomic replace, only when the content or mode differs
+    try:
+        with open(path) as current:
+            if current.read() == content and os.stat(path).st_mode & 0o777 == mode:
+                return False
+    except (IOError, OSError):
+        pass
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+# Per worker process: templates compiled once, see init_worker
+WORKER = {}
+
+
+def init_worker(root):
+    # The defaults of the template module, with the ipaddr filter
+    environment = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(os.path.join(ROLE_DIR, "templates")),
+        trim_blocks=True,
+        keep_trailing_newline=True,
+        undefined=jinja2.StrictUndefined,
+    )
+    environment.filters["ipaddr"] = ipaddr
+    WORKER.update(
+        environment=environment,
+        switch=environment.get_template("switch_config.j2"),
+        dhcp=environment.get_template("dhcp_config.j2"),
+        root=root,
+    )
+
+
+def resolve(value, variables):
+    # Role defaults refer to the host variables, e.g. {{ site }}
+    while isinstance(value, str) and "{{" in value:
+        value = WORKER["environment"].from_string(value).render(variables)
+    return value
+
+
+def staged(path):
+    return os.path.join(WORKER["root"], path.lstrip("/"))
+
+
+def is_local(host):
+    return host in ("localhost", "127.0.0.1", "::1", socket.gethostname(), socket.getfqdn())
+
+
+def stage_host(item):
+    """Write the switch config and DHCP stanza of one host
+
+    Returns (host, dhcp_config, include line, files changed, error).
+    """
+    host, variables = item
+    try:
+        paths = {
+            name: resolve(variables[name], variables)
+            for name in ("dhcp_config", "dhcp_switch_config_path", "switch_config_path_remote")
+        }
+        switch_config = WORKER["switch"].render(variables)
+        dhcp_stanza = WORKER["dhcp"].render(variables)
+        stanza_path = "{}/{}.conf".format(paths["dhcp_switch_config_path"], host)
+        changed = 0
+        for directory in (paths["switch_config_path_remote"], paths["dhcp_switch_config_path"]):
+            os.makedirs(staged(directory), exist_ok=True)
+        changed += write_if_changed(
+            staged("{}/{}.conf".format(paths["switch_config_path_remote"], host)), switch_config
+        )
+        changed += write_if_changed(staged(stanza_path), dhcp_stanza, DHCP_STANZA_MODE)
+        return host, paths["dhcp_config"], INCLUDE_LINE.format(stanza_path), changed, None
+    except Exception as exc:
+        # One broken host must not stop the others
+        return host, None, None, 0, "{}: {}".format(type(exc).__name__, exc)
+
+
+def stage_hosts(items, root, processes=1, chunksize=32):
+    """Stream stage_host results, across a process pool with processes > 1"""
+    if processes <= 1:
+        init_worker(root)
+        for item in items:
+            yield stage_host(item)
+        return
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(root,)) as pool:
+        for result in pool.imap_unordered(stage_host, items, chunksize):
+            yield result
+
+
+def read_lines(path):
+    try:
+        with open(path) as lines_file:
+            return lines_file.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def update_includes(dhcp_config, lines):
+    """Include the lines of a batch in a dhcpd config: files changed
+
+    The lines go to the BATCH_INCLUDES file of the config, sorted and
+    merged with those of the previous batches, each file written once.
+    The config only gets the include line of that file at its end, its
+    other lines stay as they are, those already in it are not repeated.
+    """
+    batch_includes = BATCH_INCLUDES.format(dhcp_config)
+    path, batch_path = staged(dhcp_config), staged(batch_includes)
+    current = read_lines(path)
+    includes = sorted((set(read_lines(batch_path)) | set(lines)) - set(current))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    changed = int(write_if_changed(batch_path, "".join(line + "\n" for line in includes)))
+    include = INCLUDE_LINE.format(batch_includes)
+    if include not in current:
+        changed += write_if_changed(path, "".join(line + "\n" for line in current + [include]))
+    return changed
+
+
+def main():
+    args = vars(parse_cli_args(sys.argv[1:]))
+
+    extra_vars = {}
+    for path in args['extra_vars']:
+        extra_vars.update(load_yaml(path))
+    items = build_hosts(load_inventory(args['inventory']), extra_vars, args['limit'])
+
+    # The role delegates to the DHCP/PXE server, the files are written here
+    init_worker(args['root'])
+    servers = sorted({
+        resolve(variables.get("dhcp_pxe_server_ztp", "localhost"), variables)
+        for _, variables in items
+    })
+    remote = [server for server in servers if not is_local(server)]
+    if remote and args['root'] == "/":
+        sys.exit("Run it on {} or stage the files with --root".format(", ".join(remote)))
+
+    includes = {}
+    changed = 0
+    errors = {}
+    for host, dhcp_config, include, host_changed, error in stage_hosts(
+        items, args['root'], args['processes']
+    ):
+        if error:
+            errors[host] = error
+            print("{}: {}".format(host, error), file=sys.stderr)
+            continue
+        includes.setdefault(dhcp_config, set()).add(include)
+        changed += host_changed
+
+    # One include file per site, each written once
+    for dhcp_config, lines in sorted(includes.items()):
+        changed += update_includes(dhcp_config, lines)
+
+    print("{} switches staged, {} files changed".format(len(items) - len(errors), changed))
+    if changed and not args['no_restart']:
+        if args['root'] != "/":
+            print("Copy {} to {}, then restart {} there".format(
+                args['root'], ", ".join(servers), args['service']
+            ))
+        else:
+            # A single restart for the whole batch, as the run_once task. dhcpd
+            # has no reload action
+            subprocess.check_call(["service", args['service'], "restart"])
+    if errors:
+        sys.exit("{} switch(es) failed".format(len(errors)))
+
+
+if __name__ == '__main__':
+    main()